@@ -2,20 +2,42 @@
 This is the main application file for the Lecture Material RAG Assistant (streamlit app)
 '''
 import streamlit as st
-import boto3
-import io
-import os
-import tempfile
-from pptx import Presentation
-from openai import OpenAI
-import time
-
-from src.ingestAndParse import IngesterAndParser
-from src.preprocessAndChunk import TextPreprocesser
-from src.embedAndSearch import EmbedAndSearch
-from src.utils.awsService import S3DocumentProcessor
-from src.utils.gptService import GPTService
-from src.utils.pineconeService import PineConeService
+
+from src.serviceContainer import get_services
+from src.preprocessAndChunk import describe_source
+from src.metadataIndex import course_of
+from src.utils.tracing import tracer, InMemoryCollector
+
+
+def show_ingestion_jobs(services):
+    '''
+    Progress of the recent ingestion jobs, refreshed every 2 seconds while some are active
+    '''
+    jobs = services.ingestQueue.jobs(limit=10)
+    active = any(job["status"] in ("queued", "running") for job in jobs)
+
+    @st.fragment(run_every=2 if active else None)
+    def jobs_panel():
+        jobs = services.ingestQueue.jobs(limit=10)
+        if not jobs:
+            return
+        st.subheader("Ingestion")
+        for job in jobs:
+            if job["status"] == "queued":
+                st.text(f"⏳ {job['filename']} (queued)")
+            elif job["status"] == "running":
+                progress = job["uploaded"] / job["chunks"] if job["chunks"] else 0.0
+                st.progress(min(progress, 1.0), text=f"{job['filename']}: {job['stage'] or 'starting'} "
+                                                     f"({job['uploaded']}/{job['chunks']} chunks)")
+            elif job["status"] == "done":
+                st.text(f"✓ {job['filename']} ({job['chunks']} chunks)")
+            else:
+                st.error(f"{job['filename']}: {job['error']}")
+        # the fragment stops polling once every job has finished
+        if not any(job["status"] in ("queued", "running") for job in jobs) and active:
+            st.rerun()
+
+    jobs_panel()
 
 
 def main():
@@ -25,16 +47,21 @@ def main():
     if "messages" not in st.session_state:
         st.session_state.messages = []
 
-    # Initialize services (pipelines)
-    ingesterAndParser = IngesterAndParser()
-    textPreprocesser = TextPreprocesser()
-    embedAndSearch = EmbedAndSearch()
-    pineconeService = PineConeService()
-    gptService = GPTService()
-    s3processor = S3DocumentProcessor()
+    # Services (clients, vector store, caches) are created once per process and reused by every
+    # rerun; the client libraries are imported the first time a service needs them
+    services = get_services()
+
+    # Populate an empty local store once from the existing Pinecone index
+    services.sync_vector_store()
+    # Workers ingesting the queued files (and resuming the jobs interrupted by a restart)
+    services.ingestQueue.start()
     
     # Sidebar for file upload and management
     with st.sidebar:
+        # Per-stage timings (TRACE_EXPORTER=log|memory enables them from the start)
+        if st.checkbox("Trace pipeline stages", value=tracer.enabled) != tracer.enabled:
+            tracer.set_exporter(InMemoryCollector() if not tracer.enabled else None)
+
         st.header("Document Management")
         
         # File uploader
@@ -49,52 +76,57 @@ def main():
             
             # Process button
             if st.button("Process New Files"):
-                existing_files = s3processor.list_files()
-                with st.spinner("Processing files..."):
-                    for uploaded_file in st.session_state.uploaded_files:
-                        if uploaded_file.name in existing_files:
-                            st.info(f"{uploaded_file.name} has already been processed!")
-                            continue
-                        else:
-                            st.info(f"Uploading {uploaded_file.name} to S3...")
-                            print(f"UPLOADED FILE OBJ = {uploaded_file}")
-                            s3_key = s3processor.upload_file_to_s3(uploaded_file)
-                            
-                            if s3_key:
-                                try:
-                                    st.info(f"Processing and indexing {uploaded_file.name}...")
-                                    # Extract text from uploaded file 
-                                    doc = ingesterAndParser.extract_text_from_pptx(uploaded_file)
-
-                                    # Chunk text 
-                                    chunks = textPreprocesser.chunk_text(doc)
-
-                                    # Generate embeddings 
-                                    embeddings = embedAndSearch.generate_embeddings(chunks)
-
-                                    pineconeService.initialize_index("custom-rag-llm")
-
-                                    # upload to pinecone
-                                    pineconeService.upload_embeddings("custom-rag-llm", embeddings)
-
-                                    st.success(f"Successfully processed {uploaded_file.name}")
-                                
-                                except Exception as e:
-                                    st.error(f"Error processing {uploaded_file.name}: {e}")
-                                
-                # Clear the uploaded files list after processing
+                # Files are ingested in the background, the chat stays usable while they are processed
+                for uploaded_file in st.session_state.uploaded_files:
+                    job = services.ingestQueue.submit(uploaded_file)
+                    if job["duplicate"]:
+                        st.info(f"{uploaded_file.name} is already {job['status']}")
+                    else:
+                        st.info(f"Queued {uploaded_file.name}")
                 st.session_state.uploaded_files = []
-                st.rerun()
-        
-        # Display existing files in S3 bucket
+
+        show_ingestion_jobs(services)
+
+        # Display existing files in S3 bucket, only on demand: listing them creates the S3 client
+        # (boto3), which a chat-only session doesn't need
         st.subheader("Existing Files")
-        existing_files = s3processor.list_files()
-        if existing_files:
-            for file_key in existing_files:
-                filename = file_key.split("/")[-1]
-                st.text(f"• {filename}")
+        existing_files = None
+        if st.toggle("Show files in S3"):
+            existing_files = services.list_files()
+            if existing_files:
+                for file_key in existing_files:
+                    filename = file_key.split("/")[-1]
+                    st.text(f"• {filename}")
+            else:
+                st.info("No files found in S3 bucket")
+
+        # Restrict the search to some courses, files or slides (only the matching vectors are scored)
+        st.subheader("Search Scope")
+        metadata_filter = {}
+        scope_index = services.vectorBackend.metadata_index()
+        if scope_index is not None:
+            courses = st.multiselect("Courses", sorted(scope_index.courses))
+            files = st.multiselect("Files", sorted(services.vectorStore.filenames()))
+            location_range = scope_index.location_range(files)
+            if location_range and location_range[0] < location_range[1]:
+                slide_range = st.slider("Slides / pages", location_range[0], location_range[1], location_range)
+                if slide_range != location_range:
+                    metadata_filter["slide_range"] = slide_range
         else:
-            st.info("No files found in S3 bucket")
+            # pinecone backend: no local metadata, the choices come from the files in S3
+            if existing_files is None:
+                existing_files = services.list_files()
+            filenames = sorted({file_key.split("/")[-1] for file_key in existing_files or []})
+            courses = st.multiselect("Courses", sorted({course_of(name) for name in filenames} - {None}))
+            files = st.multiselect("Files", filenames)
+        if courses:
+            metadata_filter["course"] = courses
+        if files:
+            metadata_filter["filename"] = files
+
+        cache_stats = services.embeddingCache.stats()
+        st.caption(f"Embedding cache: {cache_stats['hits']} hits / {cache_stats['misses']} misses, "
+                   f"~{cache_stats['saved_tokens']} tokens and {cache_stats['saved_seconds']:.1f}s saved")
     
     # Chat interface
     st.header("Chat with your Lecture Assistant")
@@ -120,37 +152,48 @@ def main():
             message_placeholder = st.empty()
             message_placeholder.markdown("Thinking...")
             
-            # Search for relevant contexts
-            with st.spinner("Searching lecture materials..."):
-                # Load stored embeddings from pinecone index
-                stored_embeddings = pineconeService.load_stored_embeddings("custom-rag-llm")
-                # Generate embeddings
-                print("Generating embeddings for Query...")
-                contexts = embedAndSearch.semantic_search(prompt, stored_embeddings)
-                print(f'\nDEBUGGING CONTEXT: {contexts}')
-        
-            # Check if contexts were found
-            if not contexts:
-                response = "I couldn't find any relevant information in your lecture materials. Please upload some lecture files or try a different question."
-            else:
-                # Construct prompt with contexts
-                full_prompt = gptService.construct_prompt(prompt, contexts)
-                
-                # Generate response
-                with st.spinner("Generating response..."):
-                    response = gptService.generate_answer(full_prompt)
+            # Search the local vector store (or reuse a cached answer). The question runs on the
+            # event loop shared by every session; the embedding request, the cache lookup and the
+            # index refresh overlap, and leaving the page cancels the requests in flight
+            response = ""
+            try:
+                with st.spinner("Searching lecture materials..."):
+                    result = services.eventLoop.run(services.asyncQueryPipeline.answer_stream(
+                        prompt, metadata_filter=metadata_filter or None))
+
+                # Render the response as the tokens arrive
+                for token in services.eventLoop.iterate(result["stream"]):
+                    response += token
+                    message_placeholder.markdown(response + "▌")
+            except TimeoutError as e:
+                message_placeholder.markdown(response + f"\n\nThe assistant took too long to answer ({e}), please try again.")
+                st.stop()
+            message_placeholder.markdown(response)
+
+            stats = result["stream"].stats
+            if result["cached"]:
+                st.caption(f"Cached answer ({result['cached']} match)")
+            elif stats["time_to_first_token"] is not None:
+                caption = (f"First token after {stats['time_to_first_token']:.2f}s, "
+                           f"{stats['tokens']} tokens at {stats['tokens_per_second'] or 0:.0f} tokens/s")
+                if result["packing"]:
+                    caption += (f" · context: {result['packing']['tokens_used']} tokens "
+                                f"({result['packing']['tokens_saved']} saved)")
+                st.caption(caption)
             
             # Display source information
             st.markdown("#### Sources:")
-            for context in contexts:
-                st.markdown(f"- {context['metadata']['filename']} (slide number: {context['metadata']['slide_number']})")
-            
-            # Update message placeholder with response
-            message_placeholder.markdown(response)
+            for source in result["sources"]:
+                st.markdown(f"- {source['filename']} ({describe_source(source)})")
             
             # Add assistant response to chat history
             st.session_state.messages.append({"role": "assistant", "content": response})
 
+    if isinstance(tracer.exporter, InMemoryCollector):
+        with st.sidebar:
+            st.subheader("Pipeline stages")
+            st.dataframe([{"stage": name, **stage} for name, stage in tracer.exporter.summary().items()])
+
 
 
 if __name__=="__main__":
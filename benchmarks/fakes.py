@@ -0,0 +1,207 @@
+'''
+Deterministic local stand-ins for the external services used by the pipeline, so benchmarks
+measure our own code and not the network:
+ - FakeOpenAI: embeddings (hash-seeded unit vectors) and chat completions (streamed or not)
+ - FakeAsyncOpenAI: the same for the AsyncOpenAI client (latency awaited with asyncio.sleep)
+ - FakeS3Client: the boto3 S3 calls used by S3DocumentProcessor
+ - InMemoryPinecone (re-exported from src.utils.inMemoryIndex)
+Each fake can add a fixed latency per call to simulate network round trips.'''
+import asyncio
+import hashlib
+import io
+import threading
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+import numpy as np
+
+from src.utils.inMemoryIndex import InMemoryPinecone, InMemoryIndex
+
+
+def fake_embedding(text, dim):
+    '''
+    Unit vector derived from the text, the same text always gets the same vector
+    '''
+    seed = int.from_bytes(hashlib.sha1(text.encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).normal(size=dim).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+class FakeEmbeddings():
+    def __init__(self, dim, latency):
+        self.dim = dim
+        self.latency = latency
+        self.calls = 0
+        self.inputs = 0
+        self._lock = threading.Lock()
+
+    def create(self, input, model):
+        if self.latency:
+            time.sleep(self.latency)
+        return self._response(input)
+
+    def _response(self, input):
+        inputs = [input] if isinstance(input, str) else list(input)
+        with self._lock:
+            self.calls += 1
+            self.inputs += len(inputs)
+        data = [SimpleNamespace(index=i, embedding=fake_embedding(text, self.dim).tolist()) for i, text in enumerate(inputs)]
+        return SimpleNamespace(data=data, usage=SimpleNamespace(total_tokens=sum(len(text) // 4 for text in inputs)))
+
+
+class FakeCompletions():
+    def __init__(self, latency, tokens, token_latency):
+        self.latency = latency
+        self.tokens = tokens
+        self.token_latency = token_latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _answer_tokens(self, messages):
+        words = messages[-1]["content"].split()
+        return [f"{words[i % len(words)] if words else 'answer'} " for i in range(self.tokens)]
+
+    def create(self, model, messages, stream=False, **kwargs):
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        tokens = self._answer_tokens(messages)
+        if not stream:
+            if self.token_latency:
+                time.sleep(self.token_latency * len(tokens))
+            message = SimpleNamespace(content="".join(tokens))
+            return SimpleNamespace(choices=[SimpleNamespace(message=message)],
+                                   usage=SimpleNamespace(completion_tokens=len(tokens)))
+
+        def chunks():
+            for token in tokens:
+                if self.token_latency:
+                    time.sleep(self.token_latency)
+                yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=token))], usage=None)
+            yield SimpleNamespace(choices=[], usage=SimpleNamespace(completion_tokens=len(tokens)))
+        return chunks()
+
+
+class FakeOpenAI():
+    '''
+    Drop-in for the OpenAI client: client.embeddings.create and client.chat.completions.create
+    '''
+    def __init__(self, dim=1536, embedding_latency=0.0, chat_latency=0.0, answer_tokens=50, token_latency=0.0):
+        self.embeddings = FakeEmbeddings(dim, embedding_latency)
+        self.chat = SimpleNamespace(completions=FakeCompletions(chat_latency, answer_tokens, token_latency))
+
+
+class FakeAsyncEmbeddings(FakeEmbeddings):
+    async def create(self, input, model):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._response(input)
+
+
+class FakeAsyncCompletions(FakeCompletions):
+    async def create(self, model, messages, stream=False, **kwargs):
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        tokens = self._answer_tokens(messages)
+        if not stream:
+            if self.token_latency:
+                await asyncio.sleep(self.token_latency * len(tokens))
+            message = SimpleNamespace(content="".join(tokens))
+            return SimpleNamespace(choices=[SimpleNamespace(message=message)],
+                                   usage=SimpleNamespace(completion_tokens=len(tokens)))
+
+        async def chunks():
+            for token in tokens:
+                if self.token_latency:
+                    await asyncio.sleep(self.token_latency)
+                yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=token))], usage=None)
+            yield SimpleNamespace(choices=[], usage=SimpleNamespace(completion_tokens=len(tokens)))
+        return chunks()
+
+
+class FakeAsyncOpenAI():
+    '''
+    Drop-in for the AsyncOpenAI client (same arguments as FakeOpenAI)
+    '''
+    def __init__(self, dim=1536, embedding_latency=0.0, chat_latency=0.0, answer_tokens=50, token_latency=0.0):
+        self.embeddings = FakeAsyncEmbeddings(dim, embedding_latency)
+        self.chat = SimpleNamespace(completions=FakeAsyncCompletions(chat_latency, answer_tokens, token_latency))
+
+
+class FakeS3Client():
+    '''
+    In-memory S3 bucket implementing the boto3 calls used by S3DocumentProcessor
+    '''
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.objects = {}
+        self._lock = threading.Lock()
+
+    def _put(self, bucket, key, data):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.objects[(bucket, key)] = {
+                "Body": data,
+                "ETag": '"' + hashlib.md5(data).hexdigest() + '"',
+                "Size": len(data),
+                "LastModified": datetime.now(timezone.utc)
+            }
+
+    def upload_fileobj(self, fileobj, bucket, key, **kwargs):
+        self._put(bucket, key, fileobj.read())
+
+    def upload_file(self, filename, bucket, key, **kwargs):
+        with open(filename, "rb") as f:
+            self._put(bucket, key, f.read())
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self._put(Bucket, Key, Body if isinstance(Body, bytes) else Body.read())
+        return {"ETag": self.objects[(Bucket, Key)]["ETag"]}
+
+    def get_object(self, Bucket, Key):
+        item = self.objects[(Bucket, Key)]
+        return {"Body": io.BytesIO(item["Body"]), "ETag": item["ETag"], "ContentLength": item["Size"]}
+
+    def head_object(self, Bucket, Key):
+        item = self.objects[(Bucket, Key)]
+        return {"ETag": item["ETag"], "ContentLength": item["Size"]}
+
+    def list_objects_v2(self, Bucket, Prefix="", MaxKeys=1000, ContinuationToken=None, StartAfter=None):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix))
+        start_after = ContinuationToken or StartAfter
+        if start_after:
+            keys = [key for key in keys if key > start_after]
+        page = keys[:MaxKeys]
+        response = {"KeyCount": len(page), "IsTruncated": len(keys) > MaxKeys}
+        if page:
+            response["Contents"] = [{"Key": key, "ETag": self.objects[(Bucket, key)]["ETag"],
+                                     "Size": self.objects[(Bucket, key)]["Size"],
+                                     "LastModified": self.objects[(Bucket, key)]["LastModified"]} for key in page]
+        if response["IsTruncated"]:
+            response["NextContinuationToken"] = page[-1]
+        return response
+
+    def get_paginator(self, operation):
+        assert operation == "list_objects_v2"
+        client = self
+
+        class Paginator():
+            def paginate(self, Bucket, Prefix="", PaginationConfig=None, **kwargs):
+                token = None
+                while True:
+                    page = client.list_objects_v2(Bucket=Bucket, Prefix=Prefix, ContinuationToken=token, **kwargs)
+                    yield page
+                    if not page["IsTruncated"]:
+                        return
+                    token = page["NextContinuationToken"]
+        return Paginator()
+
+
+__all__ = ["FakeOpenAI", "FakeS3Client", "InMemoryPinecone", "InMemoryIndex", "fake_embedding"]
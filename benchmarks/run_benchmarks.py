@@ -0,0 +1,305 @@
+'''
+Offline benchmark suite. Every external service is replaced by the deterministic stand-ins of
+benchmarks.fakes, so the numbers only reflect our own code and are reproducible from run to run:
+ - ingest: synthetic pptx/pdf files through IngestPipeline (parse -> chunk -> embed -> upload to
+   the in-memory Pinecone and the local vector store), reported in slides/sec
+ - s3: uploading the synthetic files to the S3 stand-in and listing them
+ - query: p50/p95/p99 latency of the vector search alone and of QueryPipeline end to end, for
+   stores of each of the given sizes (number of chunks), and of --sessions questions answered at
+   the same time by AsyncQueryPipeline on one event loop
+Results are printed (or written with --output) as JSON so runs can be compared.
+
+Run from the repository root:
+    python -m benchmarks.run_benchmarks --sizes 1000,10000,100000 --output results.json
+'''
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+from src.ingestAndParse import IngesterAndParser
+from src.preprocessAndChunk import TextPreprocesser
+from src.embedAndSearch import EmbedAndSearch
+from src.ingestPipeline import IngestPipeline
+from src.vectorStore import LocalVectorStore
+from src.queryPipeline import QueryPipeline
+from src.asyncQueryPipeline import AsyncQueryPipeline
+from src.contextPacker import ContextPacker
+from src.utils.gptService import GPTService
+from src.utils.pineconeService import PineConeService
+from src.utils.awsService import S3DocumentProcessor
+from src.utils.tracing import tracer, InMemoryCollector
+from .fakes import FakeOpenAI, FakeAsyncOpenAI, FakeS3Client, InMemoryPinecone
+from .synthetic import make_corpus, synthetic_vectors, lecture_text
+
+QUESTIONS = [
+    "What is gradient descent?",
+    "Explain the bias variance tradeoff",
+    "How does attention work in a transformer?",
+    "What does Bayes theorem say?",
+    "When should I use regularization?",
+]
+
+
+def percentiles(samples):
+    samples = np.asarray(samples, dtype=np.float64) * 1000
+    return {
+        "runs": int(len(samples)),
+        "mean_ms": float(samples.mean()),
+        "p50_ms": float(np.percentile(samples, 50)),
+        "p95_ms": float(np.percentile(samples, 95)),
+        "p99_ms": float(np.percentile(samples, 99)),
+    }
+
+
+def log(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+@contextlib.contextmanager
+def quiet():
+    # the pipeline prints progress to stdout, keep it out of the JSON output
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def bench_ingest(workdir, file_paths, args):
+    client = FakeOpenAI(dim=args.dim, embedding_latency=args.embedding_latency)
+    embedAndSearch = EmbedAndSearch(client=client)
+    pineconeService = PineConeService(pc=InMemoryPinecone())
+    pineconeService.initialize_index("benchmark", dimension=args.dim)
+    vectorStore = LocalVectorStore(os.path.join(workdir, "ingest_store"))
+
+    def upload(embeddings):
+        pineconeService.upload_embeddings("benchmark", embeddings, raise_on_error=True)
+        vectorStore.upsert(embeddings)
+
+    textPreprocesser = TextPreprocesser(target_tokens=args.chunk_tokens, overlap_tokens=args.chunk_overlap)
+    pipeline = IngestPipeline(IngesterAndParser(), textPreprocesser, embedAndSearch, upload,
+                              max_workers=args.workers)
+    start = time.perf_counter()
+    with quiet():
+        reports = pipeline.run(file_paths)
+    seconds = time.perf_counter() - start
+
+    slides = args.decks * args.slides_per_deck + args.pdfs * args.pages_per_pdf
+    return {
+        "files": len(file_paths),
+        "slides": slides,
+        "chunks": len(vectorStore),
+        "failed_files": sum(report["status"] != "done" for report in reports.values()),
+        "embedding_calls": client.embeddings.calls,
+        "seconds": seconds,
+        "slides_per_second": slides / seconds if seconds else None,
+        "chunks_per_second": len(vectorStore) / seconds if seconds else None,
+    }
+
+
+def bench_s3(docs, args):
+    s3 = S3DocumentProcessor(s3=FakeS3Client(latency=args.s3_latency), bucket_name="benchmark")
+    start = time.perf_counter()
+    with quiet():
+        uploaded = s3.upload_to_s3(docs)
+    upload_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    with quiet():
+        listed = s3.list_files()
+    return {
+        "files": len(uploaded),
+        "upload_seconds": upload_seconds,
+        "listed": len(listed),
+        "list_seconds": time.perf_counter() - start,
+    }
+
+
+def build_store(directory, size, dim, seed=0, ann_min_vectors=None, nprobe=8, quantization=None):
+    '''
+    Fill a LocalVectorStore with size synthetic chunks (written in batches)
+    '''
+    rng = np.random.default_rng(seed)
+    store = LocalVectorStore(directory, ann_min_vectors=ann_min_vectors, nprobe=nprobe, quantization=quantization)
+    for start, vectors in synthetic_vectors(size, dim, seed=seed):
+        store.append([{
+            "id": f"chunk_{start + i}",
+            "text": lecture_text(rng, 40),
+            "embedding": vector,
+            "metadata": {"filename": f"lecture_{(start + i) // 500:04d}.pptx", "slide_number": (start + i) % 500 + 1}
+        } for i, vector in enumerate(vectors)])
+    return store
+
+
+def bench_query(workdir, size, args):
+    client = FakeOpenAI(dim=args.dim, chat_latency=args.chat_latency, answer_tokens=args.answer_tokens)
+    async_client = FakeAsyncOpenAI(dim=args.dim, embedding_latency=args.embedding_latency,
+                                   chat_latency=args.chat_latency, answer_tokens=args.answer_tokens)
+    start = time.perf_counter()
+    store = build_store(os.path.join(workdir, f"store_{size}"), size, args.dim,
+                        ann_min_vectors=args.ann_min_vectors, nprobe=args.nprobe, quantization=args.quantization)
+    build_seconds = time.perf_counter() - start
+    embedAndSearch = EmbedAndSearch(client=client, async_client=async_client)
+    gptService = GPTService(client=client, context_packer=ContextPacker(token_budget=args.token_budget),
+                            async_client=async_client)
+    pipeline = QueryPipeline(embedAndSearch, store, gptService, top_k=args.top_k)
+
+    query_embeddings = [embedAndSearch.embed_query(question) for question in QUESTIONS]
+    with quiet():
+        # warm up: first search opens the memmap and builds/loads the ANN index if any
+        embedAndSearch.search_by_embedding(query_embeddings[0], store, top_k=args.top_k)
+        pipeline.answer(QUESTIONS[0])
+
+        search_times = []
+        for i in range(args.queries):
+            start = time.perf_counter()
+            embedAndSearch.search_by_embedding(query_embeddings[i % len(query_embeddings)], store, top_k=args.top_k)
+            search_times.append(time.perf_counter() - start)
+
+        hybrid_times = []
+        keyword_times = []
+        for i in range(args.queries):
+            question = QUESTIONS[i % len(QUESTIONS)]
+            start = time.perf_counter()
+            embedAndSearch.search_by_embedding(query_embeddings[i % len(query_embeddings)], store, top_k=args.top_k,
+                                               query_text=question)
+            hybrid_times.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            embedAndSearch.keyword_search(question, store, top_k=args.top_k)
+            keyword_times.append(time.perf_counter() - start)
+
+        # scoped to one lecture (build_store puts 500 chunks in every file)
+        scope = {"filename": "lecture_0000.pptx"}
+        embedAndSearch.search_by_embedding(query_embeddings[0], store, top_k=args.top_k, metadata_filter=scope)
+        scoped_times = []
+        for i in range(args.queries):
+            start = time.perf_counter()
+            embedAndSearch.search_by_embedding(query_embeddings[i % len(query_embeddings)], store, top_k=args.top_k,
+                                               query_text=QUESTIONS[i % len(QUESTIONS)], metadata_filter=scope)
+            scoped_times.append(time.perf_counter() - start)
+
+        # all questions scored together (one matrix-matrix product per block of rows)
+        batch_times = []
+        for _ in range(max(1, args.queries // len(query_embeddings))):
+            start = time.perf_counter()
+            embedAndSearch.search_many(query_embeddings, store, top_k=args.top_k, queries=QUESTIONS)
+            batch_times.append((time.perf_counter() - start) / len(query_embeddings))
+
+        end_to_end_times = []
+        for i in range(args.queries):
+            start = time.perf_counter()
+            pipeline.answer(QUESTIONS[i % len(QUESTIONS)])
+            end_to_end_times.append(time.perf_counter() - start)
+
+        # concurrent sessions on one event loop (no answer cache, every question is answered)
+        asyncPipeline = AsyncQueryPipeline(pipeline)
+        questions = [f"{QUESTIONS[i % len(QUESTIONS)]} ({i})" for i in range(args.sessions)]
+        start = time.perf_counter()
+        session_results = asyncio.run(asyncPipeline.answer_many(questions))
+        sessions_seconds = time.perf_counter() - start
+
+    return {
+        "chunks": size,
+        "ann": store.ann() is not None,
+        "memory": store.memory_report(),
+        "build_seconds": build_seconds,
+        "search": percentiles(search_times),
+        "hybrid_search": percentiles(hybrid_times),
+        "keyword_search": percentiles(keyword_times),
+        "scoped_search": percentiles(scoped_times),
+        "batch_search_per_query": percentiles(batch_times),
+        "end_to_end": percentiles(end_to_end_times),
+        "async_sessions": {"sessions": args.sessions, "wall_seconds": sessions_seconds,
+                           "errors": sum(result["error"] is not None for result in session_results),
+                           **percentiles([result["seconds"] for result in session_results])},
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the RAG pipeline")
+    parser.add_argument("--sizes", default="1000,10000,100000",
+                        help="comma separated store sizes (chunks) for the query benchmark, e.g. 1000,1000000")
+    parser.add_argument("--dim", type=int, default=256, help="embedding dimension (ada-002 is 1536)")
+    parser.add_argument("--queries", type=int, default=200, help="timed queries per store size")
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--token-budget", type=int, default=3000)
+    parser.add_argument("--ann-min-vectors", type=int, default=None,
+                        help="use the IVF index for stores at least this large (default: exact search)")
+    parser.add_argument("--nprobe", type=int, default=8)
+    parser.add_argument("--quantization", default=None, choices=["float16", "int8", "pq"],
+                        help="search compressed vectors with exact re-ranking")
+    parser.add_argument("--decks", type=int, default=10, help="synthetic pptx files to ingest")
+    parser.add_argument("--slides-per-deck", type=int, default=40)
+    parser.add_argument("--pdfs", type=int, default=2, help="synthetic pdf files to ingest")
+    parser.add_argument("--pages-per-pdf", type=int, default=60)
+    parser.add_argument("--workers", type=int, default=None, help="parser processes")
+    parser.add_argument("--chunk-tokens", type=int, default=300, help="target chunk size in tokens")
+    parser.add_argument("--chunk-overlap", type=int, default=40, help="overlap of the parts of a split slide")
+    parser.add_argument("--embedding-latency", type=float, default=0.0, help="simulated seconds per embeddings call")
+    parser.add_argument("--chat-latency", type=float, default=0.0, help="simulated seconds per chat call")
+    parser.add_argument("--s3-latency", type=float, default=0.0, help="simulated seconds per S3 call")
+    parser.add_argument("--answer-tokens", type=int, default=50)
+    parser.add_argument("--sessions", type=int, default=50, help="questions answered at the same time by the async pipeline")
+    parser.add_argument("--trace", action="store_true", help="add a per-stage timing summary to the results")
+    parser.add_argument("--skip", default="", help="comma separated benchmarks to skip: ingest,s3,query")
+    parser.add_argument("--workdir", default=None, help="directory for generated files (default: a temp dir)")
+    parser.add_argument("--output", default=None, help="write the JSON results to this file")
+    args = parser.parse_args(argv)
+    skip = set(filter(None, args.skip.split(",")))
+
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": vars(args),
+    }
+    collector = None
+    if args.trace:
+        collector = InMemoryCollector()
+        tracer.set_exporter(collector)
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        docs = os.path.join(workdir, "docs")
+        if "ingest" not in skip or "s3" not in skip:
+            log("Generating synthetic documents...")
+            file_paths = make_corpus(docs, args.decks, args.slides_per_deck,
+                                     n_pdfs=args.pdfs, pages_per_pdf=args.pages_per_pdf)
+        if "ingest" not in skip:
+            log("Running ingest benchmark...")
+            results["ingest"] = bench_ingest(workdir, file_paths, args)
+        if "s3" not in skip:
+            log("Running S3 benchmark...")
+            results["s3"] = bench_s3(docs, args)
+        if "query" not in skip:
+            results["query"] = []
+            for size in (int(size) for size in args.sizes.split(",") if size):
+                log(f"Running query benchmark with {size} chunks...")
+                results["query"].append(bench_query(workdir, size, args))
+
+    if collector is not None:
+        results["stages"] = collector.summary()
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+        log(f"Results written to {args.output}")
+    else:
+        print(output)
+    return results
+
+
+if __name__ == "__main__":
+    main()
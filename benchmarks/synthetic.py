@@ -0,0 +1,65 @@
+'''
+Generators of synthetic lecture material: pptx decks, pdf documents and stored vectors.'''
+import os
+import numpy as np
+import fitz  # PyMuPDF
+from pptx import Presentation
+
+WORDS = ("gradient descent loss function neural network layer activation matrix vector eigenvalue "
+         "probability distribution bayes theorem regression classification entropy variance bias "
+         "overfitting regularization convolution attention transformer embedding token softmax "
+         "derivative integral limit theorem proof lemma algorithm complexity graph tree sort").split()
+
+
+def lecture_text(rng, n_words):
+    return " ".join(rng.choice(WORDS, size=n_words))
+
+
+def make_pptx(path, n_slides, words_per_slide=60, seed=0):
+    rng = np.random.default_rng(seed)
+    prs = Presentation()
+    layout = prs.slide_layouts[1]
+    for i in range(n_slides):
+        slide = prs.slides.add_slide(layout)
+        slide.shapes.title.text = f"Slide {i + 1}: {lecture_text(rng, 4)}"
+        slide.placeholders[1].text = lecture_text(rng, words_per_slide)
+    prs.save(path)
+    return path
+
+
+def make_pdf(path, n_pages, words_per_page=200, seed=0):
+    rng = np.random.default_rng(seed)
+    pdf = fitz.open()
+    for i in range(n_pages):
+        page = pdf.new_page()
+        rect = fitz.Rect(50, 50, page.rect.width - 50, page.rect.height - 50)
+        page.insert_textbox(rect, f"Page {i + 1}\n" + lecture_text(rng, words_per_page), fontsize=9)
+    pdf.save(path)
+    pdf.close()
+    return path
+
+
+def make_corpus(directory, n_decks, slides_per_deck, n_pdfs=0, pages_per_pdf=0, seed=0):
+    '''
+    Write n_decks pptx and n_pdfs pdf files into directory, returns their paths
+    '''
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i in range(n_decks):
+        paths.append(make_pptx(os.path.join(directory, f"lecture_{i:04d}.pptx"), slides_per_deck, seed=seed + i))
+    for i in range(n_pdfs):
+        paths.append(make_pdf(os.path.join(directory, f"reading_{i:04d}.pdf"), pages_per_pdf, seed=seed + n_decks + i))
+    return paths
+
+
+def synthetic_vectors(n, dim, n_topics=None, seed=0, batch_size=65536):
+    '''
+    Yield batches of clustered unit vectors (n in total) so large corpora never sit in memory at once
+    '''
+    rng = np.random.default_rng(seed)
+    n_topics = n_topics or max(1, n // 100)
+    topics = rng.normal(size=(n_topics, dim)).astype(np.float32)
+    for start in range(0, n, batch_size):
+        size = min(batch_size, n - start)
+        vectors = topics[rng.integers(0, n_topics, size)] + 0.5 * rng.normal(size=(size, dim)).astype(np.float32)
+        yield start, vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
@@ -0,0 +1,189 @@
+'''
+This module contains the IVFIndex class, an approximate nearest neighbour index (inverted file)
+for large collections where brute-force cosine search becomes too slow.
+
+The vectors are clustered with spherical k-means into n_lists lists. A query is only scored against
+the vectors of its nprobe closest lists, so nprobe trades recall for latency. The index only stores
+the centroids and the list of every row, the vectors themselves stay in the (memory-mapped) matrix.
+
+Run this module directly to print a recall-vs-latency report against exact search:
+    python -m src.annIndex --store vector_store
+'''
+import argparse
+import json
+import time
+import numpy as np
+
+from .vectorSearch import normalize_rows, top_k_indices
+
+
+class IVFIndex():
+    def __init__(self, centroids, assignments=None, nprobe=8):
+        self.centroids = normalize_rows(centroids)
+        self.assignments = np.empty(0, dtype=np.int32) if assignments is None else np.asarray(assignments, dtype=np.int32)
+        self.nprobe = nprobe
+        self._order = None
+        self._starts = None
+
+    @property
+    def n_lists(self):
+        return self.centroids.shape[0]
+
+    def __len__(self):
+        return self.assignments.shape[0]
+
+    @classmethod
+    def train(cls, matrix, n_lists=None, iterations=10, max_training_points=256, nprobe=8, seed=0):
+        '''
+        Cluster (a sample of) the normalized matrix with spherical k-means and index every row.
+        n_lists defaults to 4 * sqrt(n).
+        '''
+        n = matrix.shape[0]
+        if n_lists is None:
+            n_lists = int(4 * np.sqrt(n))
+        n_lists = max(1, min(n_lists, n))
+        rng = np.random.default_rng(seed)
+
+        sample_size = min(n, n_lists * max_training_points)
+        sample = normalize_rows(matrix[np.sort(rng.choice(n, size=sample_size, replace=False))])
+        centroids = sample[rng.choice(sample_size, size=n_lists, replace=False)].copy()
+        for _ in range(iterations):
+            labels = cls._nearest(sample, centroids)
+            counts = np.bincount(labels, minlength=n_lists)
+            order = np.argsort(labels, kind="stable")
+            sums = np.zeros_like(centroids)
+            non_empty = np.flatnonzero(counts)
+            starts = np.concatenate([[0], np.cumsum(counts)])[:-1]
+            sums[non_empty] = np.add.reduceat(sample[order], starts[non_empty], axis=0)
+            empty = counts == 0
+            # re-seed empty lists with random training points
+            sums[empty] = sample[rng.choice(sample_size, size=int(empty.sum()))]
+            centroids = normalize_rows(sums)
+
+        index = cls(centroids, nprobe=nprobe)
+        index.add(matrix)
+        return index
+
+    @staticmethod
+    def _nearest(vectors, centroids, batch_size=16384):
+        labels = np.empty(vectors.shape[0], dtype=np.int32)
+        for i in range(0, vectors.shape[0], batch_size):
+            batch = np.asarray(vectors[i:i+batch_size], dtype=np.float32)
+            labels[i:i+batch_size] = np.argmax(batch @ centroids.T, axis=1)
+        return labels
+
+    def add(self, vectors):
+        '''
+        Incrementally index new rows (appended after the rows already indexed)
+        '''
+        if len(vectors) == 0:
+            return
+        # the nearest centroid of a vector doesn't depend on its norm, no need to normalize
+        labels = self._nearest(vectors, self.centroids)
+        self.assignments = np.concatenate([self.assignments, labels])
+        self._order = None
+
+    def _lists(self):
+        # CSR layout of the lists, rebuilt lazily after inserts
+        if self._order is None:
+            self._order = np.argsort(self.assignments, kind="stable")
+            counts = np.bincount(self.assignments, minlength=self.n_lists)
+            self._starts = np.concatenate([[0], np.cumsum(counts)])
+        return self._order, self._starts
+
+    def candidates(self, query, nprobe=None):
+        '''
+        Rows of the nprobe lists closest to the normalized query
+        '''
+        nprobe = min(nprobe or self.nprobe, self.n_lists)
+        order, starts = self._lists()
+        probes = top_k_indices(self.centroids @ query, nprobe)
+        rows = np.concatenate([order[starts[p]:starts[p + 1]] for p in probes])
+        return np.sort(rows)
+
+    def search(self, matrix, query_embedding, top_k=10, nprobe=None, exclude=None):
+        '''
+        Approximate top_k rows of the normalized matrix for the query. Returns (rows, scores).
+        exclude: optional boolean mask of rows to leave out (e.g. deleted rows).
+        '''
+        query = normalize_rows(query_embedding)[0]
+        rows = self.candidates(query, nprobe)
+        if exclude is not None:
+            rows = rows[~exclude[rows]]
+        if rows.shape[0] == 0:
+            return rows, np.empty(0, dtype=np.float32)
+        scores = np.asarray(matrix[rows]) @ query
+        best = top_k_indices(scores, top_k)
+        return rows[best], scores[best]
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            np.savez(f, centroids=self.centroids, assignments=self.assignments, nprobe=self.nprobe)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["centroids"], data["assignments"], nprobe=int(data["nprobe"]))
+
+
+def recall_report(matrix, index, queries, top_k=10, nprobes=(1, 2, 4, 8, 16, 32, 64)):
+    '''
+    Recall@top_k and mean latency of the index for several nprobe values, compared with exact
+    search over the same normalized matrix
+    '''
+    queries = normalize_rows(queries)
+    exact = []
+    start = time.perf_counter()
+    for query in queries:
+        exact.append(set(top_k_indices(matrix @ query, top_k).tolist()))
+    exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    report = []
+    for nprobe in nprobes:
+        if nprobe > index.n_lists:
+            break
+        found = 0
+        start = time.perf_counter()
+        for query, expected in zip(queries, exact):
+            rows, _ = index.search(matrix, query, top_k=top_k, nprobe=nprobe)
+            found += len(expected.intersection(rows.tolist()))
+        report.append({
+            "nprobe": nprobe,
+            "recall": found / (len(queries) * top_k),
+            "ms_per_query": (time.perf_counter() - start) * 1000 / len(queries),
+            "exact_ms_per_query": exact_ms
+        })
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall vs latency of the IVF index against exact search")
+    parser.add_argument("--store", help="local vector store directory (synthetic data when omitted)")
+    parser.add_argument("--size", type=int, default=100000, help="number of synthetic vectors")
+    parser.add_argument("--dim", type=int, default=256, help="dimension of synthetic vectors")
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--n-lists", type=int, default=None)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    if args.store:
+        from .vectorStore import LocalVectorStore
+        matrix = LocalVectorStore(args.store).vectors
+    else:
+        # clustered synthetic data so there is some structure to find
+        centers = rng.normal(size=(max(1, args.size // 100), args.dim))
+        matrix = normalize_rows(centers[rng.integers(0, centers.shape[0], args.size)]
+                                + 0.5 * rng.normal(size=(args.size, args.dim)))
+
+    start = time.perf_counter()
+    index = IVFIndex.train(matrix, n_lists=args.n_lists)
+    print(f"Trained {index.n_lists} lists on {matrix.shape[0]} vectors in {time.perf_counter() - start:.1f}s")
+
+    queries = np.asarray(matrix[rng.choice(matrix.shape[0], size=args.queries)]) + 0.1 * rng.normal(size=(args.queries, matrix.shape[1]))
+    for row in recall_report(matrix, index, queries, top_k=args.top_k):
+        print(json.dumps(row))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+'''
+This module contains the AnswerCache class, which stores generated answers (and their sources) so
+repeated questions are answered without calling the LLM.
+
+An answer is reused when:
+ - the normalized query matches a previous query exactly, or
+ - the query embedding is within similarity_threshold of a previous query and the retrieved
+   contexts are the same set as when the answer was generated.
+Every entry records the version of the index it was built from and entries from other versions are
+dropped, so answers are invalidated automatically when documents are added or removed.'''
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import numpy as np
+
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+
+def normalize_query(query):
+    return WHITESPACE_PATTERN.sub(' ', query).strip().lower()
+
+
+def context_key(contexts):
+    '''
+    Order independent fingerprint of a set of retrieved contexts
+    '''
+    items = sorted(json.dumps([context["metadata"].get("filename"), context["text"]]) for context in contexts)
+    return hashlib.sha256("\n".join(items).encode("utf-8")).hexdigest()
+
+
+class AnswerCache():
+    def __init__(self, path, similarity_threshold=0.95, max_entries=5000):
+        self.path = path
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        conn = self._connection()
+        with conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS answers (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                index_version TEXT NOT NULL,
+                query TEXT NOT NULL,
+                embedding BLOB,
+                context_key TEXT,
+                answer TEXT NOT NULL,
+                sources TEXT NOT NULL,
+                last_access REAL NOT NULL)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS answers_query ON answers(index_version, query)")
+            conn.execute("CREATE INDEX IF NOT EXISTS answers_context ON answers(index_version, context_key)")
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _hit(self, conn, row):
+        entry_id, answer, sources = row
+        with conn:
+            conn.execute("UPDATE answers SET last_access = ? WHERE id = ?", (time.time(), entry_id))
+        return {"answer": answer, "sources": json.loads(sources)}
+
+    def invalidate(self, index_version):
+        '''
+        Drop every entry that was not built from index_version
+        '''
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM answers WHERE index_version != ?", (str(index_version),))
+
+    def lookup_exact(self, query, index_version):
+        '''
+        Cached {"answer", "sources"} for the same normalized query, or None
+        '''
+        conn = self._connection()
+        row = conn.execute("""SELECT id, answer, sources FROM answers
+            WHERE index_version = ? AND query = ? ORDER BY id DESC LIMIT 1""",
+            (str(index_version), normalize_query(query))).fetchone()
+        return self._hit(conn, row) if row else None
+
+    def lookup_similar(self, query_embedding, contexts, index_version):
+        '''
+        Cached {"answer", "sources"} for a similar query that retrieved the same contexts, or None
+        '''
+        conn = self._connection()
+        rows = conn.execute("""SELECT id, answer, sources, embedding FROM answers
+            WHERE index_version = ? AND context_key = ? AND embedding IS NOT NULL""",
+            (str(index_version), context_key(contexts))).fetchall()
+        if not rows:
+            return None
+
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        matrix = np.stack([np.frombuffer(row[3], dtype=np.float32) for row in rows])
+        similarities = matrix @ query
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.similarity_threshold:
+            return None
+        return self._hit(conn, rows[best][:3])
+
+    def store(self, query, query_embedding, contexts, index_version, answer, sources):
+        '''
+        Cache an answer, dropping entries from older index versions and the least recently
+        used entries past max_entries
+        '''
+        embedding = None
+        if query_embedding is not None:
+            vector = np.asarray(query_embedding, dtype=np.float32)
+            embedding = (vector / (np.linalg.norm(vector) or 1.0)).tobytes()
+
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM answers WHERE index_version != ?", (str(index_version),))
+            conn.execute("""INSERT INTO answers(index_version, query, embedding, context_key, answer, sources, last_access)
+                VALUES(?, ?, ?, ?, ?, ?, ?)""",
+                (str(index_version), normalize_query(query), embedding, context_key(contexts),
+                 answer, json.dumps(sources), time.time()))
+            excess = conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0] - self.max_entries
+            if excess > 0:
+                conn.execute("""DELETE FROM answers WHERE id IN (
+                    SELECT id FROM answers ORDER BY last_access LIMIT ?)""", (excess,))
@@ -0,0 +1,232 @@
+'''
+This module contains the AsyncQueryPipeline class, the asyncio version of QueryPipeline. The
+OpenAI requests go through the async client, so one event loop serves many chat sessions at the
+same time (a session waiting for its embedding or its answer holds no thread), and the stages that
+don't depend on each other run concurrently:
+ - the answer cache lookup, the query embedding request and the opening of the index (memory
+   maps, keyword / ANN / quantized indexes and the partitions of the search scope) start together
+ - the search and the prompt (local, CPU bound) run in worker threads once the embedding is there
+Every stage has its own timeout (STAGE_TIMEOUTS). A late embedding falls back to keyword search
+like QueryPipeline (unless the store has no keyword search, then it is waited for); the other
+stages raise asyncio.TimeoutError. Cancelling the task of a question
+(e.g. the user left) cancels the requests in flight.
+
+EventLoopThread runs one event loop in a background thread, so synchronous code (the Streamlit
+script of every session) can submit its questions to the shared loop.'''
+import asyncio
+import logging
+import threading
+import time
+
+from .utils.gptService import AsyncAnswerStream
+from .utils.tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+# seconds per stage, None waits as long as the stage takes
+STAGE_TIMEOUTS = {
+    "embed": 5.0,      # query embedding, then the answer is built from the keyword index
+    "index": 30.0,     # opening / refreshing the local index
+    "search": 10.0,
+    "generate": 60.0,  # whole answer, or time until the stream starts
+    "token": 30.0,     # gap between two streamed chunks
+}
+
+
+async def _stage(name, awaitable, timeout):
+    try:
+        return await asyncio.wait_for(awaitable, timeout)
+    except asyncio.TimeoutError:
+        raise asyncio.TimeoutError(f"The {name} stage took more than {timeout}s") from None
+
+
+class AsyncQueryPipeline():
+    def __init__(self, queryPipeline, timeouts=None):
+        '''
+        queryPipeline: the QueryPipeline whose services (embedAndSearch, vectorStore,
+        gptService, answerCache) and settings are used. timeouts: overrides of STAGE_TIMEOUTS.
+        '''
+        self.queryPipeline = queryPipeline
+        self.embedAndSearch = queryPipeline.embedAndSearch
+        self.vectorStore = queryPipeline.vectorStore
+        self.gptService = queryPipeline.gptService
+        self.answerCache = queryPipeline.answerCache
+        self.top_k = queryPipeline.top_k
+        self.timeouts = {**STAGE_TIMEOUTS, **(timeouts or {})}
+        # answers being stored in the cache in worker threads (references keep the tasks alive)
+        self._storing = set()
+
+    def _lookup(self, query, metadata_filter):
+        index_version = self.vectorStore.index_version
+        hit = None
+        if self.answerCache is not None:
+            hit = self.answerCache.lookup_exact(self.queryPipeline._cache_query(query, metadata_filter), index_version)
+        return index_version, hit
+
+    def _open_index(self, metadata_filter):
+        # loads (or refreshes) everything the search reads, the search itself then finds it ready
+        self.vectorStore.warm_up(metadata_filter)
+
+    async def _embed(self, query):
+        if not self.vectorStore.supports_keyword_search:
+            # nothing to fall back to: wait for the embedding (the question's other timeouts still apply)
+            return await self.embedAndSearch.embed_query_async(query)
+        try:
+            return await _stage("embed", self.embedAndSearch.embed_query_async(query), self.timeouts["embed"])
+        except asyncio.TimeoutError:
+            logger.warning("Query embedding took more than %ss, using keyword search", self.timeouts["embed"])
+            tracer.current_span().add(embed_fallback="timeout")
+        except Exception as e:
+            logger.warning("Error embedding query, using keyword search: %s", e)
+            tracer.current_span().add(embed_fallback=type(e).__name__)
+        return None
+
+    async def prepare(self, query, metadata_filter=None):
+        '''
+        QueryPipeline.prepare with the independent stages overlapped
+        '''
+        embedding = asyncio.create_task(self._embed(query))
+        index = asyncio.create_task(_stage("index", asyncio.to_thread(self._open_index, metadata_filter),
+                                           self.timeouts["index"]))
+        try:
+            index_version, hit = await asyncio.to_thread(self._lookup, query, metadata_filter)
+            if hit:
+                return {**hit, "cached": "exact"}
+
+            query_embedding = await embedding
+            await index
+            if query_embedding is None:
+                search = asyncio.to_thread(self.embedAndSearch.keyword_search, query, self.vectorStore,
+                                           top_k=self.top_k, include_embeddings=True, metadata_filter=metadata_filter)
+            else:
+                search = asyncio.to_thread(self.embedAndSearch.search_by_embedding, query_embedding, self.vectorStore,
+                                           top_k=self.top_k, include_embeddings=True, query_text=query,
+                                           metadata_filter=metadata_filter)
+            contexts = await _stage("search", search, self.timeouts["search"])
+            return await asyncio.to_thread(self.queryPipeline._prepare_prompt, query, query_embedding, contexts,
+                                           index_version, metadata_filter)
+        finally:
+            # nothing keeps running after a cache hit, an error or a cancellation
+            for task in (embedding, index):
+                task.cancel()
+                # an index error after a cache hit is not an error of this question
+                task.add_done_callback(lambda task: task.cancelled() or task.exception())
+
+    async def answer(self, query, metadata_filter=None):
+        '''
+        Returns {"answer", "sources", "cached", "packing"} like QueryPipeline.answer
+        '''
+        with tracer.span("query", mode="async") as span:
+            prepared = await self.prepare(query, metadata_filter)
+            span.add(cached=prepared["cached"])
+            if "answer" in prepared:
+                return {**prepared, "packing": None}
+
+            answer = await _stage("generate", self.gptService.generate_answer_async(prepared["prompt"]),
+                                  self.timeouts["generate"])
+            await asyncio.to_thread(self.queryPipeline._store, query, prepared, answer)
+        return {"answer": answer, "sources": prepared["sources"], "cached": None, "packing": prepared["packing"]}
+
+    async def answer_stream(self, query, metadata_filter=None):
+        '''
+        Returns {"stream", "sources", "cached", "packing"} like QueryPipeline.answer_stream,
+        stream is an AsyncAnswerStream (async for token in stream)
+        '''
+        with tracer.span("query", stream=True, mode="async") as span:
+            prepared = await self.prepare(query, metadata_filter)
+            span.add(cached=prepared["cached"])
+            if "answer" in prepared:
+                return {"stream": AsyncAnswerStream.from_text(prepared["answer"]), "sources": prepared["sources"],
+                        "cached": prepared["cached"], "packing": None}
+
+            stream = await _stage("generate", self.gptService.stream_answer_async(
+                prepared["prompt"], token_timeout=self.timeouts["token"]), self.timeouts["generate"])
+        stream.on_complete.append(lambda stream: self._store_later(query, prepared, stream.text))
+        return {"stream": stream, "sources": prepared["sources"], "cached": None, "packing": prepared["packing"]}
+
+    def _store_later(self, query, prepared, answer):
+        # called on the event loop when a stream ends: the cache write (SQLite) runs in a worker
+        # thread so it doesn't hold up the other sessions
+        task = asyncio.ensure_future(asyncio.to_thread(self.queryPipeline._store, query, prepared, answer))
+        self._storing.add(task)
+        task.add_done_callback(self._stored)
+
+    def _stored(self, task):
+        self._storing.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("Error caching the answer: %s", task.exception())
+
+    async def answer_many(self, queries, metadata_filter=None, max_concurrency=None):
+        '''
+        Answer questions concurrently on the event loop (at most max_concurrency at a time if
+        given). Returns the results in question order; a failed question has "error" set.
+        '''
+        semaphore = asyncio.Semaphore(max_concurrency) if max_concurrency else None
+
+        async def run(query):
+            start = time.perf_counter()
+            try:
+                if semaphore is None:
+                    result = await self.answer(query, metadata_filter)
+                else:
+                    async with semaphore:
+                        result = await self.answer(query, metadata_filter)
+                result["error"] = None
+            except Exception as e:
+                logger.warning("Error answering %r: %s", query, e)
+                result = {"answer": None, "sources": [], "cached": None, "packing": None,
+                          "error": f"{type(e).__name__}: {e}"}
+            result["seconds"] = time.perf_counter() - start
+            return result
+
+        return await asyncio.gather(*(run(query) for query in queries))
+
+
+class EventLoopThread():
+    '''
+    An event loop running in a daemon thread. run() and iterate() can be called from any
+    thread; if the calling thread is interrupted (an exception, e.g. Streamlit stopping the
+    script), the coroutine is cancelled.
+    '''
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="event-loop", daemon=True)
+        self._thread.start()
+
+    def run(self, coroutine, timeout=None):
+        '''
+        Run a coroutine on the loop and wait for its result
+        '''
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        try:
+            return future.result(timeout)
+        except BaseException:
+            future.cancel()
+            raise
+
+    def iterate(self, async_iterable):
+        '''
+        Synchronous iterator over an async iterable consumed on the loop (e.g. an AsyncAnswerStream)
+        '''
+        iterator = async_iterable.__aiter__()
+
+        async def next_item():
+            try:
+                return True, await iterator.__anext__()
+            except StopAsyncIteration:
+                return False, None
+
+        try:
+            while True:
+                more, item = self.run(next_item())
+                if not more:
+                    return
+                yield item
+        finally:
+            aclose = getattr(iterator, "aclose", None)
+            if aclose is not None:
+                self.run(aclose())
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
@@ -0,0 +1,78 @@
+'''
+This module answers a whole file of questions (exam prep lists, regression evals) in one batch
+and writes one JSON line per question to the output file as soon as its answer is ready:
+    python -m src.batchQuestions questions.txt --output answers.jsonl --concurrency 8
+
+The questions file is either plain text (one question per line, lines starting with # are
+skipped) or JSONL with a "question" and an optional "id" per line.
+'''
+import argparse
+import json
+import time
+
+from .serviceContainer import get_services
+
+
+def read_questions(path):
+    '''
+    [{"id", "question"}] of a .txt or .jsonl questions file
+    '''
+    questions = []
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if path.endswith(".jsonl"):
+                item = json.loads(line)
+                questions.append({"id": item.get("id", line_number), "question": item["question"]})
+            else:
+                questions.append({"id": line_number, "question": line})
+    return questions
+
+
+def answer_questions(queryPipeline, questions, output_path, max_concurrency=8, metadata_filter=None):
+    '''
+    Answer the questions and append the results to output_path as JSON lines, in the order they
+    finish. Returns a summary of the run.
+    '''
+    started = time.perf_counter()
+    summary = {"questions": len(questions), "answered": 0, "errors": 0, "cached": 0}
+    generate_seconds = 0.0
+    with open(output_path, "w", encoding="utf-8") as out:
+        for result in queryPipeline.answer_many([item["question"] for item in questions],
+                                                max_concurrency=max_concurrency, metadata_filter=metadata_filter):
+            out.write(json.dumps({"id": questions[result["index"]]["id"], **result}) + "\n")
+            out.flush()
+            summary["answered" if result["error"] is None else "errors"] += 1
+            summary["cached"] += result["cached"] is not None
+            generate_seconds += result["timings"]["generate"]
+            summary["embed_seconds"] = result["timings"]["embed"]
+            summary["search_seconds"] = result["timings"]["search"]
+    summary["generate_seconds"] = generate_seconds
+    summary["wall_seconds"] = time.perf_counter() - started
+    return summary
+
+
+def main():
+    services = get_services()
+    parser = argparse.ArgumentParser(description="Answer a file of questions and write the results as JSONL")
+    parser.add_argument("questions", help=".txt (one question per line) or .jsonl ({\"question\", \"id\"}) file")
+    parser.add_argument("--output", default="answers.jsonl")
+    parser.add_argument("--concurrency", type=int, default=services.config["batch_concurrency"],
+                        help="answers generated at the same time")
+    parser.add_argument("--file", action="append", default=[], help="only search this file (repeatable)")
+    parser.add_argument("--course", action="append", default=[], help="only search this course (repeatable)")
+    args = parser.parse_args()
+
+    questions = read_questions(args.questions)
+    services.sync_vector_store()
+    metadata_filter = {key: values for key, values in (("filename", args.file), ("course", args.course)) if values}
+    print(f"Answering {len(questions)} questions ({args.concurrency} at a time)...")
+    summary = answer_questions(services.queryPipeline, questions, args.output, max_concurrency=args.concurrency,
+                               metadata_filter=metadata_filter or None)
+    print(json.dumps(summary))
+
+
+if __name__ == "__main__":
+    main()
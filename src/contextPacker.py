@@ -0,0 +1,89 @@
+'''
+This module contains the ContextPacker class which fits the retrieved contexts into a token budget
+before they are added to the prompt:
+ - near-duplicate contexts (embedding similarity above duplicate_threshold with a context that
+   scored higher) are dropped
+ - the remaining contexts are added from the highest to the lowest score; the lowest scoring ones
+   are trimmed or dropped first when the budget runs out.'''
+import numpy as np
+
+from .utils.tokens import count_tokens
+
+
+def format_context(i, context):
+    return f"\nContext {i+1} (from {context['metadata']['filename']}):\n{context['text']}\n"
+
+
+class ContextPacker():
+    def __init__(self, token_budget=3000, duplicate_threshold=0.95, min_trimmed_tokens=50):
+        '''
+        token_budget: maximum number of tokens used by the contexts in the prompt.
+        min_trimmed_tokens: a context is only trimmed to fit if at least this many tokens of it fit.
+        '''
+        self.token_budget = token_budget
+        self.duplicate_threshold = duplicate_threshold
+        self.min_trimmed_tokens = min_trimmed_tokens
+
+    def drop_duplicates(self, contexts):
+        '''
+        Keep the contexts (sorted by similarity) that are not near-duplicates of a kept one.
+        Contexts without an "embedding" are always kept.
+        '''
+        kept = []
+        kept_vectors = []
+        for context in contexts:
+            vector = context.get("embedding")
+            if vector is not None:
+                vector = np.asarray(vector, dtype=np.float32)
+                vector = vector / (np.linalg.norm(vector) or 1.0)
+                if kept_vectors and float(np.max(np.stack(kept_vectors) @ vector)) >= self.duplicate_threshold:
+                    continue
+                kept_vectors.append(vector)
+            kept.append(context)
+        return kept
+
+    def trim(self, text, max_tokens):
+        '''
+        Cut text down to at most max_tokens tokens (on a word boundary when possible)
+        '''
+        while text and count_tokens(text) > max_tokens:
+            cut = int(len(text) * max_tokens / count_tokens(text) * 0.95)
+            text = text[:cut].rsplit(" ", 1)[0] if " " in text[:cut] else text[:cut]
+        return text
+
+    def pack(self, contexts):
+        '''
+        Returns (packed contexts, report) where report has the tokens used and saved
+        '''
+        # hybrid and keyword results are ranked by their fused/BM25 "score"
+        contexts = sorted(contexts, key=lambda context: context.get("score", context.get("similarity", 0)),
+                          reverse=True)
+        tokens_before = sum(count_tokens(format_context(i, context)) for i, context in enumerate(contexts))
+        unique = self.drop_duplicates(contexts)
+
+        packed = []
+        tokens_used = 0
+        truncated = 0
+        for context in unique:
+            remaining = self.token_budget - tokens_used
+            tokens = count_tokens(format_context(len(packed), context))
+            if tokens > remaining:
+                header_tokens = count_tokens(format_context(len(packed), {**context, "text": ""}))
+                if remaining - header_tokens < self.min_trimmed_tokens:
+                    continue
+                context = {**context, "text": self.trim(context["text"], remaining - header_tokens)}
+                tokens = count_tokens(format_context(len(packed), context))
+                truncated += 1
+            packed.append(context)
+            tokens_used += tokens
+
+        report = {
+            "contexts_in": len(contexts),
+            "contexts_used": len(packed),
+            "duplicates_dropped": len(contexts) - len(unique),
+            "dropped_for_budget": len(unique) - len(packed),
+            "truncated": truncated,
+            "tokens_used": tokens_used,
+            "tokens_saved": tokens_before - tokens_used
+        }
+        return packed, report
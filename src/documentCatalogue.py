@@ -0,0 +1,201 @@
+'''
+This module contains the DocumentCatalogue class, a local manifest of the lecture files stored in
+S3 (key -> ETag, size, last modified) so the app doesn't list the bucket on every page render:
+ - files() reads the manifest; the bucket is only listed again (all pages) once the manifest is
+   older than max_age seconds or on refresh(force=True)
+ - a refresh reports what was added, changed (different ETag or size) or removed since the
+   last listing. S3 can't list only the objects changed since a date, so a refresh still lists
+   every page of the bucket and diffs it with the manifest; what it saves is listing on every
+   render, not the size of one listing
+ - when the listing fails, refresh() raises and files() keeps serving the manifest; the bucket is
+   listed again only after a backoff (5s, doubled on every failure, at most max_age or 300s)
+ - files uploaded through upload() are added to the manifest directly (ETag from head_object),
+   without listing the bucket again. Files whose size and ETag match the catalogue are skipped.'''
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+from .utils.awsService import SUPPORTED_EXTENSIONS
+
+
+def _iter_parts(file, part_size):
+    if hasattr(file, "read"):
+        file.seek(0)
+        yield from iter(lambda: file.read(part_size), b"")
+        file.seek(0)
+    else:
+        with open(file, "rb") as f:
+            yield from iter(lambda: f.read(part_size), b"")
+
+
+def file_etag(file, multipart_chunksize=None):
+    '''
+    S3 ETag of a local path or file object: the MD5 of the content, or for a multipart upload
+    the MD5 of the part MD5s followed by "-<number of parts>"
+    '''
+    if multipart_chunksize is None:
+        md5 = hashlib.md5()
+        for block in _iter_parts(file, 1024 * 1024):
+            md5.update(block)
+        return md5.hexdigest()
+    part_digests = [hashlib.md5(part).digest() for part in _iter_parts(file, multipart_chunksize)]
+    return f"{hashlib.md5(b''.join(part_digests)).hexdigest()}-{len(part_digests)}"
+
+
+def file_size(file):
+    if hasattr(file, "read"):
+        size = getattr(file, "size", None)
+        if size is None:
+            position = file.tell()
+            size = file.seek(0, os.SEEK_END)
+            file.seek(position)
+        return size
+    return os.path.getsize(file)
+
+
+class DocumentCatalogue():
+    def __init__(self, s3processor, path, prefix='', max_age=300):
+        '''
+        path: JSON manifest file. max_age: seconds before files() lists the bucket again
+        (None never lists it again automatically).
+        '''
+        self.s3processor = s3processor
+        self.path = path
+        self.prefix = prefix
+        self.max_age = max_age
+        self._lock = threading.RLock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.entries = {}
+        self.refreshed_at = None
+        # listing failures since the last successful refresh, and when the last one happened
+        self.failures = 0
+        self.failed_at = None
+        try:
+            with open(path) as f:
+                manifest = json.load(f)
+            if manifest.get("bucket") == s3processor.bucket_name and manifest.get("prefix") == prefix:
+                self.entries = manifest["files"]
+                self.refreshed_at = manifest.get("refreshed_at")
+        except FileNotFoundError:
+            pass
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"bucket": self.s3processor.bucket_name, "prefix": self.prefix,
+                       "refreshed_at": self.refreshed_at, "files": self.entries}, f)
+        os.replace(tmp_path, self.path)
+
+    def retry_after(self):
+        '''
+        Seconds to wait after the last failed listing before listing again
+        '''
+        return min(5 * 2 ** max(self.failures - 1, 0), self.max_age or 300)
+
+    def is_stale(self):
+        if self.failed_at is not None and time.time() - self.failed_at < self.retry_after():
+            return False
+        if self.refreshed_at is None:
+            return True
+        return self.max_age is not None and time.time() - self.refreshed_at > self.max_age
+
+    def refresh(self, force=False):
+        '''
+        List the bucket again if the manifest is stale (or force). Returns
+        {"added", "changed", "removed"} lists of keys, or None if the manifest was fresh. Raises
+        the S3 error if the listing fails (the manifest is kept).
+        '''
+        with self._lock:
+            if not force and not self.is_stale():
+                return None
+            try:
+                listed = {}
+                for item in self.s3processor.iter_objects(self.prefix):
+                    last_modified = item.get("LastModified")
+                    listed[item["Key"]] = {
+                        "etag": item["ETag"].strip('"'),
+                        "size": item["Size"],
+                        "last_modified": last_modified.isoformat() if hasattr(last_modified, "isoformat") else last_modified
+                    }
+            except Exception:
+                self.failures += 1
+                self.failed_at = time.time()
+                raise
+
+            changes = {
+                "added": sorted(key for key in listed if key not in self.entries),
+                "changed": sorted(key for key, entry in listed.items() if key in self.entries and
+                                  (entry["etag"], entry["size"]) != (self.entries[key]["etag"], self.entries[key]["size"])),
+                "removed": sorted(key for key in self.entries if key not in listed)
+            }
+            self.entries = listed
+            self.refreshed_at = time.time()
+            self.failures = 0
+            self.failed_at = None
+            self._save()
+            return changes
+
+    def files(self):
+        '''
+        Keys of the catalogued files, listing the bucket first only if the manifest is stale
+        (if that fails, the files of the manifest are returned)
+        '''
+        try:
+            self.refresh()
+        except Exception as e:
+            print(f"Error listing files in S3, retrying in {self.retry_after()}s: {e}")
+        with self._lock:
+            return sorted(self.entries)
+
+    def get(self, key):
+        with self._lock:
+            return self.entries.get(key)
+
+    def _key(self, file):
+        name = os.path.basename(getattr(file, "name", file))
+        return f"{self.prefix.rstrip('/')}/{name}" if self.prefix else name
+
+    def is_uploaded(self, file):
+        '''
+        True if the catalogue holds a file with the same size and content (same ETag)
+        '''
+        entry = self.get(self._key(file))
+        if entry is None or entry["size"] != file_size(file):
+            return False
+        multipart_chunksize = self.s3processor.multipart_chunksize if "-" in entry["etag"] else None
+        return entry["etag"] == file_etag(file, multipart_chunksize)
+
+    def upload(self, files, skip_unchanged=True, max_workers=None):
+        '''
+        Upload files (local paths or file objects) concurrently and add them to the catalogue.
+        Returns one report per file {"key", "size", "ok", "error", "seconds", "skipped"}.
+        '''
+        files = [file for file in files if getattr(file, "name", file).endswith(SUPPORTED_EXTENSIONS)]
+        reports = []
+        to_upload = []
+        for file in files:
+            if skip_unchanged and self.is_uploaded(file):
+                reports.append({"key": self._key(file), "size": file_size(file), "ok": True, "error": None,
+                                "seconds": 0.0, "skipped": True})
+            else:
+                to_upload.append(file)
+
+        uploaded = self.s3processor.upload_files(to_upload, self.prefix, max_workers=max_workers)
+        with self._lock:
+            for report in uploaded:
+                report["skipped"] = False
+                if not report["ok"]:
+                    continue
+                try:
+                    head = self.s3processor.head(report["key"])
+                except Exception as e:
+                    print(f"Error reading {report['key']} from S3: {e}")
+                    continue
+                self.entries[report["key"]] = {**head, "last_modified": datetime.now(timezone.utc).isoformat()}
+            self._save()
+        return reports + uploaded
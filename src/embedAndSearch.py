@@ -2,55 +2,315 @@
 This file contains the EmbedAndSearch class which is responsible 
 for generating embeddings for the chunks of text and then searching 
 for the most similar chunks to a given query based on cosine similarity'''
+import asyncio
+import logging
 import os
-from openai import OpenAI
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import numpy as np
 
+from .vectorSearch import VectorSearchEngine
+from .vectorStore import VectorStore
+from .metadataIndex import normalize_filter, matches_filter
+from .utils.tokens import count_tokens
+from .utils.tracing import tracer
+
+logger = logging.getLogger(__name__)
 
 load_dotenv()
+def _retryable_errors():
+    # Errors worth retrying with backoff (rate limits and transient network/server errors).
+    # openai is imported here rather than at module level, it is slow to import
+    from openai import RateLimitError, APITimeoutError, APIConnectionError, InternalServerError
+    return (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+
+
 class EmbedAndSearch():
-    def __init__(self):
-        self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-        pass
+    RETRYABLE_ERRORS = None
+
+    def __init__(self, client=None, model="text-embedding-ada-002", batch_size=256,
+                 max_batch_tokens=50000, max_workers=4, max_retries=6, backoff=1.0, cache=None, async_client=None):
+        '''
+        client: any object exposing embeddings.create like the OpenAI client (a fake client
+        can be passed for testing). Chunks are sent in batches of at most batch_size chunks
+        and max_batch_tokens tokens, with up to max_workers batches in flight.
+        cache: optional EmbeddingCache checked before calling the API.
+        async_client: client for the *_async methods (an AsyncOpenAI is created on first use if None)
+        '''
+        if client is None:
+            from openai import OpenAI
+            client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        self.client = client
+        if EmbedAndSearch.RETRYABLE_ERRORS is None:
+            EmbedAndSearch.RETRYABLE_ERRORS = _retryable_errors()
+        self.model = model
+        self.batch_size = batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.cache = cache
+        self._async_client = async_client
+
+    @property
+    def async_client(self):
+        if self._async_client is None:
+            from openai import AsyncOpenAI
+            self._async_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        return self._async_client
+
+
+    def make_batches(self, texts):
+        '''
+        Split texts into consecutive batches limited by chunk count and token budget.
+        Returns lists of indices into texts.
+        '''
+        batches = []
+        batch = []
+        batch_tokens = 0
+        for i, text in enumerate(texts):
+            tokens = count_tokens(text)
+            if batch and (len(batch) >= self.batch_size or batch_tokens + tokens > self.max_batch_tokens):
+                batches.append(batch)
+                batch = []
+                batch_tokens = 0
+            batch.append(i)
+            batch_tokens += tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def embed_batch(self, texts):
+        '''
+        Embed a list of texts in one request, retrying with exponential backoff and jitter
+        on rate limits and transient errors
+        '''
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.client.embeddings.create(input=texts, model=self.model)
+                usage = getattr(response, "usage", None)
+                if usage is not None:
+                    tracer.current_span().add(tokens=usage.total_tokens)
+                data = sorted(response.data, key=lambda item: item.index)
+                return [item.embedding for item in data]
+            except self.RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self.backoff * (2 ** attempt) * (0.5 + random.random() / 2)
+                logger.warning("Embedding request failed (%s), retrying in %.1fs", type(e).__name__, delay)
+                tracer.current_span().add(retried=type(e).__name__)
+                time.sleep(delay)
+
+    def embed_texts(self, texts):
+        '''
+        Embed texts, preserving the input order. Cached embeddings are reused and only the
+        misses are sent to the API.
+        '''
+        texts = list(texts)
+        with tracer.span("embed", model=self.model) as span:
+            if tracer.enabled:
+                span.add(items=len(texts), bytes=sum(len(text.encode("utf-8")) for text in texts))
+            if self.cache is None:
+                return self._embed_uncached(texts)
+
+            vectors = self.cache.get_many(texts, self.model)
+            missing = [i for i, vector in enumerate(vectors) if vector is None]
+            span.add(cache_hits=len(texts) - len(missing))
+            if missing:
+                start = time.perf_counter()
+                missing_vectors = self._embed_uncached([texts[i] for i in missing])
+                self.cache.put_many([texts[i] for i in missing], missing_vectors, self.model,
+                                    embedding_seconds=time.perf_counter() - start)
+                for i, vector in zip(missing, missing_vectors):
+                    vectors[i] = vector
+            return vectors
+
+    async def embed_batch_async(self, texts):
+        '''
+        embed_batch with the async client (the backoff sleeps don't block the event loop)
+        '''
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = await self.async_client.embeddings.create(input=texts, model=self.model)
+                usage = getattr(response, "usage", None)
+                if usage is not None:
+                    tracer.current_span().add(tokens=usage.total_tokens)
+                data = sorted(response.data, key=lambda item: item.index)
+                return [item.embedding for item in data]
+            except self.RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self.backoff * (2 ** attempt) * (0.5 + random.random() / 2)
+                logger.warning("Embedding request failed (%s), retrying in %.1fs", type(e).__name__, delay)
+                tracer.current_span().add(retried=type(e).__name__)
+                await asyncio.sleep(delay)
+
+    async def embed_texts_async(self, texts):
+        '''
+        embed_texts with the async client: the batches are requested concurrently on the event
+        loop, the cache (SQLite) is read and written in a worker thread
+        '''
+        texts = list(texts)
+        with tracer.span("embed", model=self.model) as span:
+            if tracer.enabled:
+                span.add(items=len(texts), bytes=sum(len(text.encode("utf-8")) for text in texts))
+            if self.cache is None:
+                vectors = [None] * len(texts)
+            else:
+                vectors = await asyncio.to_thread(self.cache.get_many, texts, self.model)
+            missing = [i for i, vector in enumerate(vectors) if vector is None]
+            span.add(cache_hits=len(texts) - len(missing))
+            if not missing:
+                return vectors
 
+            start = time.perf_counter()
+            batches = self.make_batches([texts[i] for i in missing])
+            results = await asyncio.gather(*(self.embed_batch_async([texts[missing[i]] for i in batch])
+                                             for batch in batches))
+            for batch, batch_vectors in zip(batches, results):
+                for i, vector in zip(batch, batch_vectors):
+                    vectors[missing[i]] = vector
+            if self.cache is not None:
+                await asyncio.to_thread(self.cache.put_many, [texts[i] for i in missing],
+                                        [vectors[i] for i in missing], self.model,
+                                        embedding_seconds=time.perf_counter() - start)
+            return vectors
+
+    async def embed_query_async(self, query):
+        return (await self.embed_texts_async([query]))[0]
+
+    def _embed_uncached(self, texts):
+        '''
+        Embed texts in batches with several requests in flight, preserving the input order
+        '''
+        vectors = [None] * len(texts)
+        batches = self.make_batches(texts)
+
+        # the requests add their token usage to the current embed span
+        @tracer.wrap
+        def run(batch):
+            return batch, self.embed_batch([texts[i] for i in batch])
+
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(batches)))) as executor:
+            for batch, batch_vectors in executor.map(run, batches):
+                for i, vector in zip(batch, batch_vectors):
+                    vectors[i] = vector
+        return vectors
 
     def generate_embeddings(self, chunks):
-        embeddings = []
-        for chunk in chunks:
-            response = self.client.embeddings.create(input=chunk["text"], 
-            model="text-embedding-ada-002")
+        chunks = list(chunks)
+        vectors = self.embed_texts([chunk["text"] for chunk in chunks])
 
-            embedding_vector = response.data[0].embedding
-            embeddings.append({
+        embeddings = []
+        for chunk, embedding_vector in zip(chunks, vectors):
+            embedding = {
                 "text": chunk["text"],
                 "embedding": embedding_vector,
                 "metadata": chunk["metadata"]
-            })
-        print('Embeddings Generated Successfully!\n')
+            }
+            if "id" in chunk:
+                embedding["id"] = chunk["id"]
+            embeddings.append(embedding)
         return embeddings
 
     def cosine_similarity(self, vec1, vec2):
         return np.dot(vec1, vec2) / (np.linalg.norm(vec1) * np.linalg.norm(vec2))
 
 
+    def embed_query(self, query):
+        return self.embed_texts([query])[0]
+
     def semantic_search(self, query, embeddings, top_k=10):
-        response = self.client.embeddings.create(input=query, 
-        model="text-embedding-ada-002")
-        
-        query_embedding = response.data[0].embedding
-
-        results = []
-        for embedding in embeddings:
-            similarity = self.cosine_similarity(query_embedding, embedding["values"])
-            results.append({
-                "text": embedding["metadata"]["text"],
-                "similarity": similarity,
-                "metadata": embedding["metadata"]
-            })
-
-        results = sorted(results, key=lambda x: x["similarity"], reverse=True)
-        return results[:top_k]
+        '''
+        Return the top_k stored embeddings most similar to the query. `embeddings` can be a
+        list of stored embeddings, an already built VectorSearchEngine (reuse it across
+        queries to avoid rebuilding the matrix) or a VectorStore backend (LocalVectorStore,
+        PineconeVectorStore). With a keyword index (LocalVectorStore) the vector and keyword
+        rankings are fused.
+        '''
+        return self.search_by_embedding(self.embed_query(query), embeddings, top_k=top_k, query_text=query)
+
+    def _engine(self, embeddings):
+        if isinstance(embeddings, VectorSearchEngine):
+            return embeddings
+        return VectorSearchEngine.from_embeddings(embeddings)
+
+    def _scope(self, engine, metadata_filter):
+        '''
+        Rows of the engine matching the metadata filter (None searches everything), filtered
+        record by record: O(size of the engine), like building it from a list of embeddings.
+        VectorStore backends resolve a filter with their metadata index in O(rows in scope).
+        '''
+        if not metadata_filter:
+            return None
+        metadata_filter = normalize_filter(metadata_filter)
+        return np.asarray([row for row in range(len(engine))
+                           if matches_filter(engine.records[row]["metadata"], metadata_filter)], dtype=np.int64)
+
+    def search_by_embedding(self, query_embedding, embeddings, top_k=10, include_embeddings=False, query_text=None,
+                            metadata_filter=None):
+        '''
+        Vector search; hybrid (vector + keyword) search when the query text is given and the
+        engine has a keyword index. metadata_filter restricts the search to some files, courses
+        or slides (see metadataIndex.py).
+        '''
+        with tracer.span("search", top_k=top_k) as span:
+            if isinstance(embeddings, VectorStore):
+                results = embeddings.query(query_embedding, top_k=top_k, metadata_filter=metadata_filter,
+                                           query_text=query_text, include_embeddings=include_embeddings)
+                span.add(items=len(results), backend=embeddings.backend)
+                return results
+            engine = self._engine(embeddings)
+            rows = self._scope(engine, metadata_filter)
+            hybrid = query_text is not None and engine.lexical_index is not None
+            if hybrid:
+                results = engine.search_hybrid(query_embedding, query_text, top_k=top_k,
+                                               include_embeddings=include_embeddings, rows=rows)
+            else:
+                results = engine.search(query_embedding, top_k=top_k, include_embeddings=include_embeddings, rows=rows)
+            span.add(items=len(results), ann=engine.ann_index is not None and rows is None,
+                     quantized=engine.quantized_index.mode if engine.quantized_index is not None else None,
+                     mode="hybrid" if hybrid else "vector", scope=len(engine) if rows is None else len(rows))
+            return results
+
+    def search_many(self, query_embeddings, embeddings, top_k=10, include_embeddings=False, queries=None,
+                    metadata_filter=None):
+        '''
+        search_by_embedding for a batch of queries, scored together with matrix-matrix products
+        (hybrid with the query texts). Returns one list of results per query.
+        '''
+        with tracer.span("search", top_k=top_k, batch=len(query_embeddings)) as span:
+            if isinstance(embeddings, VectorStore):
+                results = embeddings.query_many(query_embeddings, top_k=top_k, metadata_filter=metadata_filter,
+                                                queries=queries, include_embeddings=include_embeddings)
+                span.add(items=sum(len(result) for result in results), backend=embeddings.backend)
+                return results
+            engine = self._engine(embeddings)
+            rows = self._scope(engine, metadata_filter)
+            results = engine.search_many(query_embeddings, top_k=top_k, include_embeddings=include_embeddings,
+                                         queries=queries, rows=rows)
+            span.add(items=sum(len(result) for result in results),
+                     mode="hybrid" if queries is not None and engine.lexical_index is not None else "vector",
+                     scope=len(engine) if rows is None else len(rows))
+            return results
+
+    def keyword_search(self, query, embeddings, top_k=10, include_embeddings=False, metadata_filter=None):
+        '''
+        Keyword (BM25) search only, no embedding request. Returns [] if there is no keyword index.
+        '''
+        with tracer.span("search", top_k=top_k, mode="lexical") as span:
+            if isinstance(embeddings, VectorStore):
+                results = embeddings.query(None, top_k=top_k, metadata_filter=metadata_filter, query_text=query,
+                                           include_embeddings=include_embeddings)
+                span.add(items=len(results), backend=embeddings.backend)
+                return results
+            engine = self._engine(embeddings)
+            rows = self._scope(engine, metadata_filter)
+            results = engine.search_lexical(query, top_k=top_k, include_embeddings=include_embeddings, rows=rows)
+            span.add(items=len(results), scope=len(engine) if rows is None else len(rows))
+            return results
 
 def main():
     embedAndSearch = EmbedAndSearch()
@@ -0,0 +1,128 @@
+'''
+This module contains the EmbeddingCache class, a persistent content-addressed cache of embeddings
+so unchanged chunks (and repeated queries) are never sent to OpenAI twice.
+
+Entries are keyed by a hash of the model name and the whitespace-normalized text and are stored in
+SQLite, which handles concurrent access from several Streamlit sessions/processes. The cache is
+bounded to max_entries and evicts the least recently used entries first. Hit/miss counters are
+persisted with the entries so they cover every session using the cache.'''
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import numpy as np
+
+from .utils.tokens import count_tokens
+
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+
+def normalize_text(text):
+    return WHITESPACE_PATTERN.sub(' ', text).strip()
+
+
+class EmbeddingCache():
+    def __init__(self, path, max_entries=200000):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        conn = self._connection()
+        with conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                vector BLOB NOT NULL,
+                last_access REAL NOT NULL)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_access ON embeddings(last_access)")
+            conn.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value REAL NOT NULL)")
+
+    def _connection(self):
+        # sqlite connections can't be shared between threads, keep one per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def make_key(text, model):
+        return hashlib.sha256(f"{model}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+    def _add_stats(self, conn, **increments):
+        conn.executemany(
+            "INSERT INTO stats(name, value) VALUES(?, ?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            list(increments.items()))
+
+    def get_many(self, texts, model):
+        '''
+        Look up the embeddings of texts. Returns a list aligned with texts holding the
+        vector for hits and None for misses.
+        '''
+        keys = [self.make_key(text, model) for text in texts]
+        found = {}
+        conn = self._connection()
+        unique_keys = list(set(keys))
+        # stay below SQLite's limit on query parameters
+        for i in range(0, len(unique_keys), 500):
+            batch = unique_keys[i:i+500]
+            rows = conn.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch)
+            for key, blob in rows:
+                found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+
+        results = [found.get(key) for key in keys]
+        hits = [text for text, vector in zip(texts, results) if vector is not None]
+        with conn:
+            if found:
+                now = time.time()
+                conn.executemany("UPDATE embeddings SET last_access = ? WHERE key = ?",
+                                 [(now, key) for key in found])
+            self._add_stats(conn, hits=len(hits), misses=len(texts) - len(hits),
+                            saved_tokens=sum(count_tokens(text) for text in hits))
+        return results
+
+    def put_many(self, texts, vectors, model, embedding_seconds=None):
+        '''
+        Store embeddings and evict the least recently used entries past max_entries.
+        embedding_seconds is the time it took to compute them, used to estimate time saved.
+        '''
+        if not texts:
+            return
+        now = time.time()
+        rows = [(self.make_key(text, model), np.asarray(vector, dtype=np.float32).tobytes(), now)
+                for text, vector in zip(texts, vectors)]
+        conn = self._connection()
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO embeddings(key, vector, last_access) VALUES(?, ?, ?)", rows)
+            if embedding_seconds is not None:
+                self._add_stats(conn, embedded=len(texts), embedding_seconds=embedding_seconds)
+            excess = conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0] - self.max_entries
+            if excess > 0:
+                conn.execute("""DELETE FROM embeddings WHERE key IN (
+                    SELECT key FROM embeddings ORDER BY last_access LIMIT ?)""", (excess,))
+
+    def stats(self):
+        '''
+        Hit/miss counters plus the estimated tokens and seconds saved by the cache
+        '''
+        conn = self._connection()
+        values = dict(conn.execute("SELECT name, value FROM stats").fetchall())
+        hits = int(values.get("hits", 0))
+        misses = int(values.get("misses", 0))
+        embedded = values.get("embedded", 0)
+        seconds_per_text = values.get("embedding_seconds", 0) / embedded if embedded else 0.0
+        return {
+            "entries": conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0],
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+            "saved_tokens": int(values.get("saved_tokens", 0)),
+            "saved_seconds": hits * seconds_per_text
+        }
@@ -0,0 +1,92 @@
+'''
+This module contains the IndexManifest class, a local record of which vectors are indexed for every
+file, and make_vector_id which derives a deterministic vector id from a chunk.
+
+Since the ids only depend on the file, the location in the file and the text, re-ingesting a file
+only needs to upsert the chunks whose id is not in the manifest yet and delete the ids that are no
+longer produced, instead of re-uploading the whole file.
+
+Files are identified by their name, like in the chunk metadata and the S3 key: a file with the
+same name is a new version of the same document (IngestPipeline rejects two files with the same
+name in one run).'''
+import hashlib
+import json
+import os
+import threading
+
+
+def make_vector_id(chunk):
+    '''
+    Deterministic id of a chunk: hash of the filename, the location (slide/page) and a hash of
+    the text. The location is kept readable to make the ids easier to debug.
+    '''
+    metadata = chunk["metadata"]
+    file_hash = hashlib.sha1(metadata["filename"].encode("utf-8")).hexdigest()[:12]
+    if "slide_number" in metadata:
+        location = f"s{metadata['slide_number']}"
+    elif "page_number" in metadata:
+        location = f"p{metadata['page_number']}"
+    else:
+        location = "x"
+    if "chunk_index" in metadata:
+        location += f"c{metadata['chunk_index']}"
+    text_hash = hashlib.sha1(chunk["text"].encode("utf-8")).hexdigest()[:16]
+    return f"{file_hash}-{location}-{text_hash}"
+
+
+class IndexManifest():
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        try:
+            with open(path) as f:
+                self.files = {filename: set(ids) for filename, ids in json.load(f).items()}
+        except FileNotFoundError:
+            self.files = {}
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({filename: sorted(ids) for filename, ids in self.files.items()}, f)
+        os.replace(tmp_path, self.path)
+
+    def ids(self, filename):
+        with self._lock:
+            return set(self.files.get(filename, ()))
+
+    def assign_ids(self, chunks):
+        for chunk in chunks:
+            chunk["id"] = make_vector_id(chunk)
+        return chunks
+
+    def new_chunks(self, filename, chunks):
+        '''
+        Assign ids to the chunks and return the ones that are not indexed yet
+        '''
+        indexed = self.ids(filename)
+        return [chunk for chunk in self.assign_ids(chunks) if chunk["id"] not in indexed]
+
+    def plan(self, filename, chunks):
+        '''
+        For a re-ingested file: (chunks to upsert, ids to delete)
+        '''
+        new_chunks = self.new_chunks(filename, chunks)
+        removed_ids = self.ids(filename) - {chunk["id"] for chunk in chunks}
+        return new_chunks, removed_ids
+
+    def update(self, filename, ids):
+        '''
+        Record the complete set of ids now indexed for the file
+        '''
+        with self._lock:
+            self.files[filename] = set(ids)
+            self._save()
+
+    def remove(self, filename):
+        with self._lock:
+            ids = self.files.pop(filename, set())
+            self._save()
+        return ids
@@ -1,17 +1,51 @@
 '''
-This script is responsible for ingesting and parsing documents. It currently supports pptx files.'''
-from pptx import Presentation
-import fitz #PyMuPDF
+This script is responsible for ingesting and parsing documents. It currently supports pptx and pdf files.
+python-pptx and PyMuPDF are only imported when a file of that type is parsed.'''
+import logging
 import os 
+import threading
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+from .utils.tracing import tracer, InMemoryCollector
+
+logger = logging.getLogger(__name__)
+
+SUPPORTED_EXTENSIONS = (".pptx", ".pdf")
+# Large PDFs are split in ranges of this many pages that are parsed in parallel
+PAGES_PER_TASK = 25
 
 
 class IngesterAndParser():
-    def __init__(self):
-        pass
+    def __init__(self, executor_factory=None, max_workers=None):
+        '''
+        executor_factory: called with max_workers to create the process pool shared by every
+        iter_documents call (e.g. a spawn-context pool for the background ingestion workers);
+        without one each call creates its own pool.
+        max_workers: number of parsing processes (default: one per CPU)
+        '''
+        self.executor_factory = executor_factory
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.executor = None
+        self._lock = threading.Lock()
+
+    def shared_executor(self, broken=None):
+        '''
+        The shared pool, created on first use. A worker that dies (e.g. on a pdf that crashes
+        PyMuPDF) breaks its whole pool: pass the broken pool to get a new one.
+        '''
+        with self._lock:
+            if broken is not None and self.executor is broken:
+                logger.warning("A parsing process died, starting a new process pool")
+                broken.shutdown(wait=False, cancel_futures=True)
+                self.executor = None
+            if self.executor is None:
+                self.executor = self.executor_factory(self.max_workers)
+            return self.executor
 
     def extract_text_from_pptx(self, file_path):
-        print("Extracting text from pptx file...\n")
         try:
+            from pptx import Presentation
             prs = Presentation(file_path)
             text = []
             for slide in prs.slides:
@@ -24,29 +58,182 @@ class IngesterAndParser():
             print(f"Error reading PPTX file: {e}")
             return None
 
-        print("Extraction complete.\n")
-        
-        res = {"filename": file_path.name, "content": text, "type": "pptx"}
+        # uploaded files have a name attribute, local files are paths
+        res = {"filename": os.path.basename(getattr(file_path, "name", file_path)), "content": text, "type": "pptx"}
         return res
-    
+
+    def open_pdf(self, file_path):
+        import fitz  # PyMuPDF
+        # uploaded files are file objects, local files are paths
+        if hasattr(file_path, "read"):
+            file_path.seek(0)
+            return fitz.open(stream=file_path.read(), filetype="pdf")
+        return fitz.open(file_path)
+
+    def iter_pdf_pages(self, file_path, start_page=0, end_page=None):
+        '''
+        Yield (page_number, text) one page at a time, page_number starting at 1.
+        Only the current page is loaded, the rest of the document stays on disk.
+        '''
+        with self.open_pdf(file_path) as pdf:
+            end_page = pdf.page_count if end_page is None else min(end_page, pdf.page_count)
+            for i in range(start_page, end_page):
+                page = pdf.load_page(i)
+                yield i + 1, page.get_text()
+
+    def extract_text_from_pdf(self, file_path, start_page=0, end_page=None):
+        '''
+        Extract the text of pages [start_page, end_page) of a pdf, one entry per page
+        '''
+        try:
+            text = [page_text for _, page_text in self.iter_pdf_pages(file_path, start_page, end_page)]
+        except Exception as e:
+            print(f"Error reading PDF file: {e}")
+            return None
+
+        return {"filename": os.path.basename(getattr(file_path, "name", file_path)), "content": text,
+                "type": "pdf", "page_offset": start_page}
+
+    def pdf_page_ranges(self, file_path, pages_per_task=PAGES_PER_TASK):
+        with self.open_pdf(file_path) as pdf:
+            page_count = pdf.page_count
+        return [(start, min(start + pages_per_task, page_count)) for start in range(0, page_count, pages_per_task)]
+
+    def parse_file(self, file_path, start_page=0, end_page=None):
+        '''
+        Parse one file (path or uploaded file) based on its extension. Returns None for
+        unsupported files. start_page/end_page select a page range of pdf files.
+        '''
+        name = getattr(file_path, "name", file_path)
+        with tracer.span("parse", file=os.path.basename(name), start_page=start_page) as span:
+            if name.endswith(".pdf"):
+                document = self.extract_text_from_pdf(file_path, start_page, end_page)
+            elif name.endswith(".pptx"):
+                document = self.extract_text_from_pptx(file_path)
+            else:
+                print(f"Unsupported file format: {name}")
+                return None
+            if tracer.enabled and document is not None:
+                span.add(items=len(document["content"]), bytes=sum(len(text.encode("utf-8")) for text in document["content"]))
+            return document
+
+    def parse_tasks(self, file_path, pages_per_task=PAGES_PER_TASK):
+        '''
+        Split a file into parse tasks (file_path, start_page, end_page): one task per pptx,
+        one task per page range for pdfs
+        '''
+        if file_path.endswith(".pdf"):
+            try:
+                ranges = self.pdf_page_ranges(file_path, pages_per_task)
+            except Exception:
+                ranges = []
+            if ranges:
+                return [(file_path, start, end) for start, end in ranges]
+        return [(file_path, 0, None)]
+
+    def list_documents(self, dir):
+        return [os.path.join(dir, filename) for filename in sorted(os.listdir(dir))
+                if filename.endswith(SUPPORTED_EXTENSIONS)]
 
     def process_documents(self, dir):
         documents = []
         
         for filename in os.listdir(dir):
             filename = os.path.join(dir, filename)
-            print(f'Processing file: {filename}...\n')
-            if filename.endswith(".pdf"):
-                #TODO: Implement logic for pdf files
-                pass
-            elif filename.endswith(".pptx"):
-                content = self.extract_text_from_pptx(filename)
+            logger.info("Processing file: %s", filename)
+            content = self.parse_file(filename)
+            if content is not None:
                 documents.append(content)
-            else:
-                print(f"Unsupported file format: {filename}")
         
         return documents
 
+    def iter_documents(self, file_paths, max_workers=None, max_pending=None, pages_per_task=PAGES_PER_TASK):
+        '''
+        Parse files in a process pool and yield (file_path, document, error, parts_left) as soon
+        as each part is done. A file is one part, except pdfs which are split in page ranges
+        parsed in parallel; parts_left is the number of parts of that file still to come.
+        At most max_pending parts are parsed or waiting at a time, so memory doesn't grow
+        with the number of files. If a parsing process dies, the parts being parsed fail and the
+        others are parsed by a new pool.
+        '''
+        max_workers = max_workers or self.max_workers
+        max_pending = max_pending or 2 * max_workers
+        parts_left = {}
+
+        def iter_tasks():
+            for file_path in file_paths:
+                file_tasks = self.parse_tasks(file_path, pages_per_task)
+                parts_left[file_path] = len(file_tasks)
+                yield from file_tasks
+
+        tasks = iter_tasks()
+        if self.executor_factory is not None:
+            yield from self._iter_parsed(self.shared_executor(), self.shared_executor, tasks, parts_left, max_pending)
+            return
+        pools = [ProcessPoolExecutor(max_workers=max_workers)]
+
+        def replace(broken):
+            broken.shutdown(wait=False, cancel_futures=True)
+            pools.append(ProcessPoolExecutor(max_workers=max_workers))
+            return pools[-1]
+
+        try:
+            yield from self._iter_parsed(pools[0], replace, tasks, parts_left, max_pending)
+        finally:
+            pools[-1].shutdown()
+
+    def _iter_parsed(self, executor, replace, tasks, parts_left, max_pending):
+        # replace(broken pool) returns the pool to use instead of one a dead worker broke.
+        # Spans recorded in the workers are sent back with each result and exported here
+        tracing = tracer.enabled
+        pending = {}
+        try:
+            while True:
+                for task in tasks:
+                    try:
+                        future = executor.submit(_parse_file, tracing, *task)
+                    except BrokenProcessPool:
+                        executor = replace(executor)
+                        future = executor.submit(_parse_file, tracing, *task)
+                    pending[future] = task, executor
+                    if len(pending) >= max_pending:
+                        break
+                if not pending:
+                    return
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task, pool = pending.pop(future)
+                    file_path = task[0]
+                    parts_left[file_path] -= 1
+                    remaining = parts_left[file_path]
+                    if remaining == 0:
+                        del parts_left[file_path]
+                    try:
+                        document, spans = future.result()
+                    except BrokenProcessPool as e:
+                        if pool is executor:
+                            executor = replace(executor)
+                        yield file_path, None, e, remaining
+                        continue
+                    except Exception as e:
+                        yield file_path, None, e, remaining
+                        continue
+                    tracer.replay(spans)
+                    yield file_path, document, None, remaining
+        finally:
+            # a shared pool outlives this call, don't leave it parsing files nobody reads
+            for future in pending:
+                future.cancel()
+
+
+def _parse_file(tracing, file_path, start_page=0, end_page=None):
+    # module level so it can be sent to worker processes; a worker of a shared pool parses
+    # for several calls, so the tracing flag comes with every task
+    if tracing != tracer.enabled:
+        tracer.set_exporter(InMemoryCollector() if tracing else None)
+    document = IngesterAndParser().parse_file(file_path, start_page, end_page)
+    return document, tracer.exporter.drain() if tracer.enabled else []
+
 def main():
     DATA_DIR = "../data"
     ingesterAndParser = IngesterAndParser()
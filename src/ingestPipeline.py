@@ -0,0 +1,180 @@
+'''
+This module contains the IngestPipeline class, a streaming version of the ingest steps
+(parse -> chunk -> embed -> upload) where every stage hands work to the next one as soon as it
+is ready:
+ - files are parsed in a process pool (IngesterAndParser.iter_documents), large pdfs are split
+   in page ranges parsed in parallel
+ - a thread chunks every parsed document
+ - a thread embeds the chunks in batches
+ - a thread hands the embeddings to the sink (e.g. Pinecone upload + local vector store)
+The stages are connected by bounded queues, so memory stays flat however many files there are.
+Progress and errors are reported per file. With an IndexManifest only new or changed chunks are
+embedded and uploaded, and the chunks a file no longer produces are removed once it is done.'''
+import os
+import queue
+import threading
+
+_DONE = object()
+
+
+class IngestPipeline():
+    def __init__(self, ingesterAndParser, textPreprocesser, embedAndSearch, sink,
+                 max_workers=None, queue_size=8, embed_batch_size=256, on_progress=None,
+                 manifest=None, on_removed=None):
+        '''
+        sink: function called with each batch of embeddings of a file.
+        manifest: optional IndexManifest used to skip chunks that are already indexed.
+        on_removed: function called with the ids a re-ingested file no longer produces.
+        on_progress: optional function called with (filename, status, report) where status
+        is "parsed", "progress" (after each uploaded batch), "done" or "failed".
+        '''
+        self.ingesterAndParser = ingesterAndParser
+        self.textPreprocesser = textPreprocesser
+        self.embedAndSearch = embedAndSearch
+        self.sink = sink
+        self.max_workers = max_workers
+        self.queue_size = queue_size
+        self.embed_batch_size = embed_batch_size
+        self.on_progress = on_progress
+        self.manifest = manifest
+        self.on_removed = on_removed
+
+    def run(self, file_paths):
+        '''
+        Ingest the files and return a report {file_path: {"status", "chunks", "uploaded", "error"}}
+        '''
+        reports = {}
+        # the file name identifies a document everywhere (chunk metadata, vector ids, manifest
+        # and S3 key), so a second file with the same name in another directory is rejected
+        # rather than overwriting the first one's chunks
+        by_name = {}
+        for file_path in file_paths:
+            by_name.setdefault(os.path.basename(getattr(file_path, "name", file_path)), []).append(file_path)
+        file_paths = [paths[0] for paths in by_name.values()]
+        for name, paths in by_name.items():
+            for file_path in paths[1:]:
+                error = f"another file named {name} is in the same batch ({paths[0]})"
+                print(f"Error ingesting {file_path}: {error}")
+                reports[file_path] = {"status": "failed", "chunks": 0, "uploaded": 0, "error": error}
+                if self.on_progress:
+                    self.on_progress(file_path, "failed", dict(reports[file_path]))
+        # per file: parts not parsed yet, parts not chunked yet, batches not uploaded yet
+        counters = {}
+        # per file: filename in the chunk metadata and every chunk id produced
+        filenames = {}
+        file_ids = {}
+        lock = threading.Lock()
+        chunk_queue = queue.Queue(maxsize=self.queue_size)
+        embed_queue = queue.Queue(maxsize=self.queue_size)
+        upload_queue = queue.Queue(maxsize=self.queue_size)
+
+        def update(file_path, status=None, **increments):
+            with lock:
+                report = reports.setdefault(file_path, {"status": "pending", "chunks": 0, "uploaded": 0, "error": None})
+                counter = counters.setdefault(file_path, {"unparsed": 1, "unchunked": 0, "batches": 0})
+                if report["status"] == "failed":
+                    return
+                for name, value in increments.items():
+                    if name in counter:
+                        counter[name] += value
+                    else:
+                        report[name] += value
+                if status is None and not any(counter.values()):
+                    status = "done"
+                if status:
+                    report["status"] = status
+                report = dict(report)
+            if status == "done" and self.manifest is not None and file_path in filenames:
+                try:
+                    self._finish_file(filenames[file_path], file_ids[file_path])
+                except Exception as e:
+                    fail(file_path, e)
+                    return
+            if status and self.on_progress:
+                self.on_progress(file_path, status, report)
+
+        def fail(file_path, error):
+            print(f"Error ingesting {file_path}: {error}")
+            with lock:
+                reports[file_path]["status"] = "failed"
+                reports[file_path]["error"] = str(error)
+                report = dict(reports[file_path])
+            if self.on_progress:
+                self.on_progress(file_path, "failed", report)
+
+        def is_failed(file_path):
+            with lock:
+                return reports[file_path]["status"] == "failed"
+
+        def chunk_stage():
+            while (item := chunk_queue.get()) is not _DONE:
+                file_path, document = item
+                if is_failed(file_path):
+                    continue
+                try:
+                    chunks = self.textPreprocesser.chunk_text(document)
+                    if self.manifest is not None:
+                        with lock:
+                            filenames[file_path] = document["filename"]
+                            file_ids.setdefault(file_path, set()).update(
+                                chunk["id"] for chunk in self.manifest.assign_ids(chunks))
+                        indexed = self.manifest.ids(document["filename"])
+                        chunks = [chunk for chunk in chunks if chunk["id"] not in indexed]
+                    for i in range(0, len(chunks), self.embed_batch_size):
+                        update(file_path, batches=1, chunks=len(chunks[i:i+self.embed_batch_size]))
+                        embed_queue.put((file_path, chunks[i:i+self.embed_batch_size]))
+                    update(file_path, unchunked=-1)
+                except Exception as e:
+                    fail(file_path, e)
+            embed_queue.put(_DONE)
+
+        def embed_stage():
+            while (item := embed_queue.get()) is not _DONE:
+                file_path, chunks = item
+                if is_failed(file_path):
+                    continue
+                try:
+                    upload_queue.put((file_path, self.embedAndSearch.generate_embeddings(chunks)))
+                except Exception as e:
+                    fail(file_path, e)
+            upload_queue.put(_DONE)
+
+        def upload_stage():
+            while (item := upload_queue.get()) is not _DONE:
+                file_path, embeddings = item
+                if is_failed(file_path):
+                    continue
+                try:
+                    self.sink(embeddings)
+                    update(file_path, "progress", batches=-1, uploaded=len(embeddings))
+                    # a file is done once every part is parsed, chunked and uploaded
+                    update(file_path)
+                except Exception as e:
+                    fail(file_path, e)
+
+        threads = [threading.Thread(target=stage, daemon=True) for stage in (chunk_stage, embed_stage, upload_stage)]
+        for thread in threads:
+            thread.start()
+        try:
+            for file_path, document, error, parts_left in self.ingesterAndParser.iter_documents(
+                    file_paths, max_workers=self.max_workers):
+                if file_path not in counters:
+                    # the counter starts at 1 for the part just parsed, add the parts still to come
+                    update(file_path, unparsed=parts_left)
+                if error is not None or document is None:
+                    fail(file_path, error or "could not be parsed")
+                    continue
+                update(file_path, "parsed" if parts_left == 0 else None, unparsed=-1, unchunked=1)
+                chunk_queue.put((file_path, document))
+        finally:
+            chunk_queue.put(_DONE)
+            for thread in threads:
+                thread.join()
+        return reports
+
+    def _finish_file(self, filename, ids):
+        # remove the chunks the file no longer produces and record what is indexed now
+        removed_ids = self.manifest.ids(filename) - ids
+        if removed_ids and self.on_removed:
+            self.on_removed(removed_ids)
+        self.manifest.update(filename, ids)
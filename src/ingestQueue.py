@@ -0,0 +1,304 @@
+'''
+This module contains the IngestQueue class, a persistent job queue for ingesting uploaded files
+in the background, so the Streamlit session stays usable while files are processed.
+
+ - submit() copies the file to a spool directory and records a job in SQLite; it returns at once
+ - a pool of worker threads takes the queued jobs (several files are processed at the same time)
+   and reports the progress of every job (stage, chunks, chunks uploaded) in its row, which the
+   UI polls with jobs()
+ - the same file (same name and content) submitted again returns the existing job instead of
+   processing it twice; failed jobs are queued again
+ - jobs survive a restart: the spooled files stay on disk and jobs left running by a process that
+   is gone (or that stopped updating them for lease_seconds) are queued again by start(). A
+   heartbeat thread refreshes the running jobs of the process every heartbeat_interval seconds,
+   so a long stage (e.g. parsing a large pdf) doesn't look abandoned to another process'''
+import hashlib
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+ACTIVE_STATUSES = ("queued", "running")
+JOB_COLUMNS = ("id", "filename", "path", "content_hash", "status", "stage", "chunks", "uploaded", "error",
+               "attempts", "owner", "created_at", "started_at", "finished_at", "heartbeat_at")
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class IngestQueue():
+    def __init__(self, path, spool_dir, process_file, max_workers=2, lease_seconds=300, poll_interval=1.0,
+                 heartbeat_interval=None):
+        '''
+        process_file: function(file_path, on_progress) doing the actual ingestion, returning a
+        report {"status", "chunks", "uploaded", "error"} (or raising). on_progress(stage, report)
+        is called with the intermediate reports.
+        heartbeat_interval: seconds between two heartbeats of the running jobs (a third of
+        lease_seconds, at most 30, by default)
+        '''
+        self.path = path
+        self.spool_dir = spool_dir
+        self.process_file = process_file
+        self.max_workers = max_workers
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval or min(30.0, lease_seconds / 3)
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._local = threading.local()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._workers = []
+        # ids of the jobs this process is running, refreshed by the heartbeat thread
+        self._running = set()
+        self._running_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        os.makedirs(spool_dir, exist_ok=True)
+
+        conn = self._connection()
+        with conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                filename TEXT NOT NULL,
+                path TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                status TEXT NOT NULL,
+                stage TEXT,
+                chunks INTEGER NOT NULL DEFAULT 0,
+                uploaded INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                owner TEXT,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL,
+                heartbeat_at REAL,
+                UNIQUE(filename, content_hash))""")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status, id)")
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # autocommit, transactions are opened explicitly where a job is claimed
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _job(self, row):
+        return dict(zip(JOB_COLUMNS, row)) if row else None
+
+    def job(self, job_id):
+        row = self._connection().execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE id = ?",
+                                         (job_id,)).fetchone()
+        return self._job(row)
+
+    def jobs(self, limit=50, active_only=False):
+        '''
+        The most recent jobs, newest first, as dicts (see JOB_COLUMNS)
+        '''
+        where = f"WHERE status IN ({', '.join('?' * len(ACTIVE_STATUSES))})" if active_only else ""
+        rows = self._connection().execute(
+            f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs {where} ORDER BY id DESC LIMIT ?",
+            (*(ACTIVE_STATUSES if active_only else ()), limit)).fetchall()
+        return [self._job(row) for row in rows]
+
+    def submit(self, file, filename=None):
+        '''
+        Queue a file (local path or file object, e.g. a Streamlit UploadedFile). Returns the job;
+        a file already queued, running or done is not queued again ("duplicate": True).
+        '''
+        filename = os.path.basename(filename or getattr(file, "name", file))
+        if hasattr(file, "read"):
+            file.seek(0)
+            data = file.read()
+            file.seek(0)
+        else:
+            with open(file, "rb") as f:
+                data = f.read()
+        content_hash = hashlib.sha256(data).hexdigest()
+
+        conn = self._connection()
+        existing = self._job(conn.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE filename = ? AND content_hash = ?",
+                                          (filename, content_hash)).fetchone())
+        if existing is not None and existing["status"] != "failed":
+            return {**existing, "duplicate": True}
+
+        # spooled under the original filename, which ends up in the chunk metadata and the S3 key
+        spool_path = os.path.join(self.spool_dir, content_hash[:16], filename)
+        if not os.path.exists(spool_path):
+            os.makedirs(os.path.dirname(spool_path), exist_ok=True)
+            with open(spool_path + ".tmp", "wb") as f:
+                f.write(data)
+            os.replace(spool_path + ".tmp", spool_path)
+
+        now = time.time()
+        if existing is not None:
+            conn.execute("""UPDATE jobs SET status = 'queued', stage = NULL, error = NULL, chunks = 0, uploaded = 0,
+                owner = NULL, path = ?, created_at = ?, started_at = NULL, finished_at = NULL WHERE id = ?""",
+                (spool_path, now, existing["id"]))
+            job_id = existing["id"]
+        else:
+            # OR IGNORE: the same file submitted at the same time from another session is one job
+            conn.execute("""INSERT OR IGNORE INTO jobs(filename, path, content_hash, status, created_at)
+                VALUES(?, ?, ?, 'queued', ?)""", (filename, spool_path, content_hash, now))
+            job_id = conn.execute("SELECT id FROM jobs WHERE filename = ? AND content_hash = ?",
+                                  (filename, content_hash)).fetchone()[0]
+        self._wakeup.set()
+        return {**self.job(job_id), "duplicate": False}
+
+    def _update(self, job_id, **fields):
+        fields["heartbeat_at"] = time.time()
+        self._connection().execute(f"UPDATE jobs SET {', '.join(f'{name} = ?' for name in fields)} WHERE id = ?",
+                                   (*fields.values(), job_id))
+
+    def _claim(self):
+        # BEGIN IMMEDIATE takes the write lock, so two workers (or processes) never claim the same job
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # a new version of a file being ingested waits for it: both would update the same
+            # manifest entry (files are identified by name)
+            row = conn.execute(f"""SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE status = 'queued'
+                AND filename NOT IN (SELECT filename FROM jobs WHERE status = 'running') ORDER BY id LIMIT 1""").fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            conn.execute("""UPDATE jobs SET status = 'running', owner = ?, attempts = attempts + 1, started_at = ?,
+                heartbeat_at = ? WHERE id = ?""", (self.owner, now, now, row[0]))
+            return self._job(row)
+        finally:
+            conn.execute("COMMIT")
+
+    def requeue_orphans(self):
+        '''
+        Queue again the running jobs whose process is gone (same host) or that were not updated
+        for lease_seconds. Returns the number of jobs queued again.
+        '''
+        host = socket.gethostname()
+        conn = self._connection()
+        requeued = 0
+        for job_id, owner, heartbeat_at in conn.execute(
+                "SELECT id, owner, heartbeat_at FROM jobs WHERE status = 'running'").fetchall():
+            owner_host, _, pid = (owner or ":").rpartition(":")
+            if owner == self.owner:
+                continue
+            orphaned = (owner_host == host and pid.isdigit() and not _process_alive(int(pid))) or \
+                (heartbeat_at or 0) < time.time() - self.lease_seconds
+            if orphaned:
+                requeued += conn.execute("UPDATE jobs SET status = 'queued', owner = NULL WHERE id = ? AND status = 'running'",
+                                         (job_id,)).rowcount
+        if requeued:
+            print(f"Resuming {requeued} interrupted ingestion jobs")
+            self._wakeup.set()
+        return requeued
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.heartbeat_interval):
+            with self._running_lock:
+                job_ids = list(self._running)
+            if not job_ids:
+                continue
+            try:
+                self._connection().execute(
+                    f"UPDATE jobs SET heartbeat_at = ? WHERE status = 'running' AND owner = ? "
+                    f"AND id IN ({', '.join('?' * len(job_ids))})", (time.time(), self.owner, *job_ids))
+            except sqlite3.Error as e:
+                print(f"Error updating the ingestion job heartbeat: {e}")
+
+    def _run(self, job):
+        job_id = job["id"]
+
+        def on_progress(stage, report):
+            self._update(job_id, stage=stage, chunks=report.get("chunks", 0), uploaded=report.get("uploaded", 0))
+
+        with self._running_lock:
+            self._running.add(job_id)
+        try:
+            report = self.process_file(job["path"], on_progress)
+            if report.get("status") == "failed":
+                raise RuntimeError(report.get("error") or "ingestion failed")
+        except Exception as e:
+            print(f"Error ingesting {job['filename']}: {e}")
+            self._update(job_id, status="failed", error=f"{type(e).__name__}: {e}", finished_at=time.time())
+            return
+        finally:
+            with self._running_lock:
+                self._running.discard(job_id)
+        self._update(job_id, status="done", stage="done", chunks=report.get("chunks", 0),
+                     uploaded=report.get("uploaded", 0), finished_at=time.time())
+        try:
+            os.remove(job["path"])
+            os.rmdir(os.path.dirname(job["path"]))
+        except OSError:
+            pass
+
+    def _worker(self):
+        last_check = time.monotonic()
+        while not self._stop.is_set():
+            try:
+                job = self._claim()
+                if job is not None:
+                    self._run(job)
+                    continue
+                if time.monotonic() - last_check > min(60, self.lease_seconds):
+                    self.requeue_orphans()
+                    last_check = time.monotonic()
+            except sqlite3.Error as e:
+                # e.g. the database stayed locked by another process longer than the timeout
+                print(f"Error reading the ingestion queue, retrying: {e}")
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def start(self):
+        '''
+        Resume the interrupted jobs and start the workers (once per process)
+        '''
+        with self._start_lock:
+            if self._workers:
+                return
+            self._stop.clear()
+            self.requeue_orphans()
+            self._workers = [threading.Thread(target=self._worker, name=f"ingest-worker-{i}", daemon=True)
+                             for i in range(self.max_workers)]
+            self._workers.append(threading.Thread(target=self._heartbeat, name="ingest-heartbeat", daemon=True))
+            for worker in self._workers:
+                worker.start()
+
+    def stop(self, wait=True):
+        '''
+        Stop the workers once they have finished their current job
+        '''
+        with self._start_lock:
+            self._stop.set()
+            self._wakeup.set()
+            if wait:
+                for worker in self._workers:
+                    worker.join()
+            self._workers = []
+
+    def wait(self, job_ids=None, timeout=None):
+        '''
+        Block until the given jobs (all jobs if None) are done or failed. Returns True if they are.
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if job_ids is None:
+                active = self.jobs(limit=1, active_only=True)
+            else:
+                active = [job for job in map(self.job, job_ids) if job and job["status"] in ACTIVE_STATUSES]
+            if not active:
+                return True
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(min(self.poll_interval, 0.2))
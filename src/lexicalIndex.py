@@ -0,0 +1,207 @@
+'''
+This module contains a compact BM25 inverted index used next to the vector search, so questions
+that hinge on exact terms (formula names, acronyms, course codes) find the slides that contain
+them, and results can be returned without waiting for a query embedding.
+
+The index is a list of segments, each covering a contiguous range of rows of the vector store.
+A segment stores its postings in flat numpy arrays (CSR layout), with no Python object per
+posting:
+ - terms: sorted uint64 hashes of the terms (no vocabulary strings are kept)
+ - indptr: postings of terms[i] are rows[indptr[i]:indptr[i+1]]
+ - rows: uint32 row offsets (relative to the segment start), tfs: uint8 term frequencies
+ - doc_len: uint16 number of tokens of every row
+That is ~5 bytes per (term, chunk) pair. New chunks are added as a new segment and segments of
+similar size are merged (like a binary counter), so every posting is rewritten O(log n) times.'''
+import hashlib
+import re
+from collections import Counter
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[._\-/][a-z0-9]+)*")
+SPLIT_PATTERN = re.compile(r"[._\-/]")
+MAX_TOKEN_LENGTH = 40
+STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have in is it its of on or that the this to was "
+    "were what when where which who why will with how do does did can i you we they he she".split())
+
+
+def tokenize(text):
+    '''
+    Lowercased terms of the text. Compound terms such as "cs-101" or "l2.norm" are kept whole
+    and their parts are added too, so both "cs-101" and "101" match.
+    '''
+    terms = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        if len(token) > MAX_TOKEN_LENGTH:
+            continue
+        if token not in STOPWORDS:
+            terms.append(token)
+        if SPLIT_PATTERN.search(token):
+            terms.extend(part for part in SPLIT_PATTERN.split(token) if part and part not in STOPWORDS)
+    return terms
+
+
+def term_hash(term):
+    return int.from_bytes(hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    '''
+    Fuse several rankings (arrays of rows, best first) into {row: score} with
+    score = sum(1 / (k + rank)). Rank based, so BM25 and cosine scores need no calibration.
+    '''
+    fused = {}
+    for ranking in rankings:
+        for rank, row in enumerate(ranking):
+            row = int(row)
+            fused[row] = fused.get(row, 0.0) + 1.0 / (k + rank + 1)
+    return fused
+
+
+class LexicalSegment():
+    def __init__(self, start, doc_len, terms, indptr, rows, tfs):
+        self.start = start
+        self.doc_len = doc_len
+        self.terms = terms
+        self.indptr = indptr
+        self.rows = rows
+        self.tfs = tfs
+
+    def __len__(self):
+        return self.doc_len.shape[0]
+
+    @property
+    def end(self):
+        return self.start + len(self)
+
+    @classmethod
+    def build(cls, texts, start=0):
+        '''
+        Index texts as rows start, start + 1, ...
+        '''
+        hashes = {}
+        term_ids = []
+        row_ids = []
+        counts = []
+        doc_len = np.zeros(len(texts), dtype=np.uint16)
+        for row, text in enumerate(texts):
+            tokens = tokenize(text)
+            doc_len[row] = min(len(tokens), 65535)
+            for term, count in Counter(tokens).items():
+                value = hashes.get(term)
+                if value is None:
+                    value = hashes[term] = term_hash(term)
+                term_ids.append(value)
+                row_ids.append(row)
+                counts.append(count)
+        return cls.from_postings(start, doc_len, np.asarray(term_ids, dtype=np.uint64),
+                                 np.asarray(row_ids, dtype=np.uint32), np.asarray(counts))
+
+    @classmethod
+    def from_postings(cls, start, doc_len, term_ids, row_ids, counts):
+        order = np.lexsort((row_ids, term_ids))
+        term_ids = term_ids[order]
+        terms, first = np.unique(term_ids, return_index=True)
+        indptr = np.append(first, len(term_ids)).astype(np.int64)
+        return cls(start, doc_len, terms, indptr, row_ids[order],
+                   np.minimum(counts[order], 255).astype(np.uint8))
+
+    @classmethod
+    def merge(cls, segments):
+        '''
+        Merge segments covering consecutive row ranges into one
+        '''
+        segments = sorted(segments, key=lambda segment: segment.start)
+        start = segments[0].start
+        term_ids = np.concatenate([np.repeat(s.terms, np.diff(s.indptr)) for s in segments])
+        row_ids = np.concatenate([s.rows.astype(np.uint32) + np.uint32(s.start - start) for s in segments])
+        counts = np.concatenate([s.tfs for s in segments])
+        doc_len = np.concatenate([s.doc_len for s in segments])
+        return cls.from_postings(start, doc_len, term_ids, row_ids, counts)
+
+    def postings(self, term, first_row=None, last_row=None):
+        '''
+        (document frequency, global rows, term frequencies) of a term hash, None if the segment
+        doesn't contain it. The postings of a term are sorted by row, so restricting them to
+        the rows [first_row, last_row] is a binary search.
+        '''
+        i = np.searchsorted(self.terms, term)
+        if i == len(self.terms) or self.terms[i] != term:
+            return None
+        lo, hi = int(self.indptr[i]), int(self.indptr[i + 1])
+        df = hi - lo
+        if first_row is not None:
+            rows = self.rows[lo:hi]
+            lo, hi = (lo + int(np.searchsorted(rows, max(first_row - self.start, 0))),
+                      lo + int(np.searchsorted(rows, max(last_row - self.start + 1, 0))))
+        return df, self.rows[lo:hi].astype(np.int64) + self.start, self.tfs[lo:hi]
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            np.savez(f, start=np.int64(self.start), doc_len=self.doc_len, terms=self.terms,
+                     indptr=self.indptr, rows=self.rows, tfs=self.tfs)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(int(data["start"]), data["doc_len"], data["terms"], data["indptr"], data["rows"], data["tfs"])
+
+
+class LexicalIndex():
+    def __init__(self, segments, k1=1.2, b=0.75):
+        self.segments = sorted(segments, key=lambda segment: segment.start)
+        self.k1 = k1
+        self.b = b
+        self.count = sum(len(segment) for segment in self.segments)
+        total_len = sum(int(segment.doc_len.sum(dtype=np.int64)) for segment in self.segments)
+        self.avgdl = total_len / self.count if self.count else 0.0
+
+    def __len__(self):
+        return self.count
+
+    def search(self, query, top_k=10, deleted=None, rows=None):
+        '''
+        BM25 top_k for the query text. Returns (rows, scores), best first; rows in the deleted
+        mask are left out, and with rows (sorted array) only those rows are returned.
+        '''
+        allowed = rows
+        terms = {term_hash(term) for term in tokenize(query)}
+        if top_k <= 0 or not terms or not self.count or (allowed is not None and not len(allowed)):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        # a scoped search only reads the postings between the first and last row of the scope
+        first_row, last_row = (int(allowed[0]), int(allowed[-1])) if allowed is not None else (None, None)
+
+        row_parts = []
+        score_parts = []
+        for term in terms:
+            postings = [(segment, segment.postings(term, first_row, last_row)) for segment in self.segments]
+            postings = [(segment, p) for segment, p in postings if p is not None]
+            # the document frequency counts the whole index, not only the scope
+            df = sum(p[0] for _, p in postings)
+            if df == 0:
+                continue
+            idf = np.log(1.0 + (self.count - df + 0.5) / (df + 0.5))
+            for segment, (_, rows, tfs) in postings:
+                tf = tfs.astype(np.float32)
+                dl = segment.doc_len[rows - segment.start].astype(np.float32)
+                norm = self.k1 * (1.0 - self.b + self.b * dl / (self.avgdl or 1.0))
+                row_parts.append(rows)
+                score_parts.append((idf * tf * (self.k1 + 1.0) / (tf + norm)).astype(np.float32))
+        if not row_parts:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        # sum the scores of every term per row (only the rows containing a query term are touched)
+        rows, inverse = np.unique(np.concatenate(row_parts), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(score_parts)).astype(np.float32)
+        if deleted is not None:
+            keep = ~deleted[rows]
+            rows, scores = rows[keep], scores[keep]
+        if allowed is not None:
+            positions = np.minimum(np.searchsorted(allowed, rows), max(len(allowed) - 1, 0))
+            keep = allowed[positions] == rows if len(allowed) else np.zeros(len(rows), dtype=bool)
+            rows, scores = rows[keep], scores[keep]
+        if top_k < len(rows):
+            best = np.argpartition(-scores, top_k - 1)[:top_k]
+            rows, scores = rows[best], scores[best]
+        order = np.argsort(-scores, kind="stable")
+        return rows[order], scores[order]
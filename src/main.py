@@ -1,64 +1,69 @@
-from utils.gptService import GPTService
-from utils.pineconeService import PineConeService
-from embedAndSearch import EmbedAndSearch
-from ingestAndParse import IngesterAndParser
-from preprocessAndChunk import TextPreprocesser
+from src.serviceContainer import get_services
+from src.ingestPipeline import IngestPipeline
+from src.utils.tracing import tracer, InMemoryCollector
 import dotenv
 dotenv.load_dotenv()
-import openai
+import logging
 import os
 
 def main():
-    # Configuration
-    documents_dir = "../data"
-    pinecone_index_name = "custom-rag-llm"
-
-    ingesterAndParser = IngesterAndParser()
-    textPreprocesser = TextPreprocesser()
-    embedAndSearch = EmbedAndSearch()
-    pineconeService = PineConeService()
-    gptService = GPTService()
-    
-    
-    # Process documents
-    print("Processing documents...")
-    documents = ingesterAndParser.process_documents(documents_dir)
-    
-    # Chunk textx
-    print("Chunking text...")
-    chunks = textPreprocesser.chunk_text(documents)
-    
-    # Generate embeddings
-    print("Generating embeddings...")
-    embeddings = embedAndSearch.generate_embeddings(chunks)
+    # progress messages of the pipeline (the client libraries stay at warnings)
+    logging.basicConfig(format="%(message)s")
+    logging.getLogger("src").setLevel(os.getenv("LOG_LEVEL", "INFO"))
+    # Configuration (see src/serviceContainer.py for the environment variables)
+    documents_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data")
+    services = get_services()
     
     # Initialize Pinecone
     print("Initializing Pinecone...")
-    index = pineconeService.initialize_index(pinecone_index_name)
-    
-    # Upload to Pinecone
-    print("Uploading to Pinecone...")
-    pineconeService.upload_embeddings(index, embeddings)
+    services.pinecone_index()
+
+    # The manifest records what is indexed, so only new or changed chunks are embedded and uploaded
+    indexManifest = services.indexManifest
+    file_paths = services.ingesterAndParser.list_documents(documents_dir)
+
+    def report_progress(file_path, status, report):
+        print(f"{os.path.basename(file_path)}: {status} ({report['uploaded']}/{report['chunks']} chunks uploaded)"
+              + (f" - {report['error']}" if report["error"] else ""))
+
+    # Parse, chunk, embed and upload the documents as a streaming pipeline
+    print(f"Processing {len(file_paths)} documents...")
+    ingestPipeline = IngestPipeline(services.ingesterAndParser, services.textPreprocesser, services.embedAndSearch,
+                                    services.upload_embeddings, on_progress=report_progress, manifest=indexManifest,
+                                    on_removed=services.remove_embeddings)
+    ingestPipeline.run(file_paths)
+
+    vectorBackend = services.vectorBackend
+    print(f"Searching the {vectorBackend.backend} vector store: {vectorBackend.stats()}")
+
+    queryPipeline = services.queryPipeline
+    metadata_filter = None
     
     # Interactive query loop
     while True:
-        query = input("\nEnter your question (or 'quit' to exit): ")
+        query = input("\nEnter your question, 'scope <file>[, <file>...]' to search only some files, "
+                      "'scope' to search everything (or 'quit' to exit): ")
         if query.lower() == 'quit':
             break
+        if query.lower().split(" ")[0] == 'scope':
+            files = [name.strip() for name in query[len("scope"):].split(",") if name.strip()]
+            metadata_filter = {"filename": files} if files else None
+            print(f"Searching {', '.join(files) if files else 'all files'}")
+            continue
         
-        # Retrieve relevant contexts
+        # Retrieve relevant contexts and stream the response (or reuse a cached answer)
         print("Searching for relevant information...")
-        contexts = embedAndSearch.semantic_search(query, embeddings)
+        result = queryPipeline.answer_stream(query, metadata_filter=metadata_filter)
         
-        # Construct prompt
-        prompt = gptService.construct_prompt(query, contexts)
-        
-        # Generate response
-        print("Generating response...")
-        response = gptService.generate_answer(prompt)
-        
-        print("\nAnswer:")
-        print(response)
+        print("\nAnswer:" + (f" (cached, {result['cached']} match)" if result["cached"] else ""))
+        for token in result["stream"]:
+            print(token, end="", flush=True)
+        print(f"\n\nAnswer stats: {result['stream'].stats}")
+
+    print(f"Embedding cache stats: {services.embeddingCache.stats()}")
+    if isinstance(tracer.exporter, InMemoryCollector):
+        for name, stage in tracer.exporter.summary().items():
+            print(f"{name}: {stage}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,247 @@
+'''
+This module contains the MetadataIndex class which partitions the rows of the vector store by
+file and by course, so a search scoped with a filter (e.g. "only Lecture 5", "only CS101,
+slides 10-20") scores only the matching rows instead of the whole corpus.
+
+Per row it keeps four int32 columns (file id, course id, first and last slide/page number) and,
+built from them, the rows of every file and every course as contiguous slices of one array (CSR
+offsets) and the located rows sorted by first slide/page number, so a slide range alone is two
+binary searches.
+Resolving a filter costs O(rows in scope), independent of the size of the store (plus a binary
+search, and for a slide range the chunks that start at most one chunk span before it).
+
+Filters are dicts with any of:
+ - "filename": a filename or a list/set of filenames
+ - "course": a course tag or a list/set of course tags (e.g. "CS101")
+ - "slide_range": (first, last) slide (or pdf page) numbers, inclusive (a chunk covering
+   several slides matches if one of them is in the range)
+'''
+import json
+import re
+import numpy as np
+
+COURSE_PATTERN = re.compile(r"^([A-Za-z]{2,5})[\s_-]?(\d{2,4}[A-Za-z]?)(?![A-Za-z0-9])")
+
+
+def course_of(filename):
+    '''
+    Course tag from a filename such as "CS101_lecture5.pptx" or "math-201 week 3.pdf"
+    (-> "CS101", "MATH201"), or None
+    '''
+    match = COURSE_PATTERN.match(filename or "")
+    if match is None:
+        return None
+    return (match.group(1) + match.group(2)).upper()
+
+
+def chunk_course(metadata):
+    return metadata.get("course") or course_of(metadata.get("filename"))
+
+
+def chunk_location(metadata):
+    return metadata.get("slide_number", metadata.get("page_number"))
+
+
+def chunk_location_end(metadata):
+    # last slide/page of a chunk covering several (merged slides), the first one otherwise
+    return metadata.get("last_slide_number", metadata.get("last_page_number", chunk_location(metadata)))
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return [value]
+    return sorted(value)
+
+
+def normalize_filter(metadata_filter):
+    '''
+    Canonical form of a filter ({"filename": [...], "course": [...], "slide_range": [first, last]}),
+    or None if it doesn't restrict anything
+    '''
+    if not metadata_filter:
+        return None
+    normalized = {}
+    for key in ("filename", "course"):
+        values = _as_list(metadata_filter.get(key))
+        if values:
+            normalized[key] = values
+    slide_range = metadata_filter.get("slide_range")
+    if slide_range is not None:
+        first, last = slide_range
+        normalized["slide_range"] = [int(first) if first is not None else None,
+                                     int(last) if last is not None else None]
+    return normalized or None
+
+
+def filter_key(metadata_filter):
+    '''
+    Stable string form of a filter (e.g. for cache keys)
+    '''
+    normalized = normalize_filter(metadata_filter)
+    return json.dumps(normalized, sort_keys=True) if normalized else ""
+
+
+def matches_filter(metadata, metadata_filter):
+    '''
+    True if a chunk's metadata matches the (normalized) filter
+    '''
+    if metadata_filter is None:
+        return True
+    if "filename" in metadata_filter and metadata.get("filename") not in metadata_filter["filename"]:
+        return False
+    if "course" in metadata_filter and chunk_course(metadata) not in metadata_filter["course"]:
+        return False
+    if "slide_range" in metadata_filter:
+        first, last = metadata_filter["slide_range"]
+        location = chunk_location(metadata)
+        # a chunk covering several slides matches if any of them is in the range
+        if location is None or (first is not None and chunk_location_end(metadata) < first) or \
+                (last is not None and location > last):
+            return False
+    return True
+
+
+def _partitions(ids, n_groups):
+    # rows grouped by id: rows[offsets[g]:offsets[g+1]] are the rows of group g, in row order
+    order = np.argsort(ids, kind="stable")
+    counts = np.bincount(ids[ids >= 0], minlength=n_groups)
+    offsets = np.zeros(n_groups + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    start = int(np.count_nonzero(ids < 0))  # rows without a group sort first
+    return order[start:], offsets
+
+
+class MetadataIndex():
+    def __init__(self, filenames=None, courses=None, file_ids=None, course_ids=None, locations=None,
+                 location_ends=None):
+        self.filenames = list(filenames or [])
+        self.courses = list(courses or [])
+        self._file_lookup = {name: i for i, name in enumerate(self.filenames)}
+        self._course_lookup = {name: i for i, name in enumerate(self.courses)}
+        self.file_ids = np.asarray(file_ids if file_ids is not None else [], dtype=np.int32)
+        self.course_ids = np.asarray(course_ids if course_ids is not None else [], dtype=np.int32)
+        self.locations = np.asarray(locations if locations is not None else [], dtype=np.int32)
+        self.location_ends = np.asarray(location_ends if location_ends is not None else self.locations, dtype=np.int32)
+        self._build_partitions()
+
+    def __len__(self):
+        return self.file_ids.shape[0]
+
+    def _build_partitions(self):
+        self.file_rows, self.file_offsets = _partitions(self.file_ids, len(self.filenames))
+        self.course_rows, self.course_offsets = _partitions(self.course_ids, len(self.courses))
+        # rows with a slide/page number, by first slide/page, and the widest slide range of a chunk
+        located = np.flatnonzero(self.locations >= 0)
+        self.location_rows = located[np.argsort(self.locations[located], kind="stable")]
+        self.sorted_locations = self.locations[self.location_rows]
+        spans = self.location_ends[located] - self.locations[located]
+        self.max_span = int(spans.max()) if len(spans) else 0
+
+    def _id(self, lookup, names, value):
+        if value is None:
+            return -1
+        if value not in lookup:
+            lookup[value] = len(names)
+            names.append(value)
+        return lookup[value]
+
+    def add(self, records):
+        '''
+        Add the metadata of the next rows ({"metadata": ...} records, in row order)
+        '''
+        file_ids = []
+        course_ids = []
+        locations = []
+        location_ends = []
+        for record in records:
+            metadata = record["metadata"]
+            file_ids.append(self._id(self._file_lookup, self.filenames, metadata.get("filename")))
+            course_ids.append(self._id(self._course_lookup, self.courses, chunk_course(metadata)))
+            location = chunk_location(metadata)
+            locations.append(-1 if location is None else int(location))
+            location_ends.append(-1 if location is None else int(chunk_location_end(metadata)))
+        if not file_ids:
+            return
+        self.file_ids = np.concatenate([self.file_ids, np.asarray(file_ids, dtype=np.int32)])
+        self.course_ids = np.concatenate([self.course_ids, np.asarray(course_ids, dtype=np.int32)])
+        self.locations = np.concatenate([self.locations, np.asarray(locations, dtype=np.int32)])
+        self.location_ends = np.concatenate([self.location_ends, np.asarray(location_ends, dtype=np.int32)])
+        self._build_partitions()
+
+    def _rows_of(self, rows, offsets, lookup, values):
+        parts = [rows[offsets[lookup[value]]:offsets[lookup[value] + 1]] for value in values if value in lookup]
+        if not parts:
+            return np.empty(0, dtype=np.int64)
+        return np.sort(np.concatenate(parts)) if len(parts) > 1 else parts[0]
+
+    def rows(self, metadata_filter, deleted=None):
+        '''
+        Sorted rows matching the filter (None if the filter doesn't restrict anything), without
+        the rows set in the deleted mask
+        '''
+        metadata_filter = normalize_filter(metadata_filter)
+        if metadata_filter is None:
+            return None
+        rows = None
+        if "filename" in metadata_filter:
+            rows = self._rows_of(self.file_rows, self.file_offsets, self._file_lookup, metadata_filter["filename"])
+        if "course" in metadata_filter:
+            course_rows = self._rows_of(self.course_rows, self.course_offsets, self._course_lookup,
+                                        metadata_filter["course"])
+            rows = course_rows if rows is None else np.intersect1d(rows, course_rows, assume_unique=True)
+        if "slide_range" in metadata_filter:
+            first, last = metadata_filter["slide_range"]
+            if rows is None:
+                rows = self._rows_in_range(first, last)
+            else:
+                rows = self._rows_in_range_of(rows, first, last)
+        rows = rows.astype(np.int64)
+        if deleted is not None and len(rows):
+            rows = rows[~deleted[rows]]
+        return rows
+
+    def _rows_in_range(self, first, last):
+        # chunks starting in [first - max_span, last] are the only ones that can overlap the range
+        start = 0 if first is None else np.searchsorted(self.sorted_locations, first - self.max_span, side="left")
+        end = len(self.sorted_locations) if last is None else \
+            np.searchsorted(self.sorted_locations, last, side="right")
+        rows = self.location_rows[start:end]
+        if first is not None:
+            rows = rows[self.location_ends[rows] >= first]
+        return np.sort(rows)
+
+    def _rows_in_range_of(self, rows, first, last):
+        locations = self.locations[rows]
+        keep = locations >= 0
+        if first is not None:
+            keep &= self.location_ends[rows] >= first
+        if last is not None:
+            keep &= locations <= last
+        return rows[keep]
+
+    def location_range(self, filenames=None):
+        '''
+        (lowest, highest) slide/page number of the given files (all files if None)
+        '''
+        locations, location_ends = self.locations, self.location_ends
+        if filenames:
+            rows = self._rows_of(self.file_rows, self.file_offsets, self._file_lookup, _as_list(filenames))
+            locations, location_ends = locations[rows], location_ends[rows]
+        located = locations >= 0
+        if not located.any():
+            return None
+        return int(locations[located].min()), int(location_ends[located].max())
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            np.savez(f, filenames=json.dumps(self.filenames), courses=json.dumps(self.courses),
+                     file_ids=self.file_ids, course_ids=self.course_ids, locations=self.locations,
+                     location_ends=self.location_ends)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(json.loads(str(data["filenames"])), json.loads(str(data["courses"])),
+                       data["file_ids"], data["course_ids"], data["locations"], data["location_ends"])
@@ -0,0 +1,121 @@
+'''
+This module contains the PineconeVectorStore class, the VectorStore backend that searches the
+Pinecone index itself: top_k and the metadata filter are applied by the server, so a query sends
+one vector and receives top_k matches whatever the size of the index, and nothing is kept on the
+local disk. Pinecone has no keyword index here, so the query text is not used and a query
+needs its embedding: the query pipelines wait for it instead of falling back to keyword search
+(and report the error if it fails); the local backend keeps the hybrid search.
+
+index_version combines the vector count with a version stamp stored in the index, which
+PineConeService replaces on every upload or delete, so writes from other processes (the CLI
+ingest, other app replicas) also invalidate the answer cache, after at most stats_ttl seconds.
+
+Chunks ingested before course tags were added to the chunk metadata have no "course" field in
+Pinecone, so a course filter doesn't match them until their file is ingested again.'''
+import threading
+import time
+import numpy as np
+
+from .metadataIndex import normalize_filter
+from .vectorStore import VectorStore
+
+
+def _location_filter(key, first, last):
+    # a chunk covers the slides [key, last_<key>] (only [key] when it has no last_<key>) and
+    # matches if that range overlaps [first, last]
+    conditions = []
+    if last is not None:
+        conditions.append({key: {"$lte": last}})
+    if first is not None:
+        conditions.append({"$or": [{key: {"$gte": first}}, {"last_" + key: {"$gte": first}}]})
+    return {"$and": conditions} if conditions else {key: {"$gte": 0}}
+
+
+def pinecone_filter(metadata_filter):
+    '''
+    Pinecone metadata filter equivalent to a filter of metadataIndex.py, None if it doesn't
+    restrict anything
+    '''
+    metadata_filter = normalize_filter(metadata_filter)
+    if metadata_filter is None:
+        return None
+    conditions = []
+    for key in ("filename", "course"):
+        if key in metadata_filter:
+            conditions.append({key: {"$in": metadata_filter[key]}})
+    if "slide_range" in metadata_filter:
+        first, last = metadata_filter["slide_range"]
+        conditions.append({"$or": [_location_filter("slide_number", first, last),
+                                   _location_filter("page_number", first, last)]})
+    return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+
+class PineconeVectorStore(VectorStore):
+    backend = "pinecone"
+    supports_keyword_search = False
+
+    def __init__(self, pineconeService, index_name, stats_ttl=30.0):
+        '''
+        pineconeService: PineConeService of the client (InMemoryPinecone for tests).
+        stats_ttl: seconds the vector count and version stamp (the index_version) are cached, so
+        the answer cache doesn't cost two requests per question.
+        '''
+        self.pineconeService = pineconeService
+        self.index_name = index_name
+        self.stats_ttl = stats_ttl
+        self._lock = threading.Lock()
+        self._stats = None
+        self._version = ""
+        self._stats_at = 0.0
+
+    def _changed(self):
+        # this process sees its own writes at once
+        with self._lock:
+            self._stats = None
+
+    def upsert(self, embeddings):
+        embeddings = list(embeddings)
+        report = self.pineconeService.upload_embeddings(self.index_name, embeddings, raise_on_error=True)
+        self._changed()
+        return sum(batch["vectors"] for batch in report if batch["ok"])
+
+    def delete(self, ids):
+        # raises if Pinecone fails, so the caller (and the index manifest) sees the ids still there
+        deleted = self.pineconeService.delete_embeddings(self.index_name, ids, raise_on_error=True)
+        if deleted:
+            self._changed()
+        return deleted
+
+    def query(self, query_embedding, top_k=10, metadata_filter=None, query_text=None, include_embeddings=False):
+        if query_embedding is None:
+            raise ValueError("The pinecone vector store has no keyword index, a query embedding is required")
+        matches = self.pineconeService.query(self.index_name, query_embedding, top_k=top_k,
+                                             filter=pinecone_filter(metadata_filter),
+                                             include_values=include_embeddings)
+        results = []
+        for match in matches:
+            metadata = match["metadata"]
+            result = {"text": metadata.pop("text", ""), "similarity": float(match["score"]), "metadata": metadata}
+            if include_embeddings:
+                # normalized like the embeddings returned by the local backend
+                vector = np.asarray(match["values"], dtype=np.float32)
+                result["embedding"] = vector / (np.linalg.norm(vector) or 1.0)
+            results.append(result)
+        return results
+
+    def stats(self):
+        with self._lock:
+            if self._stats is None or time.monotonic() - self._stats_at > self.stats_ttl:
+                self._stats = self.pineconeService.stats(self.index_name)
+                self._version = self.pineconeService.read_version(self.index_name)
+                self._stats_at = time.monotonic()
+            stats, version = self._stats, self._version
+        return {"backend": self.backend, "vectors": stats["total_vector_count"], "dimension": stats["dimension"],
+                "index_version": f"pinecone-{self.index_name}-{stats['total_vector_count']}-{version}"}
+
+    @property
+    def index_version(self):
+        return self.stats()["index_version"]
+
+    def __len__(self):
+        return self.stats()["vectors"]
@@ -1,48 +1,138 @@
 '''
-This module is responsible for preprocessing and chunking text data.'''
+This module is responsible for preprocessing and chunking text data.
+
+Chunks are sized in tokens rather than one per slide: small adjacent slides (or pdf pages) are
+merged up to the target size, their first and last slide are kept in the metadata
+(slide_number / last_slide_number) so the sources can still be cited, and long slides (e.g. with
+speaker notes) are split into overlapping parts (chunk_index).'''
 import re
+import time
+
+from .utils.tokens import count_tokens
+from .utils.tracing import tracer
+from .metadataIndex import course_of
+
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+def describe_source(metadata):
+    '''
+    Human readable location of a chunk, e.g. "slide number: 3", "slides 3-5" or "page 12"
+    '''
+    if "slide_number" in metadata:
+        if "last_slide_number" in metadata:
+            return f"slides {metadata['slide_number']}-{metadata['last_slide_number']}"
+        location = f"slide number: {metadata['slide_number']}"
+    elif "page_number" in metadata:
+        if "last_page_number" in metadata:
+            return f"pages {metadata['page_number']}-{metadata['last_page_number']}"
+        location = f"page {metadata['page_number']}"
+    else:
+        return "unknown location"
+    if "chunk_index" in metadata:
+        location += f" (part {metadata['chunk_index'] + 1})"
+    return location
+
+
 class TextPreprocesser():
-    def __init__(self):
-        pass
+    def __init__(self, target_tokens=300, overlap_tokens=40):
+        '''
+        target_tokens: size of a chunk. Adjacent slides (or pdf pages) are merged into one chunk
+        while they fit in it, and a slide longer than that is split into parts of about
+        target_tokens that overlap by overlap_tokens.
+        '''
+        if overlap_tokens >= target_tokens:
+            raise ValueError("overlap_tokens must be smaller than target_tokens")
+        self.target_tokens = target_tokens
+        self.overlap_tokens = overlap_tokens
 
     def clean_text(self, text):
         '''
-        Clean text by removing extra spaces, newlines, and tabs
+        Clean text by collapsing spaces, newlines, and tabs into single spaces
         '''
-        print("Cleaning text...\n")
-        # Replace multiple newlines and tabs with a single space
-        text = re.sub(r'[\n\t]+', ' ', text)  
-        # Replace multiple spaces with a single space
-        text = re.sub(r'\s+', ' ', text).strip()  
-        print("Cleaning complete.\n")
-        return text
-    
+        return WHITESPACE_PATTERN.sub(" ", text).strip()
+
     def chunk_text(self, documents):
         '''
-        Chunk text into smaller pieces. Very naive implementation.
+        Chunk documents (one or a list) into a list of {"text", "metadata"} chunks
         '''
-        print("Chunking text...\n")
         if not isinstance(documents, list):
-            temp = []
-            temp.append(documents)
-            documents = temp
-        
-        chunked_documents = []
-        for doc in documents:
-            if doc["type"] == "pptx":
-                # For PowerPoint, each slide is already a natural chunk
-                for i, slide_content in enumerate(doc["content"]):
-                    if len(slide_content.strip()) > 0:
-                        slide_content = self.clean_text(slide_content)
-                        chunked_documents.append({
-                            "text": slide_content,
-                            "metadata": {
-                                "filename": doc["filename"],
-                                "slide_number": i + 1,
-                                "document_type": "pptx"
-                            }
-                        })
-        print("Chunking complete.\n")
+            documents = [documents]
+
+        if not tracer.enabled:
+            return list(self.iter_chunks(documents))
+
+        with tracer.span("chunk", files=[doc["filename"] for doc in documents]) as span:
+            stats = {"clean_seconds": 0.0, "cleaned": 0}
+            chunked_documents = list(self.iter_chunks(documents, stats))
+            # cleaning runs once per slide, so it is timed as a whole rather than with a span per slide
+            tracer.record("clean", stats["clean_seconds"], parent=span, items=stats["cleaned"])
+            span.add(items=len(chunked_documents),
+                     bytes=sum(len(chunk["text"].encode("utf-8")) for chunk in chunked_documents))
         return chunked_documents
 
-    
\ No newline at end of file
+    def iter_chunks(self, documents, stats=None):
+        '''
+        Generator of the chunks of the documents, in document and slide order. stats (optional
+        dict with "clean_seconds" and "cleaned") is updated with the time spent cleaning.
+        '''
+        for doc in documents:
+            yield from self._document_chunks(doc, stats)
+
+    def _document_chunks(self, doc, stats):
+        if doc["type"] == "pptx":
+            key, first_location = "slide_number", 1
+        elif doc["type"] == "pdf":
+            # page numbers continue from the page range offset
+            key, first_location = "page_number", doc.get("page_offset", 0) + 1
+        else:
+            return
+        # course tag for scoped search, e.g. "CS101" for "CS101_lecture5.pptx"
+        course = doc.get("course") or course_of(doc["filename"])
+        base = {"filename": doc["filename"], "document_type": doc["type"]}
+        if course:
+            base["course"] = course
+
+        # slides waiting to be merged: (location, text), with their total number of tokens
+        group = []
+        group_tokens = 0
+        for i, content in enumerate(doc["content"]):
+            if stats is None:
+                text = self.clean_text(content)
+            else:
+                start = time.perf_counter()
+                text = self.clean_text(content)
+                stats["clean_seconds"] += time.perf_counter() - start
+                stats["cleaned"] += 1
+            if not text:
+                continue
+            tokens = count_tokens(text)
+            if group and group_tokens + tokens > self.target_tokens:
+                yield self._merged_chunk(group, key, base)
+                group, group_tokens = [], 0
+            if tokens > self.target_tokens:
+                yield from self._split_chunks(text, tokens, first_location + i, key, base)
+                continue
+            group.append((first_location + i, text))
+            group_tokens += tokens
+        if group:
+            yield self._merged_chunk(group, key, base)
+
+    def _merged_chunk(self, group, key, base):
+        metadata = {**base, key: group[0][0]}
+        if len(group) > 1:
+            metadata["last_" + key] = group[-1][0]
+        return {"text": "\n".join(text for _, text in group), "metadata": metadata}
+
+    def _split_chunks(self, text, tokens, location, key, base):
+        # windows of words sized from the average tokens per word of the slide, so the slide is
+        # tokenized once rather than once per window
+        words = text.split(" ")
+        tokens_per_word = tokens / len(words)
+        window = max(1, int(self.target_tokens / tokens_per_word))
+        step = max(1, window - int(self.overlap_tokens / tokens_per_word))
+        for chunk_index, start in enumerate(range(0, len(words), step)):
+            yield {"text": " ".join(words[start:start + window]),
+                   "metadata": {**base, key: location, "chunk_index": chunk_index}}
+            if start + window >= len(words):
+                break
@@ -0,0 +1,306 @@
+'''
+This module contains the QuantizedIndex class, a compressed copy of the vectors of the store that
+is kept in memory and scanned instead of the float32 matrix. The top candidates of the scan (a
+shortlist of a few hundred rows) are then re-ranked exactly against the memory-mapped float32
+matrix, so only those pages of it are read.
+
+Modes (bytes per 1536-dim vector, float32 needs 6144):
+ - float16: half precision copy (3072 bytes). Nearly lossless, but numpy converts float16 slowly,
+   so the scan is slower than with the other modes
+ - int8: every vector scaled by max(|x|) / 127 and rounded (1536 + 4 bytes)
+ - pq: product quantization, the vector is split in m sub-vectors and every sub-vector is
+   replaced by the id of the nearest of 256 centroids (m bytes, m = dim / 16 by default: 96)
+
+Run this module directly to print memory per vector and recall@k against exact search:
+    python -m src.quantization --store vector_store
+'''
+import argparse
+import json
+import time
+import numpy as np
+
+from .vectorSearch import normalize_rows, top_k_indices
+
+MODES = ("float16", "int8", "pq")
+# rows decoded at once while scanning the codes (a ~4MB float32 buffer stays in the CPU cache)
+SCAN_BYTES = 4 * 1024 * 1024
+
+
+def _kmeans(points, k, iterations, rng):
+    centroids = points[rng.choice(points.shape[0], size=k, replace=False)].copy()
+    for _ in range(iterations):
+        # |p - c|^2 without the |p|^2 term, which doesn't change the nearest centroid
+        labels = np.argmin((centroids ** 2).sum(1) - 2 * points @ centroids.T, axis=1)
+        counts = np.bincount(labels, minlength=k)
+        sums = np.stack([np.bincount(labels, weights=points[:, d], minlength=k) for d in range(points.shape[1])], axis=1)
+        non_empty = counts > 0
+        centroids[non_empty] = sums[non_empty] / counts[non_empty, None]
+        # re-seed empty clusters with random points
+        empty = np.flatnonzero(~non_empty)
+        centroids[empty] = points[rng.choice(points.shape[0], size=len(empty))]
+    return centroids
+
+
+class Float16Codec():
+    mode = "float16"
+
+    def __init__(self, dim):
+        self.dim = dim
+        # float32 values decoded per row while scanning
+        self.scan_width = dim
+
+    def bytes_per_vector(self):
+        return 2 * self.dim
+
+    def encode(self, vectors):
+        return {"codes": np.asarray(vectors, dtype=np.float16)}
+
+    def scores(self, data, query, rows):
+        return data["codes"][rows].astype(np.float32) @ query
+
+    def params(self):
+        return {}
+
+
+class Int8Codec():
+    mode = "int8"
+
+    def __init__(self, dim):
+        self.dim = dim
+        self.scan_width = dim
+
+    def bytes_per_vector(self):
+        return self.dim + 4
+
+    def encode(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+        return {"codes": codes, "scales": scales.astype(np.float32)}
+
+    def scores(self, data, query, rows):
+        return (data["codes"][rows].astype(np.float32) @ query) * data["scales"][rows]
+
+    def params(self):
+        return {}
+
+
+class PQCodec():
+    mode = "pq"
+
+    def __init__(self, dim, centroids):
+        '''
+        centroids: (m, k, dim / m) array, the codebook of every sub-vector (k <= 256 centroids)
+        '''
+        self.dim = dim
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.m = self.centroids.shape[0]
+        self.sub_dim = dim // self.m
+        self.scan_width = self.m
+
+    @classmethod
+    def train(cls, matrix, m=None, iterations=10, max_training_points=10000, seed=0):
+        dim = matrix.shape[1]
+        if m is None:
+            m = max(1, dim // 16)
+        if dim % m:
+            raise ValueError(f"The dimension {dim} is not divisible by the number of sub-vectors {m}")
+        rng = np.random.default_rng(seed)
+        n = matrix.shape[0]
+        sample = np.asarray(matrix[np.sort(rng.choice(n, size=min(n, max_training_points), replace=False))],
+                            dtype=np.float32)
+        # fewer centroids than training rows would leave some of them unset, and encode would pick them
+        k = min(256, sample.shape[0])
+        sub_dim = dim // m
+        centroids = np.empty((m, k, sub_dim), dtype=np.float32)
+        for j in range(m):
+            centroids[j] = _kmeans(sample[:, j * sub_dim:(j + 1) * sub_dim], k, iterations, rng)
+        return cls(dim, centroids)
+
+    def bytes_per_vector(self):
+        return self.m
+
+    def encode(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        codes = np.empty((vectors.shape[0], self.m), dtype=np.uint8)
+        norms = (self.centroids ** 2).sum(axis=2)
+        for j in range(self.m):
+            sub = vectors[:, j * self.sub_dim:(j + 1) * self.sub_dim]
+            codes[:, j] = np.argmin(norms[j] - 2 * sub @ self.centroids[j].T, axis=1)
+        return {"codes": codes}
+
+    def scores(self, data, query, rows):
+        # inner product = sum over the sub-vectors of <query part, centroid>, read from a lookup table
+        table = np.einsum("jkd,jd->jk", self.centroids, query.reshape(self.m, self.sub_dim))
+        codes = data["codes"][rows]
+        return table[np.arange(self.m), codes].sum(axis=1)
+
+    def params(self):
+        return {"centroids": self.centroids}
+
+
+class QuantizedIndex():
+    def __init__(self, codec, data=None, shortlist=100):
+        '''
+        shortlist: minimum number of candidates re-ranked exactly (at least 10 * top_k)
+        '''
+        self.codec = codec
+        self.data = data or {key: value[:0] for key, value in codec.encode(np.zeros((0, codec.dim))).items()}
+        self.shortlist = shortlist
+
+    @property
+    def mode(self):
+        return self.codec.mode
+
+    def __len__(self):
+        return self.data["codes"].shape[0]
+
+    @classmethod
+    def train(cls, matrix, mode="int8", pq_subvectors=None, shortlist=100):
+        '''
+        Create the index for a mode ("float16", "int8" or "pq") and encode every row of the
+        normalized matrix
+        '''
+        dim = matrix.shape[1]
+        if mode == "float16":
+            codec = Float16Codec(dim)
+        elif mode == "int8":
+            codec = Int8Codec(dim)
+        elif mode == "pq":
+            codec = PQCodec.train(matrix, m=pq_subvectors)
+        else:
+            raise ValueError(f"Unknown quantization mode {mode}, use one of {', '.join(MODES)}")
+        index = cls(codec, shortlist=shortlist)
+        index.add(matrix)
+        return index
+
+    def add(self, vectors, batch_size=65536):
+        '''
+        Encode new rows (appended after the rows already encoded)
+        '''
+        parts = [self.data]
+        for i in range(0, len(vectors), batch_size):
+            parts.append(self.codec.encode(np.asarray(vectors[i:i+batch_size], dtype=np.float32)))
+        if len(parts) > 1:
+            self.data = {key: np.concatenate([part[key] for part in parts]) for key in self.data}
+
+    def memory_bytes(self):
+        return sum(value.nbytes for value in self.data.values()) + sum(
+            value.nbytes for value in self.codec.params().values())
+
+    def approximate_scores(self, query, rows=None):
+        '''
+        Scores of the normalized query against the compressed rows (every row if rows is None)
+        '''
+        n = len(self) if rows is None else len(rows)
+        batch_size = max(1, SCAN_BYTES // (4 * self.codec.scan_width))
+        scores = np.empty(n, dtype=np.float32)
+        for i in range(0, n, batch_size):
+            batch = slice(i, min(i + batch_size, n)) if rows is None else rows[i:i+batch_size]
+            scores[i:i+batch_size] = self.codec.scores(self.data, query, batch)
+        return scores
+
+    def search(self, matrix, query_embedding, top_k=10, exclude=None, rows=None):
+        '''
+        Top_k rows of the normalized matrix for the query: scan the compressed vectors, then
+        re-rank the shortlist exactly. Returns (rows, scores) like IVFIndex.search.
+        '''
+        query = normalize_rows(query_embedding)[0]
+        if rows is not None:
+            rows = np.asarray(rows, dtype=np.int64)
+            if exclude is not None:
+                rows = rows[~exclude[rows]]
+        scores = self.approximate_scores(query, rows)
+        if exclude is not None and rows is None:
+            scores[exclude[:len(scores)]] = -np.inf
+        candidates = top_k_indices(scores, max(self.shortlist, 10 * top_k))
+        candidates = candidates[np.isfinite(scores[candidates])]
+        if rows is not None:
+            candidates = rows[candidates]
+        candidates = np.sort(candidates)  # read the memory map in order
+        exact = np.asarray(matrix[candidates]) @ query
+        best = top_k_indices(exact, top_k)
+        return candidates[best], exact[best]
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            np.savez(f, mode=self.mode, dim=self.codec.dim, shortlist=self.shortlist,
+                     **{f"data_{key}": value for key, value in self.data.items()},
+                     **{f"param_{key}": value for key, value in self.codec.params().items()})
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as npz:
+            mode, dim = str(npz["mode"]), int(npz["dim"])
+            if mode == "float16":
+                codec = Float16Codec(dim)
+            elif mode == "int8":
+                codec = Int8Codec(dim)
+            else:
+                codec = PQCodec(dim, npz["param_centroids"])
+            data = {key[len("data_"):]: npz[key] for key in npz.files if key.startswith("data_")}
+            return cls(codec, data, shortlist=int(npz["shortlist"]))
+
+
+def quantization_report(matrix, queries, top_k=10, modes=MODES, pq_subvectors=None, shortlist=100):
+    '''
+    Memory per vector, recall@top_k and mean latency of every mode, compared with exact search
+    over the same normalized matrix
+    '''
+    queries = normalize_rows(queries)
+    exact = []
+    start = time.perf_counter()
+    for query in queries:
+        exact.append(set(top_k_indices(np.asarray(matrix) @ query, top_k).tolist()))
+    exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    report = [{"mode": "float32", "bytes_per_vector": 4 * matrix.shape[1], "recall": 1.0, "ms_per_query": exact_ms}]
+    for mode in modes:
+        start = time.perf_counter()
+        index = QuantizedIndex.train(matrix, mode, pq_subvectors=pq_subvectors, shortlist=shortlist)
+        build_seconds = time.perf_counter() - start
+        found = 0
+        start = time.perf_counter()
+        for query, expected in zip(queries, exact):
+            rows, _ = index.search(matrix, query, top_k=top_k)
+            found += len(expected.intersection(rows.tolist()))
+        report.append({
+            "mode": mode,
+            "bytes_per_vector": index.memory_bytes() / max(len(index), 1),
+            "recall": found / (len(queries) * top_k),
+            "ms_per_query": (time.perf_counter() - start) * 1000 / len(queries),
+            "build_seconds": build_seconds
+        })
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory and recall of the quantized vector storage modes")
+    parser.add_argument("--store", help="local vector store directory (synthetic data when omitted)")
+    parser.add_argument("--size", type=int, default=100000, help="number of synthetic vectors")
+    parser.add_argument("--dim", type=int, default=256, help="dimension of synthetic vectors")
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--shortlist", type=int, default=100)
+    parser.add_argument("--pq-subvectors", type=int, default=None)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    if args.store:
+        from .vectorStore import LocalVectorStore
+        matrix = LocalVectorStore(args.store).vectors
+    else:
+        # clustered synthetic data so there is some structure to find
+        centers = rng.normal(size=(max(1, args.size // 100), args.dim))
+        matrix = normalize_rows(centers[rng.integers(0, centers.shape[0], args.size)]
+                                + 0.5 * rng.normal(size=(args.size, args.dim)))
+
+    queries = np.asarray(matrix[rng.choice(matrix.shape[0], size=args.queries)]) + 0.1 * rng.normal(size=(args.queries, matrix.shape[1]))
+    for row in quantization_report(matrix, queries, top_k=args.top_k, pq_subvectors=args.pq_subvectors,
+                                   shortlist=args.shortlist):
+        print(json.dumps(row))
+
+
+if __name__ == "__main__":
+    main()
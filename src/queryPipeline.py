@@ -0,0 +1,244 @@
+'''
+This module contains the QueryPipeline class which answers a question end to end:
+answer cache -> query embedding -> hybrid (vector + keyword) search -> prompt (context packing)
+-> LLM answer.
+answer_many runs the same steps for a batch of questions: one batched embedding request, one
+matrix-matrix scoring pass and concurrent LLM calls, yielding the results as they finish.
+Questions can be scoped with a metadata filter (files, courses, slide range; see metadataIndex.py).
+If the query embedding doesn't arrive within embed_timeout seconds (or the request fails), the
+contexts come from the keyword index alone instead of waiting for it.'''
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed
+
+from .metadataIndex import filter_key
+from .utils.gptService import AnswerStream
+from .utils.tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+NO_CONTEXT_ANSWER = ("I couldn't find any relevant information in your lecture materials. "
+                     "Please upload some lecture files or try a different question.")
+
+
+class QueryPipeline():
+    def __init__(self, embedAndSearch, vectorStore, gptService, answerCache=None, top_k=10, embed_timeout=None):
+        '''
+        embed_timeout: seconds to wait for the query embedding before answering from the keyword
+        index alone (None waits as long as the request takes)
+        '''
+        self.embedAndSearch = embedAndSearch
+        self.vectorStore = vectorStore
+        self.gptService = gptService
+        self.answerCache = answerCache
+        self.top_k = top_k
+        self.embed_timeout = embed_timeout
+        self._executor = ThreadPoolExecutor(max_workers=4) if embed_timeout is not None else None
+
+    def embed_query(self, query):
+        '''
+        The query embedding, or None if it timed out or failed (a timed out request still
+        completes in the background and fills the embedding cache). A store without keyword
+        search has nothing to fall back to: the embedding is waited for and its errors raised.
+        '''
+        if not self.vectorStore.supports_keyword_search:
+            return self.embedAndSearch.embed_query(query)
+        try:
+            if self._executor is None:
+                return self.embedAndSearch.embed_query(query)
+            return self._executor.submit(self.embedAndSearch.embed_query, query).result(timeout=self.embed_timeout)
+        except TimeoutError:
+            logger.warning("Query embedding took more than %ss, using keyword search", self.embed_timeout)
+            tracer.current_span().add(embed_fallback="timeout")
+        except Exception as e:
+            logger.warning("Error embedding query, using keyword search: %s", e)
+            tracer.current_span().add(embed_fallback=type(e).__name__)
+        return None
+
+    def _cache_query(self, query, metadata_filter):
+        # the same question asked in another scope is a different cache entry
+        scope = filter_key(metadata_filter)
+        return f"{query} [scope: {scope}]" if scope else query
+
+    def prepare(self, query, metadata_filter=None):
+        '''
+        Everything before generation. Returns {"answer", "sources", "cached"} when the answer is
+        already known (cache hit or no context), otherwise {"prompt", "sources", "packing", ...}
+        with what is needed to generate and cache the answer.
+        '''
+        index_version = self.vectorStore.index_version
+        if self.answerCache is not None:
+            hit = self.answerCache.lookup_exact(self._cache_query(query, metadata_filter), index_version)
+            if hit:
+                return {**hit, "cached": "exact"}
+
+        query_embedding = self.embed_query(query)
+        if query_embedding is None:
+            contexts = self.embedAndSearch.keyword_search(query, self.vectorStore, top_k=self.top_k,
+                                                          include_embeddings=True, metadata_filter=metadata_filter)
+        else:
+            contexts = self.embedAndSearch.search_by_embedding(query_embedding, self.vectorStore, top_k=self.top_k,
+                                                              include_embeddings=True, query_text=query,
+                                                              metadata_filter=metadata_filter)
+        return self._prepare_prompt(query, query_embedding, contexts, index_version, metadata_filter)
+
+    def _prepare_prompt(self, query, query_embedding, contexts, index_version, metadata_filter):
+        if not contexts:
+            return {"answer": NO_CONTEXT_ANSWER, "sources": [], "cached": None}
+
+        if self.answerCache is not None and query_embedding is not None:
+            hit = self.answerCache.lookup_similar(query_embedding, contexts, index_version)
+            if hit:
+                return {**hit, "cached": "similar"}
+
+        prompt, used_contexts, packing = self.gptService.build_prompt(query, contexts)
+        return {
+            "prompt": prompt,
+            "sources": [context["metadata"] for context in used_contexts],
+            "packing": packing,
+            "cached": None,
+            "query_embedding": query_embedding,
+            "contexts": contexts,
+            "index_version": index_version,
+            "cache_query": self._cache_query(query, metadata_filter)
+        }
+
+    def prepare_many(self, queries, metadata_filter=None):
+        '''
+        prepare for a batch of questions: the questions missing from the answer cache are
+        embedded in batched requests and scored against the store together. Returns
+        (list of prepared dicts, {"embed", "search"} seconds).
+        '''
+        index_version = self.vectorStore.index_version
+        prepared = [None] * len(queries)
+        pending = []
+        for i, query in enumerate(queries):
+            hit = None
+            if self.answerCache is not None:
+                hit = self.answerCache.lookup_exact(self._cache_query(query, metadata_filter), index_version)
+            if hit:
+                prepared[i] = {**hit, "cached": "exact"}
+            else:
+                pending.append(i)
+
+        timings = {"embed": 0.0, "search": 0.0}
+        if not pending:
+            return prepared, timings
+        texts = [queries[i] for i in pending]
+        start = time.perf_counter()
+        try:
+            query_embeddings = self.embedAndSearch.embed_texts(texts)
+        except Exception as e:
+            if not self.vectorStore.supports_keyword_search:
+                raise
+            logger.warning("Error embedding questions, using keyword search: %s", e)
+            tracer.current_span().add(embed_fallback=type(e).__name__)
+            query_embeddings = None
+        timings["embed"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        if query_embeddings is None:
+            query_embeddings = [None] * len(texts)
+            contexts = [self.embedAndSearch.keyword_search(text, self.vectorStore, top_k=self.top_k,
+                                                           include_embeddings=True, metadata_filter=metadata_filter)
+                        for text in texts]
+        else:
+            contexts = self.embedAndSearch.search_many(query_embeddings, self.vectorStore, top_k=self.top_k,
+                                                       include_embeddings=True, queries=texts,
+                                                       metadata_filter=metadata_filter)
+        timings["search"] = time.perf_counter() - start
+
+        for i, query_embedding, query_contexts in zip(pending, query_embeddings, contexts):
+            start = time.perf_counter()
+            prepared[i] = self._prepare_prompt(queries[i], query_embedding, query_contexts, index_version,
+                                               metadata_filter)
+            prepared[i]["prompt_seconds"] = time.perf_counter() - start
+        return prepared, timings
+
+    def answer_many(self, queries, max_concurrency=8, metadata_filter=None):
+        '''
+        Answer a batch of questions, generating at most max_concurrency answers at a time.
+        Yields {"index", "question", "answer", "sources", "cached", "error", "timings"} as the
+        answers finish (not in question order). timings has the batch "embed" and "search"
+        seconds, the "prompt" and "generate" seconds of the question and "total" (seconds since
+        the batch started).
+        '''
+        started = time.perf_counter()
+        prepared, batch_timings = self.prepare_many(queries, metadata_filter)
+
+        def result(i, answer, error=None, generate_seconds=0.0):
+            return {
+                "index": i,
+                "question": queries[i],
+                "answer": answer,
+                "sources": prepared[i]["sources"],
+                "cached": prepared[i]["cached"],
+                "error": error,
+                "timings": {**batch_timings, "prompt": prepared[i].get("prompt_seconds", 0.0),
+                            "generate": generate_seconds, "total": time.perf_counter() - started}
+            }
+
+        to_generate = []
+        for i, item in enumerate(prepared):
+            if "answer" in item:
+                yield result(i, item["answer"])
+            else:
+                to_generate.append(i)
+
+        def generate(i):
+            start = time.perf_counter()
+            answer = self.gptService.generate_answer(prepared[i]["prompt"])
+            self._store(queries[i], prepared[i], answer)
+            return answer, time.perf_counter() - start
+
+        if not to_generate:
+            return
+        with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(to_generate)))) as executor:
+            futures = {executor.submit(generate, i): i for i in to_generate}
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    answer, seconds = future.result()
+                    yield result(i, answer, generate_seconds=seconds)
+                except Exception as e:
+                    logger.warning("Error answering question %d: %s", i, e)
+                    yield result(i, None, error=f"{type(e).__name__}: {e}")
+
+    def _store(self, query, prepared, answer):
+        # an answer built from the keyword results alone (no query embedding) is not cached, so
+        # the question gets a full answer once the embeddings work again
+        if self.answerCache is not None and prepared["query_embedding"] is not None:
+            self.answerCache.store(prepared["cache_query"], prepared["query_embedding"], prepared["contexts"],
+                                   prepared["index_version"], answer, prepared["sources"])
+
+    def answer(self, query, metadata_filter=None):
+        '''
+        Returns {"answer", "sources", "cached", "packing"} where sources is the list of context
+        metadata and cached is "exact", "similar" or None
+        '''
+        with tracer.span("query") as span:
+            prepared = self.prepare(query, metadata_filter)
+            span.add(cached=prepared["cached"])
+            if "answer" in prepared:
+                return {**prepared, "packing": None}
+
+            answer = self.gptService.generate_answer(prepared["prompt"])
+            self._store(query, prepared, answer)
+        return {"answer": answer, "sources": prepared["sources"], "cached": None, "packing": prepared["packing"]}
+
+    def answer_stream(self, query, metadata_filter=None):
+        '''
+        Streaming version of answer. Returns {"stream", "sources", "cached", "packing"} where
+        stream is an AnswerStream; the answer is added to the cache once the stream has been consumed.
+        '''
+        with tracer.span("query", stream=True) as span:
+            prepared = self.prepare(query, metadata_filter)
+            span.add(cached=prepared["cached"])
+            if "answer" in prepared:
+                return {"stream": AnswerStream.from_text(prepared["answer"]), "sources": prepared["sources"],
+                        "cached": prepared["cached"], "packing": None}
+
+            # the query span ends before generation, the generate span is recorded under it later
+            stream = self.gptService.stream_answer(prepared["prompt"])
+        stream.on_complete.append(lambda stream: self._store(query, prepared, stream.text))
+        return {"stream": stream, "sources": prepared["sources"], "cached": None, "packing": prepared["packing"]}
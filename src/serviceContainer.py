@@ -0,0 +1,358 @@
+'''
+This module contains the ServiceContainer class which creates every service of the app once per
+process and hands out the same instances afterwards. Streamlit re-runs app.py on every
+interaction; with the container the OpenAI, Pinecone and S3 clients (and their HTTP connection
+pools), the local vector store and the caches survive reruns instead of being rebuilt.
+Services are created on first use, so the heavy client libraries are only imported when the
+code path that needs them runs: e.g. a chat-only session of the app imports neither PyMuPDF nor
+boto3 (unless the S3 file list is shown, or the pinecone backend needs it for the search scope),
+and Pinecone only for the one-time sync of an empty local store.'''
+import os
+import threading
+
+PINECONE_INDEX_NAME = "custom-rag-llm"
+
+
+def config_from_env():
+    '''
+    Configuration of the services, read from the environment
+    '''
+    vector_store_dir = os.getenv("VECTOR_STORE_DIR", "vector_store")
+    return {
+        "pinecone_index_name": os.getenv("PINECONE_INDEX_NAME", PINECONE_INDEX_NAME),
+        # index searched by the queries: "local" (memory-mapped copy of the Pinecone index, hybrid
+        # search) or "pinecone" (server-side top-k and filtering, nothing stored locally)
+        "vector_backend": os.getenv("VECTOR_BACKEND", "local"),
+        "vector_store_dir": vector_store_dir,
+        "embedding_cache_path": os.getenv("EMBEDDING_CACHE_PATH", "cache/embeddings.sqlite3"),
+        "answer_cache_path": os.getenv("ANSWER_CACHE_PATH", "cache/answers.sqlite3"),
+        "answer_cache_threshold": float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95")),
+        # Switch from exact to approximate (IVF) search once the store holds this many vectors
+        "ann_min_vectors": int(os.getenv("ANN_MIN_VECTORS", "100000")),
+        "ann_nprobe": int(os.getenv("ANN_NPROBE", "8")),
+        # "float16", "int8" or "pq" to search compressed vectors (exactly re-ranked), empty for float32
+        "vector_quantization": os.getenv("VECTOR_QUANTIZATION", ""),
+        "pq_subvectors": int(os.getenv("PQ_SUBVECTORS", "0")) or None,
+        "rerank_shortlist": int(os.getenv("RERANK_SHORTLIST", "100")),
+        "context_token_budget": int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000")),
+        # chunk size: small slides are merged up to it, longer ones split in parts overlapping by the overlap
+        "chunk_target_tokens": int(os.getenv("CHUNK_TARGET_TOKENS", "300")),
+        "chunk_overlap_tokens": int(os.getenv("CHUNK_OVERLAP_TOKENS", "40")),
+        # answers generated at the same time by batch question answering (src/batchQuestions.py)
+        "batch_concurrency": int(os.getenv("BATCH_CONCURRENCY", "8")),
+        # seconds to wait for the query embedding before answering from the keyword index alone
+        "embed_timeout": float(os.getenv("EMBED_TIMEOUT", "5")),
+        # seconds before the search / the answer generation of an async query is abandoned
+        "search_timeout": float(os.getenv("SEARCH_TIMEOUT", "10")),
+        "generate_timeout": float(os.getenv("GENERATE_TIMEOUT", "60")),
+        "index_manifest_path": os.getenv("INDEX_MANIFEST_PATH", os.path.join(vector_store_dir, "manifest.json")),
+        "ingest_queue_path": os.getenv("INGEST_QUEUE_PATH", "cache/ingest_jobs.sqlite3"),
+        "ingest_spool_dir": os.getenv("INGEST_SPOOL_DIR", "cache/ingest_spool"),
+        # files ingested at the same time by the background ingestion queue
+        "ingest_workers": int(os.getenv("INGEST_WORKERS", "2")),
+        # processes parsing documents, shared by all the ingestion jobs
+        "parse_workers": int(os.getenv("PARSE_WORKERS", "0")) or os.cpu_count() or 1,
+        "s3_catalogue_path": os.getenv("S3_CATALOGUE_PATH", "cache/s3_catalogue.json"),
+        # seconds before the S3 catalogue lists the bucket again
+        "s3_catalogue_max_age": float(os.getenv("S3_CATALOGUE_MAX_AGE", "300")),
+    }
+
+
+class ServiceContainer():
+    def __init__(self, config=None, openai_client=None, pinecone_client=None, s3_client=None,
+                 async_openai_client=None):
+        '''
+        config: overrides of config_from_env(). The clients can be injected (e.g. the stand-ins
+        of benchmarks.fakes), otherwise they are created on first use.
+        '''
+        self.config = {**config_from_env(), **(config or {})}
+        self._services = {}
+        self._lock = threading.RLock()
+        if openai_client is not None:
+            self._services["openai_client"] = openai_client
+        if pinecone_client is not None:
+            self._services["pinecone_client"] = pinecone_client
+        if s3_client is not None:
+            self._services["s3_client"] = s3_client
+        if async_openai_client is not None:
+            self._services["async_openai_client"] = async_openai_client
+
+    def _get(self, name, factory):
+        service = self._services.get(name)
+        if service is None:
+            with self._lock:
+                service = self._services.get(name)
+                if service is None:
+                    service = factory()
+                    self._services[name] = service
+        return service
+
+    def created(self):
+        '''
+        Names of the services created so far
+        '''
+        return sorted(self._services)
+
+    # Clients
+
+    @property
+    def openai_client(self):
+        def create():
+            from openai import OpenAI
+            return OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        return self._get("openai_client", create)
+
+    @property
+    def pinecone_client(self):
+        def create():
+            from pinecone import Pinecone
+            return Pinecone(api_key=os.getenv("PINECONE_API_KEY"), environment="us-east1-aws")
+        return self._get("pinecone_client", create)
+
+    @property
+    def s3_client(self):
+        def create():
+            import boto3
+            return boto3.client(
+                's3',
+                aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
+                aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+                region_name=os.getenv("AWS_DEFAULT_REGION")
+            )
+        return self._get("s3_client", create)
+
+    # Services
+
+    @property
+    def ingesterAndParser(self):
+        '''
+        Parser with a process pool shared by the ingestion jobs of the process. Its workers are
+        spawned rather than forked from the (multithreaded) Streamlit server, and only started
+        when a file is parsed.
+        '''
+        def create():
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            from .ingestAndParse import IngesterAndParser
+            spawn = multiprocessing.get_context("spawn")
+            return IngesterAndParser(
+                executor_factory=lambda max_workers: ProcessPoolExecutor(max_workers=max_workers, mp_context=spawn),
+                max_workers=self.config["parse_workers"])
+        return self._get("ingesterAndParser", create)
+
+    @property
+    def textPreprocesser(self):
+        def create():
+            from .preprocessAndChunk import TextPreprocesser
+            return TextPreprocesser(target_tokens=self.config["chunk_target_tokens"],
+                                    overlap_tokens=self.config["chunk_overlap_tokens"])
+        return self._get("textPreprocesser", create)
+
+    @property
+    def embeddingCache(self):
+        def create():
+            from .embeddingCache import EmbeddingCache
+            return EmbeddingCache(self.config["embedding_cache_path"])
+        return self._get("embeddingCache", create)
+
+    @property
+    def embedAndSearch(self):
+        def create():
+            from .embedAndSearch import EmbedAndSearch
+            # the async client (AsyncOpenAI unless injected) is only created when an async method runs
+            return EmbedAndSearch(client=self.openai_client, cache=self.embeddingCache,
+                                  async_client=self._services.get("async_openai_client"))
+        return self._get("embedAndSearch", create)
+
+    @property
+    def gptService(self):
+        def create():
+            from .utils.gptService import GPTService
+            from .contextPacker import ContextPacker
+            return GPTService(client=self.openai_client,
+                              context_packer=ContextPacker(token_budget=self.config["context_token_budget"]),
+                              async_client=self._services.get("async_openai_client"))
+        return self._get("gptService", create)
+
+    @property
+    def pineconeService(self):
+        def create():
+            from .utils.pineconeService import PineConeService
+            return PineConeService(pc=self.pinecone_client)
+        return self._get("pineconeService", create)
+
+    def pinecone_index(self):
+        '''
+        Name of the Pinecone index, created (or checked) only the first time it is needed
+        '''
+        name = self.config["pinecone_index_name"]
+        self._get("pinecone_index", lambda: self.pineconeService.initialize_index(name))
+        return name
+
+    @property
+    def s3processor(self):
+        def create():
+            from .utils.awsService import S3DocumentProcessor
+            return S3DocumentProcessor(s3=self.s3_client)
+        return self._get("s3processor", create)
+
+    @property
+    def documentCatalogue(self):
+        def create():
+            from .documentCatalogue import DocumentCatalogue
+            return DocumentCatalogue(self.s3processor, self.config["s3_catalogue_path"],
+                                     max_age=self.config["s3_catalogue_max_age"])
+        return self._get("documentCatalogue", create)
+
+    @property
+    def vectorStore(self):
+        def create():
+            from .vectorStore import LocalVectorStore
+            return LocalVectorStore(self.config["vector_store_dir"], ann_min_vectors=self.config["ann_min_vectors"],
+                                    nprobe=self.config["ann_nprobe"], quantization=self.config["vector_quantization"],
+                                    pq_subvectors=self.config["pq_subvectors"], shortlist=self.config["rerank_shortlist"])
+        return self._get("vectorStore", create)
+
+    @property
+    def vectorBackend(self):
+        '''
+        The VectorStore the queries search, chosen by the vector_backend setting
+        '''
+        def create():
+            backend = self.config["vector_backend"]
+            if backend == "local":
+                return self.vectorStore
+            if backend == "pinecone":
+                from .pineconeVectorStore import PineconeVectorStore
+                return PineconeVectorStore(self.pineconeService, self.pinecone_index())
+            raise ValueError(f"Unknown vector backend {backend!r}, expected 'local' or 'pinecone'")
+        return self._get("vectorBackend", create)
+
+    @property
+    def indexManifest(self):
+        def create():
+            from .indexManifest import IndexManifest
+            return IndexManifest(self.config["index_manifest_path"])
+        return self._get("indexManifest", create)
+
+    @property
+    def answerCache(self):
+        def create():
+            from .answerCache import AnswerCache
+            return AnswerCache(self.config["answer_cache_path"],
+                               similarity_threshold=self.config["answer_cache_threshold"])
+        return self._get("answerCache", create)
+
+    @property
+    def queryPipeline(self):
+        def create():
+            from .queryPipeline import QueryPipeline
+            return QueryPipeline(self.embedAndSearch, self.vectorBackend, self.gptService, answerCache=self.answerCache,
+                                 embed_timeout=self.config["embed_timeout"])
+        return self._get("queryPipeline", create)
+
+    @property
+    def asyncQueryPipeline(self):
+        def create():
+            from .asyncQueryPipeline import AsyncQueryPipeline
+            return AsyncQueryPipeline(self.queryPipeline, timeouts={
+                "embed": self.config["embed_timeout"],
+                "search": self.config["search_timeout"],
+                "generate": self.config["generate_timeout"]
+            })
+        return self._get("asyncQueryPipeline", create)
+
+    @property
+    def eventLoop(self):
+        '''
+        Event loop thread shared by every session of the process (runs asyncQueryPipeline)
+        '''
+        def create():
+            from .asyncQueryPipeline import EventLoopThread
+            return EventLoopThread()
+        return self._get("eventLoop", create)
+
+    @property
+    def ingestQueue(self):
+        def create():
+            from .ingestQueue import IngestQueue
+            return IngestQueue(self.config["ingest_queue_path"], self.config["ingest_spool_dir"], self.ingest_file,
+                               max_workers=self.config["ingest_workers"])
+        return self._get("ingestQueue", create)
+
+    def upload_embeddings(self, embeddings):
+        '''
+        Index embeddings in Pinecone, and in the local vector store with the local backend
+        '''
+        if self.config["vector_backend"] == "pinecone":
+            self.vectorBackend.upsert(embeddings)
+            return
+        self.pineconeService.upload_embeddings(self.pinecone_index(), embeddings, raise_on_error=True)
+        self.vectorStore.upsert(embeddings)
+
+    def remove_embeddings(self, ids):
+        '''
+        Remove vectors from Pinecone, and from the local vector store with the local backend
+        '''
+        if self.config["vector_backend"] == "pinecone":
+            self.vectorBackend.delete(ids)
+            return
+        # raises if Pinecone fails, so the manifest keeps the ids and the delete is tried again
+        self.pineconeService.delete_embeddings(self.pinecone_index(), ids, raise_on_error=True)
+        self.vectorStore.delete(ids)
+
+    def ingest_file(self, file_path, on_progress=None):
+        '''
+        Upload a file to S3 (skipped if unchanged) and index its new or changed chunks. Returns
+        the report of IngestPipeline. on_progress(stage, report) is called along the way.
+        '''
+        from .ingestPipeline import IngestPipeline
+        if on_progress:
+            on_progress("uploading", {})
+        reports = self.documentCatalogue.upload([file_path])
+        if not reports or not reports[0]["ok"]:
+            raise RuntimeError(f"Error uploading {os.path.basename(file_path)} to S3: "
+                               f"{reports[0]['error'] if reports else 'unsupported file'}")
+        pipeline = IngestPipeline(self.ingesterAndParser, self.textPreprocesser, self.embedAndSearch,
+                                  self.upload_embeddings, manifest=self.indexManifest, on_removed=self.remove_embeddings,
+                                  on_progress=(lambda path, status, report: on_progress(status, report)) if on_progress else None)
+        return pipeline.run([file_path])[file_path]
+
+    def sync_vector_store(self):
+        '''
+        Populate an empty local store from the existing Pinecone index, once per process (nothing
+        to do with the pinecone backend)
+        '''
+        def sync():
+            if self.config["vector_backend"] == "local" and len(self.vectorStore) == 0:
+                self.pineconeService.export_embeddings(self.config["pinecone_index_name"], self.vectorStore)
+            return True
+        self._get("vector_store_synced", sync)
+
+    def list_files(self, refresh=False):
+        '''
+        Files in the S3 bucket, from the document catalogue (the bucket is only listed again
+        once the catalogue is older than s3_catalogue_max_age, or with refresh=True)
+        '''
+        if refresh:
+            try:
+                self.documentCatalogue.refresh(force=True)
+            except Exception as e:
+                print(f"Error listing files in S3: {e}")
+        return self.documentCatalogue.files()
+
+
+_container = None
+_container_lock = threading.Lock()
+
+
+def get_services():
+    '''
+    The process-wide ServiceContainer
+    '''
+    global _container
+    if _container is None:
+        with _container_lock:
+            if _container is None:
+                _container = ServiceContainer()
+    return _container
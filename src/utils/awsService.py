@@ -1,83 +1,138 @@
 '''
 This module contains the S3DocumentProcessor class which is responsible for uploading files to S3, listing files in S3.
+Uploads run concurrently and large files are sent as multipart uploads; listings page through
+the whole bucket (list_objects_v2 returns at most 1000 keys per call).
 '''
 
-import boto3
+import io
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 import dotenv
-import io
-from pptx import Presentation
 
 dotenv.load_dotenv()
 
+SUPPORTED_EXTENSIONS = ('.pptx', '.pdf')
+# Files larger than MULTIPART_THRESHOLD are uploaded in parts of MULTIPART_CHUNKSIZE bytes
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+
+
 class S3DocumentProcessor:
-    def __init__(self):
-        # Initialize AWS session
-        self.s3 = boto3.client(
-            's3',
-            aws_access_key_id= os.getenv("AWS_ACCESS_KEY_ID"),
-            aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
-            region_name=os.getenv("AWS_DEFAULT_REGION")
-        )
-        self.bucket_name = "custom-rag-llm"
-    
+    def __init__(self, s3=None, bucket_name="custom-rag-llm", max_workers=8,
+                 multipart_threshold=MULTIPART_THRESHOLD, multipart_chunksize=MULTIPART_CHUNKSIZE):
+        # Initialize AWS session (an S3 client stand-in can be passed for tests and benchmarks)
+        if s3 is None:
+            import boto3
+            s3 = boto3.client(
+                's3',
+                aws_access_key_id= os.getenv("AWS_ACCESS_KEY_ID"),
+                aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+                region_name=os.getenv("AWS_DEFAULT_REGION")
+            )
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.max_workers = max_workers
+        self.multipart_threshold = multipart_threshold
+        self.multipart_chunksize = multipart_chunksize
+        self._transfer_config = None
+
+    def transfer_config(self):
+        '''
+        boto3 TransferConfig: multipart above the threshold, parts of one file sent in parallel
+        '''
+        if self._transfer_config is None:
+            from boto3.s3.transfer import TransferConfig
+            self._transfer_config = TransferConfig(multipart_threshold=self.multipart_threshold,
+                                                   multipart_chunksize=self.multipart_chunksize,
+                                                   max_concurrency=4)
+        return self._transfer_config
+
+    def _upload(self, file, s3_key):
+        # file is a local path or a file object (e.g. a Streamlit UploadedFile)
+        if hasattr(file, "read"):
+            # upload_fileobj closes the file it is given, upload a copy so the caller can still parse it
+            file.seek(0)
+            data = io.BytesIO(file.read())
+            file.seek(0)
+            self.s3.upload_fileobj(data, self.bucket_name, s3_key, Config=self.transfer_config())
+        else:
+            self.s3.upload_file(file, self.bucket_name, s3_key, Config=self.transfer_config())
+
     def upload_file_to_s3(self, file):
         """
         Upload one file  to S3 bucket
         """
         try:
-            print(f'Uploading {file.name} to S3...\n')
-            uploaded_files = []
-
-            if file.name.endswith(('.pptx', '.pdf')):
-                s3_key = file.name
-                self.s3.upload_fileobj(file, self.bucket_name, s3_key)
-                uploaded_files.append(s3_key)
-            
-            print(f"Uploaded {file.name} successfully")
+            if not file.name.endswith(SUPPORTED_EXTENSIONS):
+                print(f"Unsupported file format: {file.name}")
+                return None
+
+            s3_key = file.name
+            self._upload(file, s3_key)
             return s3_key
 
-                    
         except Exception as e:
             print(f"Error uploading file to S3: {e}")
-    
+
+    def upload_files(self, files, s3_prefix='', max_workers=None):
+        """
+        Upload files (local paths or file objects) concurrently. Returns one report per file
+        {"key", "size", "ok", "error", "seconds"}
+        """
+        def upload(file):
+            name = os.path.basename(getattr(file, "name", file))
+            s3_key = f"{s3_prefix.rstrip('/')}/{name}" if s3_prefix else name
+            size = getattr(file, "size", None)
+            if size is None and not hasattr(file, "read"):
+                size = os.path.getsize(file)
+            start = time.perf_counter()
+            error = None
+            try:
+                self._upload(file, s3_key)
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+                print(f"Error uploading {name} to S3: {error}")
+            return {"key": s3_key, "size": size, "ok": error is None, "error": error,
+                    "seconds": time.perf_counter() - start}
+
+        files = [file for file in files if getattr(file, "name", file).endswith(SUPPORTED_EXTENSIONS)]
+        if not files:
+            return []
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers or self.max_workers, len(files)))) as executor:
+            return list(executor.map(upload, files))
+
     def upload_to_s3(self, local_directory, s3_prefix=''):
         """
         Upload all files from a local directory to S3 bucket
         """
-        try:
-            print('Uploading files to S3...\n')
-            uploaded_files = []
-            
-            for filename in os.listdir(local_directory):
-                if filename.endswith(('.pptx', '.pdf')):
-                    local_path = os.path.join(local_directory, filename)
-                    s3_key = os.path.join(s3_prefix, filename) if s3_prefix else filename
-                    
-                    print(f"Uploading {filename} to S3...")
-                    self.s3.upload_file(local_path, self.bucket_name, s3_key)
-                    uploaded_files.append(s3_key)
-                    print(f"Uploaded {filename} successfully")
-        except Exception as e:
-            print(f"Error uploading files to S3: {e}")
-        
-        return uploaded_files
-    
+        file_paths = [os.path.join(local_directory, filename) for filename in sorted(os.listdir(local_directory))]
+        return [report["key"] for report in self.upload_files(file_paths, s3_prefix) if report["ok"]]
+
+    def iter_objects(self, prefix=''):
+        """
+        Yield {"Key", "ETag", "Size", ...} for every supported file under prefix, one page of
+        up to 1000 keys at a time
+        """
+        paginator = self.s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+            for item in page.get("Contents", []):
+                if item["Key"].endswith(SUPPORTED_EXTENSIONS):
+                    yield item
+
+    def head(self, s3_key):
+        """
+        {"etag", "size"} of an object
+        """
+        response = self.s3.head_object(Bucket=self.bucket_name, Key=s3_key)
+        return {"etag": response["ETag"].strip('"'), "size": response["ContentLength"]}
+
     def list_files(self, prefix=''):
         """
         List all files in the S3 bucket with the given prefix
         """
         try:
-            response = self.s3.list_objects_v2(
-                Bucket=self.bucket_name,
-                Prefix=prefix
-            )
-            
-            if 'Contents' not in response:
-                return []
-            
-            return [item['Key'] for item in response['Contents'] 
-                    if item['Key'].endswith(('.pptx', '.pdf'))]
+            return [item['Key'] for item in self.iter_objects(prefix)]
         except Exception as e:
             print(f"Error listing files in S3: {e}")
-    
\ No newline at end of file
+            return []
@@ -1,20 +1,161 @@
 '''
 This module contains the GPTService class which is responsible for interacting with the OpenAI API 
 to generate answers to questions based on provided contexts and to build the prompt based on context'''
+import asyncio
 import os 
-from openai import OpenAI
+import time
+from types import SimpleNamespace
 import dotenv
 
+from ..contextPacker import format_context
+from .tracing import tracer
+
 dotenv.load_dotenv()
 
+
+class AnswerStream():
+    '''
+    Iterates over the text deltas of a streamed chat completion and records the latency the user
+    sees: time to first token and tokens per second. Functions in on_complete are called with the
+    stream once it is fully consumed.
+    '''
+    def __init__(self, chunks, started=None):
+        self._chunks = chunks
+        self.started = started if started is not None else time.perf_counter()
+        self.first_token_at = None
+        self.finished_at = None
+        self.text = ""
+        self.completion_tokens = None
+        self._deltas = 0
+        self.on_complete = []
+
+    @classmethod
+    def from_text(cls, text):
+        '''
+        Stream of an already known answer (e.g. from the answer cache)
+        '''
+        chunk = SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))], usage=None)
+        return cls(iter([chunk]))
+
+    def _delta(self, chunk):
+        # text of a chunk (None for chunks without text, e.g. the final usage chunk)
+        if getattr(chunk, "usage", None) is not None:
+            self.completion_tokens = chunk.usage.completion_tokens
+        if not chunk.choices:
+            return None
+        delta = chunk.choices[0].delta.content
+        if not delta:
+            return None
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        self.text += delta
+        self._deltas += 1
+        return delta
+
+    def _finish(self):
+        self.finished_at = time.perf_counter()
+        for callback in self.on_complete:
+            callback(self)
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            delta = self._delta(chunk)
+            if delta:
+                yield delta
+        self._finish()
+
+    @property
+    def stats(self):
+        '''
+        {"time_to_first_token", "total_seconds", "tokens", "tokens_per_second"} (None until known)
+        '''
+        tokens = self.completion_tokens if self.completion_tokens is not None else self._deltas
+        ttft = None if self.first_token_at is None else self.first_token_at - self.started
+        total = None if self.finished_at is None else self.finished_at - self.started
+        generation = None if total is None or ttft is None else self.finished_at - self.first_token_at
+        return {
+            "time_to_first_token": ttft,
+            "total_seconds": total,
+            "tokens": tokens,
+            "tokens_per_second": tokens / generation if generation else None
+        }
+
+
+class AsyncAnswerStream(AnswerStream):
+    '''
+    AnswerStream over the chunks of an async streamed chat completion (async for delta in stream).
+    With token_timeout, waiting more than token_timeout seconds for the next chunk raises
+    asyncio.TimeoutError and closes the response.
+    '''
+    def __init__(self, chunks, started=None, token_timeout=None):
+        super().__init__(chunks, started=started)
+        self.token_timeout = token_timeout
+
+    @classmethod
+    def from_text(cls, text):
+        chunk = SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))], usage=None)
+
+        async def chunks():
+            yield chunk
+        return cls(chunks())
+
+    async def __aiter__(self):
+        chunks = self._chunks.__aiter__()
+        try:
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), self.token_timeout)
+                except StopAsyncIteration:
+                    break
+                delta = self._delta(chunk)
+                if delta:
+                    yield delta
+        except BaseException:
+            # cancelled, timed out or abandoned by the consumer: close the HTTP response
+            close = getattr(self._chunks, "close", None) or getattr(self._chunks, "aclose", None)
+            if close is not None:
+                await close()
+            raise
+        self._finish()
+
+
 class GPTService():
-    def __init__(self):
-        self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-        pass
+    def __init__(self, client=None, context_packer=None, async_client=None):
+        '''
+        context_packer: optional ContextPacker limiting the tokens used by the contexts
+        async_client: client for the *_async methods (an AsyncOpenAI is created on first use if None)
+        '''
+        if client is None:
+            from openai import OpenAI
+            client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        self.client = client
+        self.context_packer = context_packer
+        self._async_client = async_client
+
+    @property
+    def async_client(self):
+        if self._async_client is None:
+            from openai import AsyncOpenAI
+            self._async_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        return self._async_client
 
 
 
     def construct_prompt(self, query, contexts):
+        return self.build_prompt(query, contexts)[0]
+
+    def build_prompt(self, query, contexts):
+        '''
+        Build the prompt, packing the contexts into the token budget of the context packer (if
+        any). Returns (prompt, contexts used, packing report or None).
+        '''
+        with tracer.span("prompt") as span:
+            prompt, contexts, report = self._build_prompt(query, contexts)
+            span.add(items=len(contexts), bytes=len(prompt.encode("utf-8")),
+                     tokens=report["tokens_used"] if report else 0)
+        return prompt, contexts, report
+
+    def _build_prompt(self, query, contexts):
         prompt = """You are an educational assistant that helps students understand lecture material. 
         You will be given a question and relevant context from lecture slides and materials.
         Please answer the question based on the provided context. If the context doesn't contain 
@@ -23,27 +164,99 @@ class GPTService():
         Relevant lecture materials:
         """
 
+        report = None
+        if self.context_packer is not None:
+            contexts, report = self.context_packer.pack(contexts)
+
         # Add contexts
         for i, context in enumerate(contexts):
-            print(f"CONTEXT OBJECT: {context}")
-            prompt += f"\nContext {i+1} (from {context['metadata']['filename']}):\n{context['text']}\n"
+            prompt += format_context(i, context)
 
         # Add the query
         prompt += f"\nQuestion: {query}\n\nAnswer:"
 
-        return prompt
+        return prompt, contexts, report
 
     def generate_answer(self, prompt):
         '''
         Generate an answer to a question based on a provided prompt
         '''
         # Generate response from GPT-4o model
+        with tracer.span("generate", model="gpt-4o", stream=False) as span:
+            response = self.client.chat.completions.create(model="gpt-4o",
+            messages=[
+                {"role": "system", "content": "You are a helpful educational assistant."},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=0.3,  # Lower temperature for more factual responses
+            max_tokens=1000)
+            usage = getattr(response, "usage", None)
+            span.add(items=1, tokens=usage.completion_tokens if usage is not None else 0)
+
+        return response.choices[0].message.content
+
+    def stream_answer(self, prompt):
+        '''
+        Same as generate_answer but returns an AnswerStream yielding the tokens as they arrive
+        '''
+        started = time.perf_counter()
         response = self.client.chat.completions.create(model="gpt-4o",
         messages=[
             {"role": "system", "content": "You are a helpful educational assistant."},
             {"role": "user", "content": prompt}
         ],
-        temperature=0.3,  # Lower temperature for more factual responses
-        max_tokens=1000)
+        temperature=0.3,
+        max_tokens=1000,
+        stream=True,
+        stream_options={"include_usage": True})
+
+        stream = AnswerStream(response, started=started)
+        if tracer.enabled:
+            # the stream is consumed after this returns, so the span is recorded once it is done
+            parent = tracer.current_span()
+            stream.on_complete.append(lambda stream: tracer.record(
+                "generate", stream.finished_at - stream.started, parent=parent, items=1,
+                tokens=stream.stats["tokens"] or 0, model="gpt-4o", stream=True,
+                time_to_first_token=stream.stats["time_to_first_token"]))
+        return stream
+
+    async def generate_answer_async(self, prompt):
+        '''
+        generate_answer with the async client, the event loop is free while the answer is generated
+        '''
+        with tracer.span("generate", model="gpt-4o", stream=False) as span:
+            response = await self.async_client.chat.completions.create(model="gpt-4o",
+            messages=[
+                {"role": "system", "content": "You are a helpful educational assistant."},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=0.3,
+            max_tokens=1000)
+            usage = getattr(response, "usage", None)
+            span.add(items=1, tokens=usage.completion_tokens if usage is not None else 0)
 
         return response.choices[0].message.content
+
+    async def stream_answer_async(self, prompt, token_timeout=None):
+        '''
+        stream_answer with the async client, returns an AsyncAnswerStream
+        '''
+        started = time.perf_counter()
+        response = await self.async_client.chat.completions.create(model="gpt-4o",
+        messages=[
+            {"role": "system", "content": "You are a helpful educational assistant."},
+            {"role": "user", "content": prompt}
+        ],
+        temperature=0.3,
+        max_tokens=1000,
+        stream=True,
+        stream_options={"include_usage": True})
+
+        stream = AsyncAnswerStream(response, started=started, token_timeout=token_timeout)
+        if tracer.enabled:
+            parent = tracer.current_span()
+            stream.on_complete.append(lambda stream: tracer.record(
+                "generate", stream.finished_at - stream.started, parent=parent, items=1,
+                tokens=stream.stats["tokens"] or 0, model="gpt-4o", stream=True,
+                time_to_first_token=stream.stats["time_to_first_token"]))
+        return stream
@@ -0,0 +1,164 @@
+'''
+This module contains InMemoryIndex and InMemoryPinecone, local stand-ins for a Pinecone index and
+client implementing the subset of the API used by PineConeService (upsert, delete, fetch, query,
+list, describe_index_stats, each in a namespace). They are used for tests and benchmarks, and can inject failures to
+exercise the retry logic.'''
+import json
+import threading
+from types import SimpleNamespace
+import numpy as np
+
+# Pinecone rejects upsert requests larger than 2MB
+MAX_REQUEST_BYTES = 2 * 1024 * 1024
+
+
+def _matches_filter(metadata, filter):
+    '''
+    Evaluate a Pinecone style metadata filter ($eq, $ne, $in, $nin, $gt, $gte, $lt, $lte, $and, $or)
+    '''
+    if not filter:
+        return True
+    for key, condition in filter.items():
+        if key == "$and":
+            if not all(_matches_filter(metadata, sub) for sub in condition):
+                return False
+            continue
+        if key == "$or":
+            if not any(_matches_filter(metadata, sub) for sub in condition):
+                return False
+            continue
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        value = metadata.get(key)
+        for op, expected in condition.items():
+            if op == "$eq" and value != expected:
+                return False
+            if op == "$ne" and value == expected:
+                return False
+            if op == "$in" and value not in expected:
+                return False
+            if op == "$nin" and value in expected:
+                return False
+            if op in ("$gt", "$gte", "$lt", "$lte"):
+                if value is None:
+                    return False
+                if op == "$gt" and not value > expected:
+                    return False
+                if op == "$gte" and not value >= expected:
+                    return False
+                if op == "$lt" and not value < expected:
+                    return False
+                if op == "$lte" and not value <= expected:
+                    return False
+    return True
+
+
+class InMemoryIndex():
+    def __init__(self, dimension=1536, max_request_bytes=MAX_REQUEST_BYTES, failures=0):
+        '''
+        failures: number of upsert calls that fail before the index starts accepting them
+        '''
+        self.dimension = dimension
+        self.max_request_bytes = max_request_bytes
+        self.failures = failures
+        # vectors of the default namespace, and of every namespace by name
+        self.vectors = {}
+        self.namespaces = {"": self.vectors}
+        self.upsert_calls = 0
+        self._lock = threading.Lock()
+
+    def _namespace(self, namespace):
+        return self.namespaces.setdefault(namespace or "", {})
+
+    def upsert(self, vectors, namespace=None):
+        with self._lock:
+            self.upsert_calls += 1
+            if self.failures > 0:
+                self.failures -= 1
+                raise ConnectionError("Injected upsert failure")
+        size = len(json.dumps({"vectors": vectors}, separators=(",", ":")))
+        if size > self.max_request_bytes:
+            raise ValueError(f"Request size {size} exceeds the maximum of {self.max_request_bytes} bytes")
+        with self._lock:
+            target = self._namespace(namespace)
+            for vector in vectors:
+                if len(vector["values"]) != self.dimension:
+                    raise ValueError(f"Vector dimension {len(vector['values'])} does not match the index dimension {self.dimension}")
+                target[vector["id"]] = {"values": list(vector["values"]), "metadata": dict(vector.get("metadata") or {})}
+        return {"upserted_count": len(vectors)}
+
+    def delete(self, ids=None, delete_all=False, filter=None, namespace=None):
+        with self._lock:
+            vectors = self._namespace(namespace)
+            if delete_all:
+                vectors.clear()
+            elif filter:
+                for vector_id in [i for i, v in vectors.items() if _matches_filter(v["metadata"], filter)]:
+                    del vectors[vector_id]
+            for vector_id in ids or []:
+                vectors.pop(vector_id, None)
+        return {}
+
+    def fetch(self, ids, namespace=None):
+        with self._lock:
+            vectors = self._namespace(namespace)
+            found = {vector_id: SimpleNamespace(id=vector_id, values=vectors[vector_id]["values"],
+                                                metadata=vectors[vector_id]["metadata"])
+                     for vector_id in ids if vector_id in vectors}
+        return SimpleNamespace(vectors=found)
+
+    def list(self, prefix=None, limit=100, namespace=None):
+        '''
+        Yield pages of ids like the Pinecone serverless list()
+        '''
+        with self._lock:
+            ids = sorted(vector_id for vector_id in self._namespace(namespace) if not prefix or vector_id.startswith(prefix))
+        for i in range(0, len(ids), limit):
+            yield ids[i:i+limit]
+
+    def query(self, vector, top_k=10, include_values=False, include_metadata=False, filter=None, namespace=None):
+        with self._lock:
+            items = [(vector_id, v) for vector_id, v in self._namespace(namespace).items() if _matches_filter(v["metadata"], filter)]
+        if not items:
+            return {"matches": []}
+        matrix = np.asarray([v["values"] for _, v in items], dtype=np.float32)
+        query = np.asarray(vector, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1) * (np.linalg.norm(query) or 1.0)
+        norms[norms == 0] = 1.0
+        scores = matrix @ query / norms
+        matches = []
+        for i in np.argsort(-scores)[:top_k]:
+            vector_id, v = items[i]
+            matches.append({
+                "id": vector_id,
+                "score": float(scores[i]),
+                "values": v["values"] if include_values else [],
+                "metadata": v["metadata"] if include_metadata else None
+            })
+        return {"matches": matches}
+
+    def describe_index_stats(self):
+        with self._lock:
+            counts = {name: len(vectors) for name, vectors in self.namespaces.items() if vectors}
+        return {"dimension": self.dimension, "total_vector_count": sum(counts.values()),
+                "namespaces": {name: {"vector_count": count} for name, count in counts.items()}}
+
+
+class InMemoryPinecone():
+    '''
+    Stand-in for the Pinecone client, holds named InMemoryIndex instances
+    '''
+    def __init__(self, **index_options):
+        self.index_options = index_options
+        self.indexes = {}
+
+    def has_index(self, name):
+        return name in self.indexes
+
+    def create_index(self, name, dimension, metric="cosine", spec=None):
+        self.indexes[name] = InMemoryIndex(dimension=dimension, **self.index_options)
+
+    def Index(self, name):
+        if name not in self.indexes:
+            self.indexes[name] = InMemoryIndex(**self.index_options)
+        return self.indexes[name]
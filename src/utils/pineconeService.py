@@ -1,18 +1,40 @@
 '''
 This module contains the PineConeService class which is responsible for interacting with the Pinecone API
-to create indexes, upload embeddings and load embeddings from the Pinecone index'''
+to create indexes, upload, query and export the embeddings of the Pinecone index'''
 import dotenv
-from pinecone import (Pinecone, ServerlessSpec)
 import os
-import numpy as np
+import json
+import logging
+import random
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from ..indexManifest import make_vector_id
+from .tracing import tracer
+
+logger = logging.getLogger(__name__)
 
 dotenv.load_dotenv()
 
+# Pinecone rejects requests over 2MB, keep some headroom
+MAX_BATCH_BYTES = 1_800_000
+# the version record of an index (see write_version) has its own namespace, so queries, exports
+# and the vector count never include it
+VERSION_NAMESPACE = "index-version"
+VERSION_ID = "version"
+
 
 class PineConeService():
     
-    def __init__(self):
-        self.pc = Pinecone(api_key=os.getenv("PINECONE_API_KEY"), environment="us-east1-aws")
+    def __init__(self, pc=None):
+        '''
+        pc: Pinecone client, or a stand-in such as InMemoryPinecone for tests
+        '''
+        if pc is None:
+            from pinecone import Pinecone
+            pc = Pinecone(api_key=os.getenv("PINECONE_API_KEY"), environment="us-east1-aws")
+        self.pc = pc
     
 
     def initialize_index(self, index_name, dimension=1536, metric="cosine"):
@@ -21,6 +43,7 @@ class PineConeService():
         '''
         try:
             if not self.pc.has_index(index_name):
+                from pinecone import ServerlessSpec
                 self.pc.create_index(name=index_name,
                                     dimension=dimension,
                                     metric=metric,
@@ -29,7 +52,7 @@ class PineConeService():
                                         region="us-east-1"
                                     ),)
             else:
-                print(f"Index {index_name} already exists")
+                logger.info("Index %s already exists", index_name)
             
         except Exception as e:
             print(f"Error creating index: {e}")
@@ -38,55 +61,204 @@ class PineConeService():
         
         
     
-    def upload_embeddings(self, index_name, embeddings, batch_size=100):
+    def _index(self, index):
+        # accept an index name or an index object
+        return self.pc.Index(index) if isinstance(index, str) else index
+
+    def make_batches(self, vectors, max_batch_bytes, max_batch_vectors):
         '''
-        Upload embeddings to Pinecone index
+        Split vectors into consecutive batches whose serialized payload stays under max_batch_bytes
+        '''
+        batches = []
+        batch = []
+        batch_bytes = 0
+        for vector in vectors:
+            size = len(json.dumps(vector, separators=(",", ":")))
+            if batch and (batch_bytes + size > max_batch_bytes or len(batch) >= max_batch_vectors):
+                batches.append((batch, batch_bytes))
+                batch = []
+                batch_bytes = 0
+            batch.append(vector)
+            batch_bytes += size
+        if batch:
+            batches.append((batch, batch_bytes))
+        return batches
+
+    def upsert_batch(self, index, batch_number, batch, batch_bytes, max_retries, backoff):
+        '''
+        Upsert one batch, retrying with exponential backoff. Returns the batch report.
+        '''
+        start = time.perf_counter()
+        error = None
+        for attempt in range(1, max_retries + 2):
+            try:
+                index.upsert(vectors=batch)
+                error = None
+                break
+            except Exception as e:
+                error = e
+                if attempt <= max_retries:
+                    time.sleep(backoff * (2 ** (attempt - 1)) * (0.5 + random.random() / 2))
+        return {
+            "batch": batch_number,
+            "vectors": len(batch),
+            "bytes": batch_bytes,
+            "attempts": attempt,
+            "ok": error is None,
+            "error": None if error is None else f"{type(error).__name__}: {error}",
+            "seconds": time.perf_counter() - start
+        }
+
+    def upload_embeddings(self, index_name, embeddings, max_batch_bytes=MAX_BATCH_BYTES, max_batch_vectors=1000,
+                          max_workers=4, max_retries=4, backoff=0.5, raise_on_error=False):
         '''
+        Upload embeddings to Pinecone index. Batches are sized by serialized payload bytes (every
+        vector carries its chunk text) and up to max_workers batches are in flight. Failed batches
+        are retried with backoff. Returns one report per batch
+        ({"batch", "vectors", "bytes", "attempts", "ok", "error", "seconds"}); with raise_on_error
+        an exception is raised if any batch still failed.
+        '''
+        embeddings = list(embeddings)
+        with tracer.span("upsert", target="pinecone", index=index_name) as span:
+            report = self._upload(index_name, embeddings, max_batch_bytes, max_batch_vectors, max_workers,
+                                  max_retries, backoff)
+            failed = [batch for batch in report if not batch["ok"]]
+            span.add(items=sum(batch["vectors"] for batch in report if batch["ok"]),
+                     bytes=sum(batch["bytes"] for batch in report), batches=len(report), failed_batches=len(failed))
+        if len(failed) < len(report):
+            self._update_version(index_name, len(embeddings[0]["embedding"]))
+        if failed:
+            logger.warning("%d of %d upsert batches failed: %s", len(failed), len(report), failed[0]["error"])
+            if raise_on_error:
+                raise RuntimeError(f"{len(failed)} of {len(report)} upsert batches failed: {failed[0]['error']}")
+        return report
+
+    def _upload(self, index_name, embeddings, max_batch_bytes, max_batch_vectors, max_workers, max_retries, backoff):
+        index = self._index(index_name)
+        vectors = []
+        for item in embeddings:
+            vectors.append({
+                # deterministic ids, so uploading the same chunk again overwrites it
+                "id": item.get("id") or make_vector_id(item),
+                "values": [float(value) for value in item["embedding"]],
+                "metadata": {
+                    "text": item["text"],
+                    **item["metadata"]
+                }
+            })
+
+        batches = self.make_batches(vectors, max_batch_bytes, max_batch_vectors)
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(batches)))) as executor:
+            return list(executor.map(
+                lambda args: self.upsert_batch(index, args[0], *args[1], max_retries, backoff),
+                enumerate(batches)))
+
+    def delete_embeddings(self, index_name, ids, batch_size=1000, raise_on_error=False):
+        '''
+        Delete vectors from the Pinecone index by id. Returns the number of ids deleted; with
+        raise_on_error the error of a failed delete request is raised instead.
+        '''
+        ids = list(ids)
+        deleted = 0
         try:
-            print("Uploading embeddings to Pinecone...\n")
-            index = self.pc.Index(index_name)
-            print(f"list(index.list()): {list(index.list())}")
-            num_vector_ids = len(list(index.list())[0]) if len(list(index.list())) != 0 else 0
-            print(f'num_vectors = {num_vector_ids}')
-            for i in range(0, len(embeddings), batch_size):
-                batch = embeddings[i:i+batch_size]
-                vectors_to_upsert = []
-                
-                for j, item in enumerate(batch):
-                    vector_id = f"vec_{i+j+num_vector_ids}"
-                    vectors_to_upsert.append({
-                        "id": vector_id,
-                        "values": item["embedding"],
-                        "metadata": {
-                            "text": item["text"],
-                            **item["metadata"]
-                        }
-                    })
-                
-                index.upsert(vectors=vectors_to_upsert)
-                print("Embeddings uploaded successfully!")
+            index = self._index(index_name)
+            for i in range(0, len(ids), batch_size):
+                index.delete(ids=ids[i:i+batch_size])
+                deleted += len(ids[i:i+batch_size])
+            if ids:
+                logger.info("Deleted %d embeddings from Pinecone", len(ids))
+        except Exception as e:
+            print(f"Error deleting embeddings: {e}")
+            if raise_on_error:
+                raise
+        finally:
+            if deleted:
+                self._update_version(index_name)
+        return deleted
 
+    def query(self, index_name, vector, top_k=10, filter=None, include_values=False):
+        '''
+        Server-side similarity search: the top_k matches of the index (restricted by a Pinecone
+        metadata filter) as dicts with "id", "score", "values" and "metadata"
+        '''
+        index = self._index(index_name)
+        response = index.query(vector=[float(value) for value in vector], top_k=top_k, filter=filter or None,
+                               include_values=include_values, include_metadata=True)
+        return [{"id": match["id"], "score": match["score"], "values": match.get("values") or [],
+                 "metadata": dict(match.get("metadata") or {})} for match in response["matches"]]
+
+    def stats(self, index_name):
+        '''
+        describe_index_stats of the index as a dict (the vector count without the version record)
+        '''
+        stats = self._index(index_name).describe_index_stats()
+        namespaces = stats["namespaces"]
+        versions = namespaces[VERSION_NAMESPACE]["vector_count"] if VERSION_NAMESPACE in namespaces else 0
+        return {"dimension": stats["dimension"], "total_vector_count": stats["total_vector_count"] - versions}
+
+    def write_version(self, index_name, dimension=None):
+        '''
+        Store a new random version stamp in the index, so every process reading it with
+        read_version sees that the index changed. Called after every upload or delete. Returns
+        the stamp.
+        '''
+        if dimension is None:
+            dimension = self.stats(index_name)["dimension"]
+        version = uuid.uuid4().hex
+        # Pinecone doesn't accept all-zero vectors
+        record = {"id": VERSION_ID, "values": [1.0] + [0.0] * (dimension - 1),
+                  "metadata": {"version": version, "updated_at": time.time()}}
+        self._index(index_name).upsert(vectors=[record], namespace=VERSION_NAMESPACE)
+        return version
+
+    def read_version(self, index_name):
+        '''
+        Version stamp of the index, "" if none was written yet
+        '''
+        fetched = self._index(index_name).fetch(ids=[VERSION_ID], namespace=VERSION_NAMESPACE).vectors
+        return fetched[VERSION_ID].metadata["version"] if VERSION_ID in fetched else ""
+
+    def _update_version(self, index_name, dimension=None):
+        try:
+            self.write_version(index_name, dimension)
         except Exception as e:
-            print(f"Error uploading embeddings: {e}")
+            print(f"Error updating the version of the Pinecone index: {e}")
 
-    def load_stored_embeddings(self, index_name):
+    def export_embeddings(self, index_name, vector_store, batch_size=100):
         '''
-        Load embeddings from Pinecone index
+        Copy every vector of the Pinecone index into a local vector store. Pages through the
+        ids with index.list() and fetches the vectors in batches, so it is not limited to the
+        10000 matches of a query.
         '''
         try:
-            
             index = self.pc.Index(index_name)
-            
-            print("LOADING EMBEDDINGS FROM PINECONE...\n")
-        
-            random_embedding = np.random.rand(1536)
-            # return the top 10000 vectors. This is my way of retrieving all vectors (since I know
-            # that I have less than 10000 vectors in the index)
-            # to perform the semantic search locally 
-            query_result = index.query(vector=random_embedding.tolist(), top_k=10000, include_values=True, include_metadata=True)
-            # print(f'\nQUERY RESULT = {query_result}')
-            return query_result['matches']
-            
+            with tracer.span("load", source="pinecone", index=index_name, target="local") as span:
+                exported = self._export(index, vector_store, batch_size)
+                span.add(items=exported)
+            logger.info("Exported %d embeddings from Pinecone to the local vector store", exported)
+            return exported
+
         except Exception as e:
-            print(f"Error loading stored embeddings: {e}")
-            return None
+            print(f"Error exporting embeddings: {e}")
+            return 0
+
+    def _export(self, index, vector_store, batch_size):
+        exported = 0
+        for ids in index.list():
+            for i in range(0, len(ids), batch_size):
+                fetched = index.fetch(ids=ids[i:i+batch_size]).vectors
+                embeddings = []
+                for vector_id in ids[i:i+batch_size]:
+                    if vector_id not in fetched:
+                        continue
+                    vector = fetched[vector_id]
+                    metadata = dict(vector.metadata or {})
+                    text = metadata.pop("text", "")
+                    embeddings.append({
+                        "id": vector_id,
+                        "text": text,
+                        "embedding": vector.values,
+                        "metadata": metadata
+                    })
+                exported += vector_store.append(embeddings)
+        return exported
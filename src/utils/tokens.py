@@ -0,0 +1,36 @@
+'''
+Token counting helpers. Uses tiktoken when it is installed, otherwise a character based
+estimate (about 4 characters per token for English text) which is good enough for budgeting.
+The encoding is loaded on the first count (tiktoken may download it), not when the module is
+imported.'''
+import threading
+
+_encoding = None
+_encoding_loaded = False
+_encoding_lock = threading.Lock()
+
+
+def _get_encoding():
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        with _encoding_lock:
+            if not _encoding_loaded:
+                try:
+                    import tiktoken
+                    _encoding = tiktoken.get_encoding("cl100k_base")
+                except Exception:  # tiktoken is optional
+                    _encoding = None
+                _encoding_loaded = True
+    return _encoding
+
+
+def count_tokens(text):
+    '''
+    Number of tokens in the text (exact with tiktoken, estimated otherwise)
+    '''
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return max(1, (len(text) + 3) // 4)
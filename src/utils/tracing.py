@@ -0,0 +1,276 @@
+'''
+This module contains a lightweight tracer recording a span (timing plus item, byte and token
+counts) for every pipeline stage: parse, clean, chunk, embed, upsert, load, search, prompt and
+generate. Finished spans are handed to an exporter:
+ - LogExporter: one JSON line per span on the "custom_rag.trace" logger
+ - InMemoryCollector: keeps the spans in memory and summarizes them per stage (tests, the UI)
+The exporter can be switched at runtime with tracer.set_exporter (None disables tracing, then
+tracer.span returns a shared no-op span so the instrumented code costs close to nothing).
+TRACE_EXPORTER=log or TRACE_EXPORTER=memory enables tracing from the environment.
+
+Usage:
+    with tracer.span("search", top_k=10) as span:
+        results = ...
+        span.add(items=len(results))
+Spans opened inside another span (in the same thread, or in a thread started through
+tracer.wrap) share its trace_id, so the stages of one request can be grouped.'''
+import contextvars
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+import numpy as np
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span():
+    __slots__ = ("tracer", "name", "attrs", "items", "bytes", "tokens", "trace_id", "span_id",
+                 "parent_id", "start", "started", "seconds", "error", "_token", "_lock")
+
+    def __init__(self, tracer, name, attrs, parent=None):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+        self.items = 0
+        self.bytes = 0
+        self.tokens = 0
+        parent = parent if parent is not None else _current_span.get()
+        self.trace_id = parent.trace_id if parent is not None else uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent is not None else None
+        self.span_id = uuid.uuid4().hex[:16]
+        self.start = time.time()
+        self.started = time.perf_counter()
+        self.seconds = None
+        self.error = None
+        self._token = None
+        self._lock = threading.Lock()
+
+    def add(self, items=0, bytes=0, tokens=0, **attrs):
+        '''
+        Add to the counts of the span (thread safe) and set attributes
+        '''
+        with self._lock:
+            self.items += items
+            self.bytes += bytes
+            self.tokens += tokens
+            self.attrs.update(attrs)
+        return self
+
+    def __enter__(self):
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current_span.reset(self._token)
+        if exc is not None:
+            self.error = f"{exc_type.__name__}: {exc}"
+        self.end()
+        return False
+
+    def end(self):
+        if self.seconds is None:
+            self.seconds = time.perf_counter() - self.started
+            self.tracer.export(self.to_dict())
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "seconds": self.seconds,
+            "items": self.items,
+            "bytes": self.bytes,
+            "tokens": self.tokens,
+            "error": self.error,
+            "attrs": self.attrs
+        }
+
+
+class _NoopSpan():
+    '''
+    Returned while tracing is disabled, every method does nothing
+    '''
+    __slots__ = ()
+    trace_id = None
+    span_id = None
+
+    def add(self, items=0, bytes=0, tokens=0, **attrs):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def end(self):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class LogExporter():
+    def __init__(self, logger=None, level=logging.INFO, stream=None):
+        '''
+        Without a logger, spans go to the "custom_rag.trace" logger which writes to stream
+        (stderr by default) unless the application configured handlers for it.
+        '''
+        if logger is None:
+            logger = logging.getLogger("custom_rag.trace")
+            if not logger.handlers:
+                logger.addHandler(logging.StreamHandler(stream or sys.stderr))
+                logger.setLevel(level)
+                logger.propagate = False
+        self.logger = logger
+        self.level = level
+
+    def export(self, span):
+        self.logger.log(self.level, json.dumps(span, default=str))
+
+
+class InMemoryCollector():
+    def __init__(self, max_spans=100000):
+        self.max_spans = max_spans
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        with self._lock:
+            self.spans.append(span)
+            if len(self.spans) > self.max_spans:
+                del self.spans[:len(self.spans) - self.max_spans]
+
+    def drain(self):
+        '''
+        Return the collected spans and forget them
+        '''
+        with self._lock:
+            spans, self.spans = self.spans, []
+        return spans
+
+    def clear(self):
+        self.drain()
+
+    def by_name(self, name):
+        with self._lock:
+            return [span for span in self.spans if span["name"] == name]
+
+    def summary(self):
+        '''
+        Per stage: {"count", "total_seconds", "p50_ms", "p95_ms", "items", "bytes", "tokens", "errors"}
+        '''
+        with self._lock:
+            spans = list(self.spans)
+        stages = {}
+        for span in spans:
+            stages.setdefault(span["name"], []).append(span)
+        summary = {}
+        for name, stage_spans in stages.items():
+            seconds = np.asarray([span["seconds"] for span in stage_spans])
+            summary[name] = {
+                "count": len(stage_spans),
+                "total_seconds": float(seconds.sum()),
+                "p50_ms": float(np.percentile(seconds, 50) * 1000),
+                "p95_ms": float(np.percentile(seconds, 95) * 1000),
+                "items": sum(span["items"] for span in stage_spans),
+                "bytes": sum(span["bytes"] for span in stage_spans),
+                "tokens": sum(span["tokens"] for span in stage_spans),
+                "errors": sum(span["error"] is not None for span in stage_spans)
+            }
+        return summary
+
+
+class Tracer():
+    def __init__(self, exporter=None):
+        self.exporter = exporter
+
+    @property
+    def enabled(self):
+        return self.exporter is not None
+
+    def set_exporter(self, exporter):
+        '''
+        Switch the exporter at runtime, None disables tracing. Returns the previous exporter.
+        '''
+        previous, self.exporter = self.exporter, exporter
+        return previous
+
+    def span(self, name, **attrs):
+        if self.exporter is None:
+            return NOOP_SPAN
+        return Span(self, name, attrs)
+
+    def current_span(self):
+        if self.exporter is None:
+            return NOOP_SPAN
+        return _current_span.get() or NOOP_SPAN
+
+    def record(self, name, seconds, parent=None, items=0, bytes=0, tokens=0, **attrs):
+        '''
+        Export a span timed elsewhere (e.g. accumulated over a loop, or ended by a callback)
+        '''
+        if self.exporter is None:
+            return
+        span = Span(self, name, attrs, parent=parent if parent is not NOOP_SPAN else None)
+        span.add(items=items, bytes=bytes, tokens=tokens)
+        span.start -= seconds
+        span.seconds = seconds
+        self.export(span.to_dict())
+
+    def replay(self, spans):
+        '''
+        Export spans collected in another process (see IngesterAndParser.iter_documents)
+        '''
+        for span in spans:
+            self.export(span)
+
+    def export(self, span):
+        exporter = self.exporter
+        if exporter is None:
+            return
+        try:
+            exporter.export(span)
+        except Exception as e:
+            # tracing must never break the pipeline
+            print(f"Error exporting span {span['name']}: {e}")
+
+    def wrap(self, fn):
+        '''
+        Run fn (e.g. in a thread pool) with the current span as parent of the spans it opens
+        '''
+        parent = _current_span.get()
+        if self.exporter is None or parent is None:
+            return fn
+
+        def wrapped(*args, **kwargs):
+            token = _current_span.set(parent)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                _current_span.reset(token)
+        return wrapped
+
+
+def exporter_from_name(name):
+    '''
+    "log", "memory" or "off"/"" (disabled)
+    '''
+    name = (name or "").strip().lower()
+    if name == "log":
+        return LogExporter()
+    if name == "memory":
+        return InMemoryCollector()
+    if name in ("", "off", "none"):
+        return None
+    raise ValueError(f"Unknown trace exporter: {name}")
+
+
+# shared tracer used by the whole pipeline
+tracer = Tracer(exporter_from_name(os.getenv("TRACE_EXPORTER")))
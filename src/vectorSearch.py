@@ -0,0 +1,250 @@
+'''
+This module contains the VectorSearchEngine class which holds all stored vectors as a single
+pre-normalized float32 matrix so that a query can be scored with one matrix-vector product
+and the top k results picked with a partial selection instead of a full sort.
+With a lexical (BM25) index the vector and keyword rankings can be fused (hybrid search), or the
+keyword ranking used on its own when no query embedding is available.
+With a quantized index the compressed vectors are scanned and only a shortlist is scored on the
+float32 matrix.
+search_many scores a batch of queries with one matrix-matrix product per block of rows.
+Every search takes optional rows (e.g. the rows of one lecture, see metadataIndex.py) to
+restrict it to; only those rows are scored.'''
+import numpy as np
+
+from .lexicalIndex import reciprocal_rank_fusion
+
+# number of candidates taken from each ranking (at least) before fusing them
+HYBRID_CANDIDATES = 50
+# rows scored at once by search_many
+BLOCK_ROWS = 65536
+
+
+def normalize_rows(matrix):
+    '''
+    Return a float32 copy of the matrix where every row has unit length (zero rows stay zero)
+    '''
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if matrix.ndim == 1:
+        matrix = matrix.reshape(1, -1)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def top_k_indices(scores, top_k):
+    '''
+    Indices of the top_k highest scores, best first. Uses argpartition so only the
+    selected slice is sorted.
+    '''
+    n = scores.shape[0]
+    if top_k <= 0 or n == 0:
+        return np.empty(0, dtype=np.int64)
+    if top_k >= n:
+        return np.argsort(-scores, kind="stable")
+    candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+class VectorSearchEngine():
+    def __init__(self, matrix, records, normalized=False, ann_index=None, deleted=None, lexical_index=None,
+                 quantized_index=None):
+        '''
+        matrix: (n, dim) array of vectors. records: sequence where records[i] is a dict
+        with the "text" and "metadata" of row i. ann_index: optional IVFIndex over the
+        matrix, used instead of exact search when given. deleted: optional boolean mask of
+        rows to leave out of the results. lexical_index: optional LexicalIndex over the texts
+        of the rows, used by search_hybrid and search_lexical. quantized_index: optional
+        QuantizedIndex, scanned instead of the matrix when there is no ann_index.
+        '''
+        self.matrix = matrix if normalized else normalize_rows(matrix)
+        self.records = records
+        self.ann_index = ann_index
+        self.deleted = deleted
+        self.lexical_index = lexical_index
+        self.quantized_index = quantized_index
+
+    @classmethod
+    def from_embeddings(cls, embeddings):
+        '''
+        Build the engine from a list of stored embeddings. Accepts both Pinecone matches
+        ({"values", "metadata"}) and the output of EmbedAndSearch.generate_embeddings
+        ({"text", "embedding", "metadata"}).
+        '''
+        vectors = []
+        records = []
+        for embedding in embeddings or []:
+            values = embedding["values"] if "values" in embedding else embedding["embedding"]
+            metadata = embedding["metadata"]
+            text = embedding["text"] if "text" in embedding else metadata["text"]
+            vectors.append(values)
+            records.append({"text": text, "metadata": metadata})
+
+        if not vectors:
+            return cls(np.empty((0, 0), dtype=np.float32), records, normalized=True)
+        return cls(np.asarray(vectors, dtype=np.float32), records)
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def score(self, query_embedding):
+        '''
+        Cosine similarity of the query against every stored vector
+        '''
+        query = normalize_rows(query_embedding)[0]
+        return self.matrix @ query
+
+    def search_rows(self, query_embedding, top_k=10, rows=None):
+        '''
+        (rows, cosine similarities) of the top_k most similar vectors, best first. rows: sorted
+        array of the only rows to consider.
+        '''
+        if rows is not None:
+            return self._search_subset(query_embedding, top_k, rows)
+        if len(self) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        if self.ann_index is not None:
+            return self.ann_index.search(self.matrix, query_embedding, top_k=top_k, exclude=self.deleted)
+        if self.quantized_index is not None:
+            return self.quantized_index.search(self.matrix, query_embedding, top_k=top_k, exclude=self.deleted)
+        scores = self.score(query_embedding)
+        if self.deleted is not None:
+            scores[self.deleted] = -np.inf
+        rows = top_k_indices(scores, top_k)
+        scores = scores[rows]
+        if self.deleted is not None:
+            keep = np.isfinite(scores)
+            rows, scores = rows[keep], scores[keep]
+        return rows, scores
+
+    def _search_subset(self, query_embedding, top_k, rows):
+        # exact search over the gathered rows only, cost proportional to the size of the subset
+        rows = np.asarray(rows, dtype=np.int64)
+        if self.deleted is not None and len(rows):
+            rows = rows[~self.deleted[rows]]
+        if len(rows) == 0:
+            return rows, np.empty(0, dtype=np.float32)
+        if self.quantized_index is not None and len(rows) > self.quantized_index.shortlist:
+            return self.quantized_index.search(self.matrix, query_embedding, top_k=top_k, rows=rows)
+        query = normalize_rows(query_embedding)[0]
+        scores = np.asarray(self.matrix[rows]) @ query
+        best = top_k_indices(scores, top_k)
+        return rows[best], scores[best]
+
+    def _result(self, row, include_embeddings=False, **scores):
+        record = self.records[int(row)]
+        result = {"text": record["text"], **scores, "metadata": record["metadata"]}
+        if include_embeddings:
+            result["embedding"] = np.asarray(self.matrix[int(row)])
+        return result
+
+    def search(self, query_embedding, top_k=10, include_embeddings=False, rows=None):
+        '''
+        Return the top_k most similar records as {"text", "similarity", "metadata"} dicts
+        (plus the normalized "embedding" with include_embeddings)
+        '''
+        rows, scores = self.search_rows(query_embedding, top_k, rows=rows)
+        return [self._result(row, include_embeddings, similarity=float(score)) for row, score in zip(rows, scores)]
+
+    def search_lexical(self, query, top_k=10, include_embeddings=False, rows=None):
+        '''
+        Keyword (BM25) search without a query embedding. Results carry the BM25 "score"
+        instead of a "similarity".
+        '''
+        if self.lexical_index is None or len(self) == 0:
+            return []
+        rows, scores = self.lexical_index.search(query, top_k, deleted=self.deleted, rows=rows)
+        return [self._result(row, include_embeddings, score=float(score)) for row, score in zip(rows, scores)]
+
+    def search_hybrid(self, query_embedding, query, top_k=10, include_embeddings=False, rows=None):
+        '''
+        Fuse the vector and keyword rankings with reciprocal rank fusion. Results carry the
+        fused "score" (used for ranking), the cosine "similarity" and the BM25 "lexical_score"
+        (0 if the record doesn't contain any query term).
+        '''
+        if self.lexical_index is None:
+            return self.search(query_embedding, top_k, include_embeddings, rows=rows)
+        if len(self) == 0:
+            return []
+        vector_rows, similarities = self.search_rows(query_embedding, self.hybrid_candidates(top_k), rows=rows)
+        return self._fuse(query_embedding, query, vector_rows, similarities, top_k, include_embeddings, rows)
+
+    @staticmethod
+    def hybrid_candidates(top_k):
+        return max(top_k * 5, HYBRID_CANDIDATES)
+
+    def _fuse(self, query_embedding, query, vector_rows, similarities, top_k, include_embeddings, rows):
+        lexical_rows, lexical_scores = self.lexical_index.search(query, self.hybrid_candidates(top_k),
+                                                                 deleted=self.deleted, rows=rows)
+        fused = reciprocal_rank_fusion([vector_rows, lexical_rows])
+        rows = sorted(fused, key=fused.get, reverse=True)[:top_k]
+
+        similarity = dict(zip(vector_rows.tolist(), similarities.tolist()))
+        lexical_score = dict(zip(lexical_rows.tolist(), lexical_scores.tolist()))
+        missing = [row for row in rows if row not in similarity]
+        if missing:
+            # keyword-only hits: compute their cosine similarity directly
+            query_vector = normalize_rows(query_embedding)[0]
+            similarity.update(zip(missing, (np.asarray(self.matrix[missing]) @ query_vector).tolist()))
+        return [self._result(row, include_embeddings, score=fused[row], similarity=float(similarity[row]),
+                             lexical_score=float(lexical_score.get(row, 0.0)))
+                for row in rows]
+
+    def search_rows_many(self, query_embeddings, top_k=10, rows=None):
+        '''
+        Exact top_k of every query in one pass over the matrix: each block of BLOCK_ROWS rows is
+        scored against all queries with one matrix-matrix product and merged into a running
+        top_k. Returns a list of (rows, cosine similarities), one per query.
+        '''
+        queries = normalize_rows(query_embeddings)
+        if top_k <= 0:
+            return [(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)) for _ in queries]
+        if rows is not None:
+            rows = np.asarray(rows, dtype=np.int64)
+            if self.deleted is not None and len(rows):
+                rows = rows[~self.deleted[rows]]
+        n = len(self) if rows is None else len(rows)
+        # the running top_k never holds more than the rows scored (argpartition needs top_k <= n)
+        top_k = min(top_k, n) if n else top_k
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        for start in range(0, n, BLOCK_ROWS):
+            end = min(start + BLOCK_ROWS, n)
+            block_rows = np.arange(start, end) if rows is None else rows[start:end]
+            block = self.matrix[start:end] if rows is None else self.matrix[block_rows]
+            scores = queries @ np.asarray(block).T
+            if self.deleted is not None and rows is None:
+                scores[:, self.deleted[start:end]] = -np.inf
+            scores = np.hstack([best_scores, scores])
+            candidates = np.hstack([best_rows, np.broadcast_to(block_rows, (len(queries), len(block_rows)))])
+            if scores.shape[1] > top_k:
+                keep = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+                scores = np.take_along_axis(scores, keep, axis=1)
+                candidates = np.take_along_axis(candidates, keep, axis=1)
+            best_rows, best_scores = candidates, scores
+
+        results = []
+        for query_rows, query_scores in zip(best_rows, best_scores):
+            order = np.argsort(-query_scores, kind="stable")
+            query_rows, query_scores = query_rows[order], query_scores[order]
+            keep = np.isfinite(query_scores)
+            results.append((query_rows[keep], query_scores[keep]))
+        return results
+
+    def search_many(self, query_embeddings, top_k=10, include_embeddings=False, queries=None, rows=None):
+        '''
+        search (or search_hybrid, with the query texts) for a batch of queries. Returns one list
+        of results per query.
+        '''
+        if len(query_embeddings) == 0:
+            return []
+        hybrid = queries is not None and self.lexical_index is not None
+        n_candidates = self.hybrid_candidates(top_k) if hybrid else top_k
+        results = []
+        for i, (vector_rows, similarities) in enumerate(self.search_rows_many(query_embeddings, n_candidates, rows)):
+            if hybrid:
+                results.append(self._fuse(query_embeddings[i], queries[i], vector_rows, similarities, top_k,
+                                          include_embeddings, rows))
+            else:
+                results.append([self._result(row, include_embeddings, similarity=float(score))
+                                for row, score in zip(vector_rows, similarities)])
+        return results
@@ -0,0 +1,665 @@
+'''
+This module contains the LocalVectorStore class, a persistent on-disk vector store used for
+semantic search so queries don't have to download the whole Pinecone index.
+
+Layout of the store directory:
+ - header.json: dimension, number of rows, number of deleted rows, the data generation and a
+   version bumped on every change (written last, so a crashed append is ignored)
+ - vectors.f32: raw float32 matrix of L2-normalized vectors, opened with np.memmap
+ - records.jsonl: one JSON line per row with the id, text and metadata
+ - offsets.u64: byte offset of every row in records.jsonl so a record can be read with one seek
+ - deleted.u8: one byte per row, set when the row is deleted (rows are only removed on compaction)
+ - ann.npz: optional IVF index, only built once the store holds ann_min_vectors vectors
+   (smaller stores use exact search)
+ - quantized.npz: optional compressed copy of the vectors (float16, int8 or product quantization
+   codes, see quantization.py) scanned instead of the float32 matrix; only the shortlist is
+   re-ranked from the memory map, so the float32 matrix no longer has to fit in memory
+ - metadata.npz: file / course / slide number of every row, partitioned for scoped search (see
+   metadataIndex.py), extended with the new rows on first use after an append
+ - lexical_<start>_<end>.npz: BM25 inverted index segments over the texts of the rows
+   [start, end) (see lexicalIndex.py), listed in the header so they are switched together with
+   the rows they cover
+Compaction writes the data files of a new generation (e.g. vectors.1.f32) and then switches the
+header to it, so readers never see half written files.
+'''
+import json
+import logging
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+import numpy as np
+
+from .vectorSearch import VectorSearchEngine, normalize_rows
+from .annIndex import IVFIndex
+from .lexicalIndex import LexicalIndex, LexicalSegment
+from .metadataIndex import MetadataIndex
+from .quantization import QuantizedIndex
+from .utils.tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, fall back to the in-process lock only
+    fcntl = None
+
+
+class VectorStore():
+    '''
+    Interface of the vector store backends the query pipeline searches: LocalVectorStore (in
+    process, memory-mapped) and PineconeVectorStore (server-side search, see
+    pineconeVectorStore.py). Embeddings are {"id", "text", "embedding", "metadata"} dicts and
+    results {"text", "metadata", "similarity" and/or "score"} dicts like VectorSearchEngine's.
+    '''
+    backend = None
+    # True if query() can rank by query_text alone (query_embedding None), which the query
+    # pipelines fall back to when the query embedding is late or fails
+    supports_keyword_search = False
+
+    def upsert(self, embeddings):
+        '''
+        Add embeddings, replacing the ones with the same id. Returns the number added.
+        '''
+        raise NotImplementedError
+
+    def delete(self, ids):
+        '''
+        Remove embeddings by id. Returns the number removed.
+        '''
+        raise NotImplementedError
+
+    def query(self, query_embedding, top_k=10, metadata_filter=None, query_text=None, include_embeddings=False):
+        '''
+        The top_k embeddings most similar to the query embedding among those matching the
+        metadata filter (see metadataIndex.py). Backends with a keyword index fuse it with the
+        query_text ranking; without a query embedding they search the keywords alone.
+        '''
+        raise NotImplementedError
+
+    def query_many(self, query_embeddings, top_k=10, metadata_filter=None, queries=None, include_embeddings=False):
+        '''
+        query for a batch of query embeddings, one list of results per query
+        '''
+        queries = queries or [None] * len(query_embeddings)
+        return [self.query(query_embedding, top_k=top_k, metadata_filter=metadata_filter, query_text=query,
+                           include_embeddings=include_embeddings)
+                for query_embedding, query in zip(query_embeddings, queries)]
+
+    def stats(self):
+        '''
+        {"backend", "vectors", "dimension", ...}
+        '''
+        raise NotImplementedError
+
+    @property
+    def index_version(self):
+        '''
+        Changes when the contents of the store change (answer cache entries are tied to it)
+        '''
+        raise NotImplementedError
+
+    def warm_up(self, metadata_filter=None):
+        '''
+        Load what the next query will read (nothing for remote backends)
+        '''
+
+    def metadata_index(self):
+        '''
+        MetadataIndex of the rows, None if the backend doesn't keep one
+        '''
+        return None
+
+
+class LocalVectorStore(VectorStore):
+    HEADER_FILE = "header.json"
+    VECTORS_FILE = "vectors.f32"
+    RECORDS_FILE = "records.jsonl"
+    OFFSETS_FILE = "offsets.u64"
+    DELETED_FILE = "deleted.u8"
+    ANN_FILE = "ann.npz"
+    METADATA_FILE = "metadata.npz"
+    QUANTIZED_FILE = "quantized.npz"
+    LOCK_FILE = ".lock"
+    # compact once this fraction of the rows is deleted
+    COMPACT_RATIO = 0.25
+    backend = "local"
+    supports_keyword_search = True
+
+    def __init__(self, directory, ann_min_vectors=None, nprobe=8, quantization=None, pq_subvectors=None,
+                 shortlist=100):
+        '''
+        ann_min_vectors: use an approximate (IVF) index once the store holds at least this
+        many vectors. None always uses exact search. nprobe tunes the IVF recall/latency.
+        quantization: None, "float16", "int8" or "pq" to search a compressed copy of the vectors
+        and re-rank the best shortlist rows exactly (pq_subvectors: bytes per vector for "pq").
+        '''
+        self.directory = directory
+        self.ann_min_vectors = ann_min_vectors
+        self.nprobe = nprobe
+        self.quantization = quantization or None
+        self.pq_subvectors = pq_subvectors
+        self.shortlist = shortlist
+        self.ann_index = None
+        self.quantized_index = None
+        self._metadata_index = None
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.RLock()
+        self._records_file = None
+        self._id_rows = None
+        self.dim = 0
+        self.count = 0
+        self.deleted_count = 0
+        self.generation = 0
+        self.version = 0
+        self.uid = None
+        self.vectors = np.empty((0, 0), dtype=np.float32)
+        self.offsets = np.empty(0, dtype=np.uint64)
+        self.deleted = np.empty(0, dtype=np.uint8)
+        # [start, end) row ranges of the lexical index segments, None if the store has none yet
+        self.lexical_ranges = None
+        self._lexical_segments = {}
+        self._lexical_index = None
+        self._lexical_key = None
+        self.refresh()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _data_path(self, name, generation=None):
+        # data files of generation 0 keep their plain name, later ones get the generation
+        generation = self.generation if generation is None else generation
+        if generation == 0:
+            return self._path(name)
+        base, ext = os.path.splitext(name)
+        return self._path(f"{base}.{generation}{ext}")
+
+    def _lexical_path(self, start, end, generation=None):
+        return self._data_path(f"lexical_{start}_{end}.npz", generation)
+
+    def _read_header(self):
+        try:
+            with open(self._path(self.HEADER_FILE)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"dim": 0, "count": 0, "version": 0}
+
+    def _write_header(self, header):
+        tmp_path = self._path(self.HEADER_FILE + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(header, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._path(self.HEADER_FILE))
+
+    @contextmanager
+    def _write_lock(self):
+        # serializes writers across threads and processes
+        with self._lock, open(self._path(self.LOCK_FILE), "w") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def refresh(self):
+        '''
+        (Re)open the memory maps if the store was changed since it was last opened.
+        Only reads the header, so this is cheap to call before every query.
+        '''
+        with self._lock:
+            header = self._read_header()
+            # the lexical index of an older store is added later without changing its contents
+            self.lexical_ranges = header.get("lexical")
+            if header.get("version", 0) == self.version and header["count"] == self.count:
+                return
+            if header.get("generation", 0) != self.generation:
+                self.ann_index = None
+                self.quantized_index = None
+                self._metadata_index = None
+            self.version = header.get("version", 0)
+            self.uid = header.get("uid")
+            self.generation = header.get("generation", 0)
+            self.dim = header["dim"]
+            self.count = header["count"]
+            self.deleted_count = header.get("deleted", 0)
+            self._id_rows = None
+            if self.count == 0:
+                self.vectors = np.empty((0, self.dim), dtype=np.float32)
+                self.offsets = np.empty(0, dtype=np.uint64)
+                self.deleted = np.empty(0, dtype=np.uint8)
+            else:
+                self.vectors = np.memmap(self._data_path(self.VECTORS_FILE), dtype=np.float32,
+                                         mode="r", shape=(self.count, self.dim))
+                self.offsets = np.memmap(self._data_path(self.OFFSETS_FILE), dtype=np.uint64,
+                                         mode="r", shape=(self.count,))
+                if self.deleted_count:
+                    self.deleted = np.memmap(self._data_path(self.DELETED_FILE), dtype=np.uint8,
+                                             mode="r", shape=(self.count,))
+                else:
+                    self.deleted = np.zeros(self.count, dtype=np.uint8)
+            if self._records_file is not None:
+                self._records_file.close()
+                self._records_file = None
+
+    def __len__(self):
+        '''
+        Number of live (not deleted) vectors
+        '''
+        return self.count - self.deleted_count
+
+    @property
+    def index_version(self):
+        '''
+        Identifies the current contents of the store (changes on every append or delete)
+        '''
+        self.refresh()
+        return f"{self.uid}-{self.version}"
+
+    def __getitem__(self, row):
+        '''
+        Read the record ({"id", "text", "metadata"}) of one row from the sidecar
+        '''
+        if row < 0 or row >= self.count:
+            raise IndexError(row)
+        with self._lock:
+            if self._records_file is None:
+                self._records_file = open(self._data_path(self.RECORDS_FILE), "rb")
+            self._records_file.seek(int(self.offsets[row]))
+            return json.loads(self._records_file.readline())
+
+    def iter_records(self, include_deleted=False, start=0):
+        '''
+        Sequentially read every record of the store (from row start on)
+        '''
+        if self.count <= start:
+            return
+        deleted = self.deleted
+        with open(self._data_path(self.RECORDS_FILE), "rb") as f:
+            f.seek(int(self.offsets[start]))
+            for row in range(start, self.count):
+                line = f.readline()
+                if include_deleted or not deleted[row]:
+                    yield json.loads(line)
+
+    def filenames(self):
+        index = self.metadata_index()
+        if index is None:
+            return set()
+        live = index.file_ids[~self.deleted.astype(bool)] if self.deleted_count else index.file_ids
+        return {index.filenames[i] for i in np.unique(live) if i >= 0}
+
+    def id_rows(self):
+        '''
+        Map of vector id -> row for the live rows (built on first use)
+        '''
+        self.refresh()
+        with self._lock:
+            if self._id_rows is None:
+                self._id_rows = {record["id"]: row for row, record in enumerate(self.iter_records(include_deleted=True))
+                                 if not self.deleted[row]}
+            return self._id_rows
+
+    def __contains__(self, vector_id):
+        return vector_id in self.id_rows()
+
+    def append(self, embeddings):
+        '''
+        Append embeddings ({"text", "embedding", "metadata"} and optionally "id") to the store
+        '''
+        if not embeddings:
+            return 0
+
+        with tracer.span("upsert", target="local") as span:
+            self._append(embeddings, span)
+        self.refresh()
+        return len(embeddings)
+
+    def _append(self, embeddings, span):
+        matrix = normalize_rows([item["embedding"] for item in embeddings])
+        with self._write_lock():
+            header = self._read_header()
+            if header["dim"] and header["dim"] != matrix.shape[1]:
+                raise ValueError(f"Embedding dimension {matrix.shape[1]} does not match store dimension {header['dim']}")
+            generation = header.get("generation", 0)
+
+            # Truncate anything past the header count (left over by an interrupted append)
+            count = header["count"]
+            for name, row_size in ((self.VECTORS_FILE, 4 * matrix.shape[1]), (self.OFFSETS_FILE, 8), (self.DELETED_FILE, 1)):
+                with open(self._data_path(name, generation), "ab") as f:
+                    f.truncate(count * row_size)
+            records_end = 0
+            if count:
+                offsets = np.fromfile(self._data_path(self.OFFSETS_FILE, generation), dtype=np.uint64, count=count)
+                with open(self._data_path(self.RECORDS_FILE, generation), "rb") as f:
+                    f.seek(int(offsets[-1]))
+                    f.readline()
+                    records_end = f.tell()
+            with open(self._data_path(self.RECORDS_FILE, generation), "ab") as f:
+                f.truncate(records_end)
+
+            new_offsets = []
+            with open(self._data_path(self.RECORDS_FILE, generation), "ab") as f:
+                for i, item in enumerate(embeddings):
+                    new_offsets.append(f.tell())
+                    record = {
+                        "id": item.get("id", f"vec_{header.get('version', 0)}_{i}"),
+                        "text": item["text"],
+                        "metadata": item["metadata"]
+                    }
+                    f.write(json.dumps(record).encode("utf-8") + b"\n")
+                records_written = f.tell() - records_end
+                f.flush()
+                os.fsync(f.fileno())
+            for name, data in ((self.VECTORS_FILE, matrix.tobytes()),
+                               (self.OFFSETS_FILE, np.asarray(new_offsets, dtype=np.uint64).tobytes()),
+                               (self.DELETED_FILE, bytes(len(embeddings)))):
+                with open(self._data_path(name, generation), "ab") as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+
+            # Index the texts for keyword search (a store without a lexical index yet gets one
+            # over all its rows on first use, see lexical_index())
+            new_header = {**header, "dim": int(matrix.shape[1]), "count": count + len(embeddings),
+                          "version": header.get("version", 0) + 1,
+                          "uid": header.get("uid") or uuid.uuid4().hex}
+            merged = []
+            if count == 0 or header.get("lexical") is not None:
+                ranges = [] if count == 0 else header["lexical"]
+                new_header["lexical"], merged = self._add_lexical_segment(
+                    ranges, [item["text"] for item in embeddings], count, generation)
+
+            self._write_header(new_header)
+            self._remove_lexical_segments(merged, generation)
+            span.add(items=len(embeddings), bytes=matrix.nbytes + records_written)
+
+    def _load_lexical_segment(self, start, end, generation):
+        key = (generation, start, end)
+        segment = self._lexical_segments.get(key)
+        if segment is None:
+            segment = self._lexical_segments[key] = LexicalSegment.load(self._lexical_path(start, end, generation))
+        return segment
+
+    def _add_lexical_segment(self, ranges, texts, start, generation):
+        '''
+        Write the segment of the new rows, then merge the last segments while the newest one is
+        at least as large as the one before it. Returns the new ranges and the merged ranges
+        (whose files are removed once the header no longer lists them).
+        '''
+        segment = LexicalSegment.build(texts, start)
+        segment.save(self._lexical_path(start, segment.end, generation))
+        self._lexical_segments[(generation, start, segment.end)] = segment
+        ranges = [list(r) for r in ranges] + [[start, segment.end]]
+        merged = []
+        while len(ranges) >= 2 and ranges[-1][1] - ranges[-1][0] >= ranges[-2][1] - ranges[-2][0]:
+            last, previous = ranges.pop(), ranges.pop()
+            segment = LexicalSegment.merge([self._load_lexical_segment(*previous, generation),
+                                            self._load_lexical_segment(*last, generation)])
+            segment.save(self._lexical_path(previous[0], last[1], generation))
+            self._lexical_segments[(generation, previous[0], last[1])] = segment
+            ranges.append([previous[0], last[1]])
+            merged.extend([previous, last])
+        return ranges, merged
+
+    def _remove_lexical_segments(self, ranges, generation):
+        for start, end in ranges:
+            self._lexical_segments.pop((generation, start, end), None)
+            try:
+                os.remove(self._lexical_path(start, end, generation))
+            except FileNotFoundError:
+                pass
+
+    def delete(self, ids):
+        '''
+        Delete vectors by id. Rows are only marked as deleted and skipped by search; the store
+        is compacted once COMPACT_RATIO of its rows are deleted.
+        '''
+        ids = set(ids)
+        if not ids:
+            return 0
+
+        with self._write_lock():
+            # the id map is rebuilt if another process changed the store in the meantime
+            id_rows = self.id_rows()
+            rows = sorted(id_rows[vector_id] for vector_id in ids if vector_id in id_rows)
+            if not rows:
+                return 0
+            header = self._read_header()
+            deleted = np.memmap(self._data_path(self.DELETED_FILE), dtype=np.uint8, mode="r+", shape=(header["count"],))
+            deleted[rows] = 1
+            deleted.flush()
+            del deleted
+            self._write_header({**header, "deleted": header.get("deleted", 0) + len(rows),
+                                "version": header.get("version", 0) + 1})
+
+        self.refresh()
+        if self.deleted_count > self.COMPACT_RATIO * self.count:
+            self.compact()
+        return len(rows)
+
+    def upsert(self, embeddings):
+        '''
+        Replace the vectors whose id is already in the store and append the others
+        '''
+        self.delete([item["id"] for item in embeddings if "id" in item])
+        return self.append(embeddings)
+
+    def compact(self):
+        '''
+        Rewrite the store without its deleted rows into a new generation of data files
+        '''
+        with self._write_lock():
+            self.refresh()
+            if self.deleted_count == 0:
+                return
+            old_generation = self.generation
+            generation = old_generation + 1
+            live = np.flatnonzero(self.deleted == 0)
+
+            offsets = []
+            texts = []
+            with open(self._data_path(self.RECORDS_FILE, generation), "wb") as out:
+                for row in live:
+                    record = self[int(row)]
+                    offsets.append(out.tell())
+                    texts.append(record["text"])
+                    out.write(json.dumps(record).encode("utf-8") + b"\n")
+            with open(self._data_path(self.VECTORS_FILE, generation), "wb") as out:
+                for i in range(0, len(live), 65536):
+                    out.write(np.asarray(self.vectors[live[i:i+65536]]).tobytes())
+            np.asarray(offsets, dtype=np.uint64).tofile(self._data_path(self.OFFSETS_FILE, generation))
+            np.zeros(len(live), dtype=np.uint8).tofile(self._data_path(self.DELETED_FILE, generation))
+            lexical, _ = self._add_lexical_segment([], texts, 0, generation) if len(live) else ([], [])
+
+            header = self._read_header()
+            self._write_header({**header, "count": int(len(live)), "deleted": 0, "generation": generation,
+                                "version": header.get("version", 0) + 1, "lexical": lexical})
+            self.refresh()
+            self._remove_lexical_segments(header.get("lexical") or [], old_generation)
+            # open memory maps of other processes keep the old files alive until they refresh
+            for name in (self.VECTORS_FILE, self.RECORDS_FILE, self.OFFSETS_FILE, self.DELETED_FILE, self.ANN_FILE,
+                         self.METADATA_FILE, self.QUANTIZED_FILE):
+                try:
+                    os.remove(self._data_path(name, old_generation))
+                except FileNotFoundError:
+                    pass
+
+    def ann(self):
+        '''
+        The IVF index of the store, loaded from disk or built on first use and extended with
+        the rows appended since it was saved. None while the store is below ann_min_vectors.
+        '''
+        self.refresh()
+        if self.ann_min_vectors is None or self.count < self.ann_min_vectors:
+            return None
+        with self._lock:
+            path = self._data_path(self.ANN_FILE)
+            if self.ann_index is None and os.path.exists(path):
+                self.ann_index = IVFIndex.load(path)
+            changed = False
+            if self.ann_index is None or len(self.ann_index) > self.count:
+                logger.info("Building IVF index over %d vectors", self.count)
+                with tracer.span("load", source="ann", action="train") as span:
+                    self.ann_index = IVFIndex.train(self.vectors)
+                    span.add(items=self.count)
+                changed = True
+            elif len(self.ann_index) < self.count:
+                with tracer.span("load", source="ann", action="add") as span:
+                    span.add(items=self.count - len(self.ann_index))
+                    self.ann_index.add(self.vectors[len(self.ann_index):])
+                changed = True
+            if changed:
+                self.ann_index.save(path + ".tmp")
+                os.replace(path + ".tmp", path)
+            self.ann_index.nprobe = self.nprobe
+            return self.ann_index
+
+    def quantized(self):
+        '''
+        The QuantizedIndex of the store, loaded from disk or encoded on first use and extended
+        with the rows appended since it was saved. None without quantization.
+        '''
+        self.refresh()
+        if self.quantization is None or self.count == 0:
+            return None
+        with self._lock:
+            path = self._data_path(self.QUANTIZED_FILE)
+            if self.quantized_index is None and os.path.exists(path):
+                self.quantized_index = QuantizedIndex.load(path)
+            changed = False
+            if (self.quantized_index is None or self.quantized_index.mode != self.quantization
+                    or len(self.quantized_index) > self.count):
+                logger.info("Encoding %d vectors as %s", self.count, self.quantization)
+                with tracer.span("load", source="quantized", action="train", mode=self.quantization) as span:
+                    self.quantized_index = QuantizedIndex.train(self.vectors, self.quantization,
+                                                                pq_subvectors=self.pq_subvectors)
+                    span.add(items=self.count)
+                changed = True
+            elif len(self.quantized_index) < self.count:
+                with tracer.span("load", source="quantized", action="add") as span:
+                    span.add(items=self.count - len(self.quantized_index))
+                    self.quantized_index.add(self.vectors[len(self.quantized_index):])
+                changed = True
+            if changed:
+                self.quantized_index.save(path + ".tmp")
+                os.replace(path + ".tmp", path)
+            self.quantized_index.shortlist = self.shortlist
+            return self.quantized_index
+
+    def memory_report(self):
+        '''
+        Bytes per vector scanned by a query: the float32 matrix, or the compressed codes
+        '''
+        self.refresh()
+        report = {"vectors": len(self), "dim": self.dim, "float32_bytes_per_vector": 4 * self.dim}
+        quantized = self.quantized()
+        if quantized is not None:
+            report.update(mode=quantized.mode, bytes_per_vector=quantized.memory_bytes() / max(len(quantized), 1))
+        return report
+
+    def metadata_index(self):
+        '''
+        The MetadataIndex of the store, loaded from disk and extended with the rows appended
+        since it was saved. None while the store is empty.
+        '''
+        self.refresh()
+        if self.count == 0:
+            return None
+        with self._lock:
+            path = self._data_path(self.METADATA_FILE)
+            if self._metadata_index is None and os.path.exists(path):
+                self._metadata_index = MetadataIndex.load(path)
+            if self._metadata_index is None or len(self._metadata_index) > self.count:
+                self._metadata_index = MetadataIndex()
+            if len(self._metadata_index) < self.count:
+                self._metadata_index.add(self.iter_records(include_deleted=True, start=len(self._metadata_index)))
+                self._metadata_index.save(path + ".tmp")
+                os.replace(path + ".tmp", path)
+            return self._metadata_index
+
+    def rows_matching(self, metadata_filter):
+        '''
+        Live rows matching a metadata filter (see metadataIndex.py), None if the filter doesn't
+        restrict anything
+        '''
+        index = self.metadata_index()
+        if index is None:
+            return None if not metadata_filter else np.empty(0, dtype=np.int64)
+        return index.rows(metadata_filter, deleted=self.deleted.astype(bool) if self.deleted_count else None)
+
+    def lexical_index(self):
+        '''
+        The BM25 index over the texts of the store. Stores written before the lexical index
+        existed get one built over all their rows the first time it is needed.
+        '''
+        self.refresh()
+        if self.count == 0:
+            return None
+        if self.lexical_ranges is None:
+            with self._write_lock():
+                self.refresh()
+                if self.lexical_ranges is None:
+                    logger.info("Building keyword index over %d records", self.count)
+                    texts = [record["text"] for record in self.iter_records(include_deleted=True)]
+                    lexical, _ = self._add_lexical_segment([], texts, 0, self.generation)
+                    self._write_header({**self._read_header(), "lexical": lexical})
+                    self.refresh()
+        with self._lock:
+            key = (self.generation, tuple(tuple(r) for r in self.lexical_ranges))
+            if key != self._lexical_key:
+                self._lexical_index = LexicalIndex([self._load_lexical_segment(start, end, self.generation)
+                                                    for start, end in self.lexical_ranges])
+                self._lexical_key = key
+                # drop the cached segments that were merged away
+                self._lexical_segments = {k: v for k, v in self._lexical_segments.items()
+                                          if k[0] == self.generation and k[1:] in set(key[1])}
+            return self._lexical_index
+
+    def query(self, query_embedding, top_k=10, metadata_filter=None, query_text=None, include_embeddings=False):
+        engine = self.search_engine()
+        rows = self.rows_matching(metadata_filter)
+        if query_embedding is None:
+            mode = "lexical"
+            results = engine.search_lexical(query_text, top_k=top_k, include_embeddings=include_embeddings, rows=rows)
+        elif query_text is not None and engine.lexical_index is not None:
+            mode = "hybrid"
+            results = engine.search_hybrid(query_embedding, query_text, top_k=top_k,
+                                           include_embeddings=include_embeddings, rows=rows)
+        else:
+            mode = "vector"
+            results = engine.search(query_embedding, top_k=top_k, include_embeddings=include_embeddings, rows=rows)
+        tracer.current_span().add(ann=engine.ann_index is not None and rows is None, mode=mode,
+                                  quantized=engine.quantized_index.mode if engine.quantized_index is not None else None,
+                                  scope=len(engine) if rows is None else len(rows))
+        return results
+
+    def query_many(self, query_embeddings, top_k=10, metadata_filter=None, queries=None, include_embeddings=False):
+        # scored together, one matrix-matrix product per block of rows
+        engine = self.search_engine()
+        rows = self.rows_matching(metadata_filter)
+        tracer.current_span().add(mode="hybrid" if queries is not None and engine.lexical_index is not None else "vector",
+                                  scope=len(engine) if rows is None else len(rows))
+        return engine.search_many(query_embeddings, top_k=top_k, include_embeddings=include_embeddings,
+                                  queries=queries, rows=rows)
+
+    def warm_up(self, metadata_filter=None):
+        # opens (or refreshes) the memory maps and loads the ANN / keyword / quantized indexes
+        # and the partitions of the scope, the query then finds them ready
+        self.search_engine()
+        if metadata_filter:
+            self.rows_matching(metadata_filter)
+
+    def stats(self):
+        self.refresh()
+        return {"backend": self.backend, "vectors": len(self), "dimension": self.dim, "deleted": self.deleted_count,
+                "index_version": self.index_version, "ann": self.ann() is not None,
+                "quantization": self.quantization}
+
+    def search_engine(self):
+        '''
+        VectorSearchEngine reading directly from the memory-mapped matrix, with the keyword index
+        for hybrid search
+        '''
+        ann_index = self.ann()
+        deleted = self.deleted.astype(bool) if self.deleted_count else None
+        return VectorSearchEngine(self.vectors, self, normalized=True, ann_index=ann_index, deleted=deleted,
+                                  lexical_index=self.lexical_index(), quantized_index=self.quantized())
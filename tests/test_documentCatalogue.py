@@ -0,0 +1,106 @@
+import boto3
+import pytest
+from moto import mock_aws
+
+from src.documentCatalogue import DocumentCatalogue
+from src.utils.awsService import S3DocumentProcessor
+
+BUCKET = "custom-rag-llm"
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def write(path, data):
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_upload_skips_unchanged_files(s3, tmp_path):
+    catalogue = DocumentCatalogue(S3DocumentProcessor(s3=s3, bucket_name=BUCKET), str(tmp_path / "catalogue.json"))
+    first = write(tmp_path / "CS101_lecture1.pdf", b"%PDF-1.4 lecture one")
+    second = write(tmp_path / "CS101_lecture2.pptx", b"slides two")
+
+    reports = catalogue.upload([first, second])
+    assert sorted((report["key"], report["skipped"]) for report in reports) == \
+        [("CS101_lecture1.pdf", False), ("CS101_lecture2.pptx", False)]
+
+    reports = catalogue.upload([first, second])
+    assert all(report["ok"] and report["skipped"] for report in reports)
+
+    write(tmp_path / "CS101_lecture1.pdf", b"%PDF-1.4 lecture one, edited")
+    reports = {report["key"]: report for report in catalogue.upload([first, second])}
+    assert not reports["CS101_lecture1.pdf"]["skipped"]
+    assert reports["CS101_lecture2.pptx"]["skipped"]
+    assert s3.get_object(Bucket=BUCKET, Key="CS101_lecture1.pdf")["Body"].read() == b"%PDF-1.4 lecture one, edited"
+
+
+def test_multipart_uploads_are_recognised(s3, tmp_path):
+    processor = S3DocumentProcessor(s3=s3, bucket_name=BUCKET, multipart_threshold=5 * 1024 * 1024,
+                                    multipart_chunksize=5 * 1024 * 1024)
+    catalogue = DocumentCatalogue(processor, str(tmp_path / "catalogue.json"))
+    path = write(tmp_path / "big.pdf", b"x" * (11 * 1024 * 1024))
+
+    assert not catalogue.upload([path])[0]["skipped"]
+    assert "-" in catalogue.get("big.pdf")["etag"]
+    assert catalogue.upload([path])[0]["skipped"]
+
+
+def test_refresh_pages_through_the_bucket(s3, tmp_path):
+    for i in range(1205):
+        s3.put_object(Bucket=BUCKET, Key=f"deck_{i:04d}.pptx", Body=b"x")
+    s3.put_object(Bucket=BUCKET, Key="notes.txt", Body=b"x")
+    catalogue = DocumentCatalogue(S3DocumentProcessor(s3=s3, bucket_name=BUCKET), str(tmp_path / "catalogue.json"))
+
+    changes = catalogue.refresh()
+
+    assert len(changes["added"]) == 1205
+    assert len(catalogue.files()) == 1205
+    assert catalogue.refresh() is None
+
+
+def test_catalogue_is_reloaded_from_disk(s3, tmp_path):
+    processor = S3DocumentProcessor(s3=s3, bucket_name=BUCKET)
+    path = write(tmp_path / "CS101_lecture1.pdf", b"%PDF-1.4")
+    DocumentCatalogue(processor, str(tmp_path / "catalogue.json")).upload([path])
+
+    catalogue = DocumentCatalogue(processor, str(tmp_path / "catalogue.json"))
+
+    assert catalogue.is_uploaded(path)
+
+
+def test_failed_listing_backs_off(s3, tmp_path, monkeypatch):
+    processor = S3DocumentProcessor(s3=s3, bucket_name=BUCKET)
+    path = write(tmp_path / "CS101_lecture1.pdf", b"%PDF-1.4")
+    catalogue = DocumentCatalogue(processor, str(tmp_path / "catalogue.json"), max_age=0)
+    catalogue.upload([path])
+    catalogue.refresh(force=True)
+
+    calls = []
+    listing = processor.iter_objects
+
+    def broken_listing(prefix=''):
+        calls.append(prefix)
+        raise ConnectionError("S3 is down")
+        yield
+    monkeypatch.setattr(processor, "iter_objects", broken_listing)
+
+    with pytest.raises(ConnectionError):
+        catalogue.refresh(force=True)
+    # the manifest is still served, and the bucket is not listed again during the backoff
+    assert catalogue.files() == ["CS101_lecture1.pdf"]
+    assert catalogue.files() == ["CS101_lecture1.pdf"]
+    assert len(calls) == 1
+
+    monkeypatch.setattr(processor, "iter_objects", listing)
+    catalogue.failed_at -= catalogue.retry_after()
+    assert catalogue.refresh() == {"added": [], "changed": [], "removed": []}
+    assert catalogue.failures == 0
@@ -0,0 +1,77 @@
+from types import SimpleNamespace
+import httpx
+import numpy as np
+import pytest
+from openai import APIConnectionError
+
+from benchmarks.fakes import FakeOpenAI, fake_embedding
+from src.embedAndSearch import EmbedAndSearch
+
+
+class FlakyEmbeddings():
+    '''
+    Fails the first `failures` calls with a retryable error, then answers like FakeOpenAI
+    '''
+    def __init__(self, failures, dim=16):
+        self.failures = failures
+        self.dim = dim
+        self.calls = 0
+        self.inputs = []
+
+    def create(self, input, model):
+        self.calls += 1
+        if self.failures > 0:
+            self.failures -= 1
+            raise APIConnectionError(request=httpx.Request("POST", "https://api.openai.com/v1/embeddings"))
+        self.inputs.append(list(input))
+        # answer in reverse order, the index field gives the position
+        data = [SimpleNamespace(index=i, embedding=fake_embedding(text, self.dim).tolist())
+                for i, text in enumerate(input)]
+        return SimpleNamespace(data=data[::-1], usage=None)
+
+
+def make_client(embeddings):
+    client = FakeOpenAI(dim=16)
+    client.embeddings = embeddings
+    return client
+
+
+def test_embed_texts_preserves_order_across_batches():
+    client = FakeOpenAI(dim=16)
+    embedder = EmbedAndSearch(client=client, batch_size=3, max_workers=4)
+    texts = [f"chunk number {i}" for i in range(10)]
+
+    vectors = embedder.embed_texts(texts)
+
+    assert client.embeddings.calls == 4
+    for text, vector in zip(texts, vectors):
+        np.testing.assert_allclose(vector, fake_embedding(text, 16), rtol=1e-6)
+
+
+def test_embed_batch_sorts_by_index():
+    embedder = EmbedAndSearch(client=make_client(FlakyEmbeddings(failures=0)))
+    texts = ["first", "second", "third"]
+
+    vectors = embedder.embed_batch(texts)
+
+    for text, vector in zip(texts, vectors):
+        np.testing.assert_allclose(vector, fake_embedding(text, 16), rtol=1e-6)
+
+
+def test_embed_batch_retries_transient_errors():
+    embeddings = FlakyEmbeddings(failures=2)
+    embedder = EmbedAndSearch(client=make_client(embeddings), max_retries=3, backoff=0)
+
+    vectors = embedder.embed_batch(["a", "b"])
+
+    assert embeddings.calls == 3
+    assert len(vectors) == 2
+
+
+def test_embed_batch_gives_up_after_max_retries():
+    embeddings = FlakyEmbeddings(failures=5)
+    embedder = EmbedAndSearch(client=make_client(embeddings), max_retries=2, backoff=0)
+
+    with pytest.raises(APIConnectionError):
+        embedder.embed_batch(["a"])
+    assert embeddings.calls == 3
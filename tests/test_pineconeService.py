@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from src.utils.inMemoryIndex import InMemoryPinecone
+from src.utils.pineconeService import PineConeService
+
+
+def make_embeddings(n, dim=8, words=200):
+    rng = np.random.default_rng(0)
+    return [{"text": " ".join(["word"] * words) + f" {i}", "embedding": rng.normal(size=dim),
+             "metadata": {"filename": "CS101_lecture1.pptx", "slide_number": i + 1}} for i in range(n)]
+
+
+def test_batches_stay_under_the_payload_limit():
+    pc = InMemoryPinecone(dimension=8, max_request_bytes=5000)
+    service = PineConeService(pc=pc)
+
+    report = service.upload_embeddings("test", make_embeddings(40), max_batch_bytes=5000, max_retries=0,
+                                       raise_on_error=True)
+
+    assert len(report) > 1
+    assert all(batch["ok"] and batch["bytes"] <= 5000 for batch in report)
+    assert sum(batch["vectors"] for batch in report) == 40
+    assert len(pc.Index("test").vectors) == 40
+
+
+def test_batches_are_limited_by_vector_count():
+    service = PineConeService(pc=InMemoryPinecone(dimension=8))
+
+    report = service.upload_embeddings("test", make_embeddings(25, words=1), max_batch_vectors=10)
+
+    assert [batch["vectors"] for batch in sorted(report, key=lambda batch: batch["batch"])] == [10, 10, 5]
+
+
+def test_failed_batches_are_retried():
+    pc = InMemoryPinecone(dimension=8, failures=2)
+    service = PineConeService(pc=pc)
+
+    report = service.upload_embeddings("test", make_embeddings(10, words=1), max_batch_vectors=5, max_workers=1,
+                                       max_retries=3, backoff=0)
+
+    assert all(batch["ok"] for batch in report)
+    assert sum(batch["attempts"] for batch in report) == 4
+    assert len(pc.Index("test").vectors) == 10
+
+
+def test_partial_failure_is_reported():
+    pc = InMemoryPinecone(dimension=8, failures=1)
+    service = PineConeService(pc=pc)
+    embeddings = make_embeddings(10, words=1)
+
+    report = service.upload_embeddings("test", embeddings, max_batch_vectors=5, max_workers=1, max_retries=0)
+
+    assert [batch["ok"] for batch in sorted(report, key=lambda batch: batch["batch"])] == [False, True]
+    assert len(pc.Index("test").vectors) == 5
+
+    pc.Index("test").failures = 1
+    with pytest.raises(RuntimeError):
+        service.upload_embeddings("test", embeddings, max_batch_vectors=5, max_workers=1, max_retries=0,
+                                  raise_on_error=True)
+
+
+def test_failed_delete_raises():
+    pc = InMemoryPinecone(dimension=8)
+    service = PineConeService(pc=pc)
+    service.upload_embeddings("test", make_embeddings(3, words=1))
+    ids = sorted(pc.Index("test").vectors)
+
+    def broken_delete(ids=None, **kwargs):
+        raise ConnectionError("Injected delete failure")
+    pc.Index("test").delete = broken_delete
+
+    assert service.delete_embeddings("test", ids) == 0
+    with pytest.raises(ConnectionError):
+        service.delete_embeddings("test", ids, raise_on_error=True)
+    assert len(pc.Index("test").vectors) == 3
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+from src.metadataIndex import matches_filter, normalize_filter
+from src.pineconeVectorStore import PineconeVectorStore
+from src.utils.inMemoryIndex import InMemoryPinecone
+from src.utils.pineconeService import PineConeService
+
+
+def make_store(dim=8, **options):
+    pc = InMemoryPinecone(dimension=dim)
+    store = PineconeVectorStore(PineConeService(pc=pc), "test", **options)
+    rng = np.random.default_rng(0)
+    embeddings = []
+    for i in range(30):
+        metadata = {"filename": f"CS10{i % 3}_lecture.pptx", "course": f"CS10{i % 3}", "slide_number": i % 10 + 1}
+        if i % 4 == 0:
+            metadata["last_slide_number"] = i % 10 + 3
+        embeddings.append({"id": f"chunk-{i}", "text": f"chunk {i}", "embedding": rng.normal(size=dim),
+                           "metadata": metadata})
+    assert store.upsert(embeddings) == 30
+    return pc, store, embeddings
+
+
+@pytest.mark.parametrize("metadata_filter", [
+    {"filename": "CS101_lecture.pptx"},
+    {"course": ["CS100", "CS102"]},
+    {"slide_range": (4, 6)},
+    {"slide_range": (None, 2)},
+    {"course": "CS101", "slide_range": (9, None)},
+])
+def test_query_applies_the_metadata_filter(metadata_filter):
+    _, store, embeddings = make_store()
+
+    results = store.query(np.ones(8), top_k=100, metadata_filter=metadata_filter)
+
+    expected = sorted(e["text"] for e in embeddings if matches_filter(e["metadata"], normalize_filter(metadata_filter)))
+    assert expected and sorted(result["text"] for result in results) == expected
+
+
+def test_query_needs_an_embedding():
+    _, store, _ = make_store()
+    with pytest.raises(ValueError):
+        store.query(None, query_text="keyword search")
+
+
+def test_delete_returns_the_count_and_raises_on_failure():
+    pc, store, _ = make_store()
+
+    assert store.delete(["chunk-0", "chunk-1"]) == 2
+    assert len(store) == 28
+
+    def broken_delete(ids=None, **kwargs):
+        raise ConnectionError("Injected delete failure")
+    pc.Index("test").delete = broken_delete
+    with pytest.raises(ConnectionError):
+        store.delete(["chunk-2"])
+    assert len(pc.Index("test").vectors) == 28
+
+
+def test_writes_of_another_process_change_the_index_version():
+    pc, store, embeddings = make_store(stats_ttl=0)
+    version = store.index_version
+    assert len(store) == 30
+
+    # e.g. the CLI ingest: same number of vectors, new content
+    PineConeService(pc=pc).upload_embeddings("test", [{**embeddings[0], "text": "edited"}])
+    assert len(store) == 30
+    assert store.index_version != version
+
+    version = store.index_version
+    PineconeVectorStore(PineConeService(pc=pc), "test").delete(["chunk-1"])
+    assert store.index_version != version
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from src.quantization import MODES, PQCodec, QuantizedIndex
+from src.vectorSearch import normalize_rows, top_k_indices
+
+
+def clustered(n, dim, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(max(1, n // 50), dim))
+    return normalize_rows(centers[rng.integers(0, centers.shape[0], n)] + 0.5 * rng.normal(size=(n, dim)))
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_codecs_round_trip_close_to_exact_scores(mode, tmp_path):
+    matrix = clustered(2000, 64)
+    index = QuantizedIndex.train(matrix, mode)
+    index.save(tmp_path / "index.npz")
+    loaded = QuantizedIndex.load(tmp_path / "index.npz")
+    assert loaded.mode == mode and len(loaded) == len(matrix)
+
+    query = matrix[7]
+    exact = matrix @ query
+    approximate = loaded.approximate_scores(query)
+    np.testing.assert_allclose(approximate, index.approximate_scores(query))
+    tolerance = {"float16": 1e-2, "int8": 5e-2, "pq": 0.5}[mode]
+    assert np.abs(approximate - exact).mean() < tolerance
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_search_recall(mode):
+    matrix = clustered(5000, 64)
+    rng = np.random.default_rng(1)
+    queries = normalize_rows(matrix[rng.choice(len(matrix), size=20)] + 0.1 * rng.normal(size=(20, 64)))
+    index = QuantizedIndex.train(matrix, mode)
+    found = 0
+    for query in queries:
+        rows, scores = index.search(matrix, query, top_k=10)
+        np.testing.assert_allclose(scores, matrix[rows] @ query, rtol=1e-5)
+        found += len(set(rows.tolist()) & set(top_k_indices(matrix @ query, 10).tolist()))
+    assert found / (10 * len(queries)) >= 0.9
+
+
+def test_pq_codebook_has_one_centroid_per_training_row_when_small():
+    matrix = clustered(100, 32)
+    codec = PQCodec.train(matrix, m=4)
+    assert codec.centroids.shape == (4, 100, 8)
+    codes = codec.encode(matrix)["codes"]
+    assert codes.max() < 100
+    # every row is its own centroid, so the codes reproduce the vectors
+    decoded = np.concatenate([codec.centroids[j, codes[:, j]] for j in range(4)], axis=1)
+    np.testing.assert_allclose(decoded, matrix, atol=1e-5)